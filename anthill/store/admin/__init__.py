@@ -1,19 +1,51 @@
 from anthill.common.validate import validate
 
-from anthill.common import update as common_update, to_int
+from anthill.common import to_int
 import anthill.common.admin as a
 
 from .. model.store import StoreError, StoreNotFound, StoreComponentNotFound
 from .. model.category import CategoryError, CategoryNotFound, CategoryModel
 from .. model.item import ItemError, ItemNotFound
 from .. model.tier import TierModel, TierError, TierNotFound, CurrencyError, CurrencyNotFound
-from .. model.order import OrderQueryError, OrdersModel
+from .. model.order import OrderQueryError, OrdersModel, OrderQuery
 from ..model.campaign import CampaignError, CampaignNotFound, CampaignItemNotFound
 
 import math
 import datetime
 
 
+ITEM_DATA_TITLES = {
+    "item_": ("Public Item Properties", "Private Item Properties"),
+    "campaign_item_": ("Updated Public Item Properties", "Updated Private Item Properties")
+}
+
+
+def item_data_fields(schemes, prefix):
+    """
+    Form fields to edit the item (prefix 'item_') or campaign item (prefix 'campaign_item_') data with,
+    built once per cached category schemes
+    """
+
+    fields = schemes.layout.get(prefix)
+
+    if fields is None:
+        public_title, private_title = ITEM_DATA_TITLES[prefix]
+
+        fields = {
+            prefix + "public_data": a.field(
+                public_title, "dorn", "primary",
+                schema=schemes.public_item_scheme, order=4, description="Available to everyone"),
+            prefix + "private_data": a.field(
+                private_title, "dorn", "primary",
+                schema=schemes.private_item_scheme, order=5,
+                description="Available only as a response to successful purchase")
+        }
+
+        schemes.layout[prefix] = fields
+
+    return fields
+
+
 class StoreAdminComponents(object):
     COMPONENTS = {}
 
@@ -912,30 +944,14 @@ class NewStoreItemController(a.AdminController):
             raise a.ActionError("No such store")
 
         try:
-            category = await categories.get_category(self.gamespace, category_id)
+            schemes = await categories.get_category_schemes(self.gamespace, category_id)
         except CategoryNotFound:
             raise a.ActionError("No such category")
 
-        try:
-            common_scheme = await categories.get_common_scheme(self.gamespace)
-        except CategoryNotFound:
-            common_public_item_scheme = {}
-            common_private_item_scheme = {}
-        else:
-            common_public_item_scheme = common_scheme.public_item_scheme
-            common_private_item_scheme = common_scheme.private_item_scheme
-
-        public_item_scheme = category.public_item_scheme
-        private_item_scheme = category.private_item_scheme
-
-        common_update(public_item_scheme, common_public_item_scheme)
-        common_update(private_item_scheme, common_private_item_scheme)
-
         data = {
-            "category_name": category.name,
+            "category_name": schemes.name,
             "store_name": store.name,
-            "public_item_scheme": public_item_scheme,
-            "private_item_scheme": private_item_scheme,
+            "item_data_fields": item_data_fields(schemes, "item_"),
             "item_tier": item_tier,
             "tiers_list": {tier.tier_id: u"{0} ({1})".format(tier.title, tier.name) for tier in tiers_list},
             "item_name": item_name,
@@ -962,13 +978,7 @@ class NewStoreItemController(a.AdminController):
                 "item_enabled": a.field(
                     "Is Item Enabled?", "switch", "primary",
                     order=3, description="Only enabled items will be sent to the users"),
-                "item_public_data": a.field(
-                    "Public Item Properties", "dorn", "primary",
-                    schema=data["public_item_scheme"], order=4, description="Available to everyone"),
-                "item_private_data": a.field(
-                    "Private Item Properties", "dorn", "primary",
-                    schema=data["private_item_scheme"], order=5,
-                    description="Available only as a response to successful purchase")
+                **data["item_data_fields"]
             }, methods={
                 "create": a.method("Clone" if self.context.get("clone") else "Create", "primary")
             }, data=data),
@@ -1198,31 +1208,15 @@ class StoreItemController(a.AdminController):
         tiers_list = await tiers.list_tiers(self.gamespace, store_id)
 
         try:
-            category = await categories.get_category(self.gamespace, category_id)
+            schemes = await categories.get_category_schemes(self.gamespace, category_id)
         except CategoryNotFound:
             raise a.ActionError("No such category")
 
-        try:
-            common_scheme = await categories.get_common_scheme(self.gamespace)
-        except CategoryNotFound:
-            common_public_item_scheme = {}
-            common_private_item_scheme = {}
-        else:
-            common_public_item_scheme = common_scheme.public_item_scheme
-            common_private_item_scheme = common_scheme.private_item_scheme
-
-        public_item_scheme = category.public_item_scheme
-        private_item_scheme = category.private_item_scheme
-
-        common_update(public_item_scheme, common_public_item_scheme)
-        common_update(private_item_scheme, common_private_item_scheme)
-
         return {
-            "category_name": category.name,
+            "category_name": schemes.name,
             "category_id": category_id,
             "store_name": store.name,
-            "public_item_scheme": public_item_scheme,
-            "private_item_scheme": private_item_scheme,
+            "item_data_fields": item_data_fields(schemes, "item_"),
             "item_name": item.name,
             "item_enabled": "true" if item.enabled else "false",
             "item_public_data": item.public_data,
@@ -1249,13 +1243,7 @@ class StoreItemController(a.AdminController):
                 "item_enabled": a.field(
                     "Is Item Enabled?", "switch", "primary",
                     order=3, description="Only enabled items will be sent to the users"),
-                "item_public_data": a.field(
-                    "Public Item Properties", "dorn", "primary",
-                    schema=data["public_item_scheme"], order=4, description="Available to everyone"),
-                "item_private_data": a.field(
-                    "Private Item Properties", "dorn", "primary",
-                    schema=data["private_item_scheme"], order=5,
-                    description="Available only as a response to successful purchase")
+                **data["item_data_fields"]
             }, methods={
                 "update": a.method("Update", "primary"),
                 "delete": a.method("Delete this item", "danger"),
@@ -1912,6 +1900,7 @@ class OrdersController(a.AdminController):
 
         q = orders.orders_query(self.gamespace, store_id)
 
+        q.projection = OrderQuery.PROJECTION_ADMIN
         q.offset = (page - 1) * OrdersController.ORDERS_PER_PAGE
         q.limit = OrdersController.ORDERS_PER_PAGE
 
@@ -2502,7 +2491,7 @@ class NewCampaignItemController(a.AdminController):
             try:
                 await campaigns.add_campaign_item(
                     self.gamespace, campaign_id, item_id, campaign_item_private_data,
-                    campaign_item_public_data, campaign_item_tier)
+                    campaign_item_public_data, campaign_item_tier, db=db)
             except CampaignError as e:
                 raise a.ActionError(e.message)
 
@@ -2534,7 +2523,7 @@ class NewCampaignItemController(a.AdminController):
                 raise a.ActionError("Failed to get an item: " + e.message)
 
             try:
-                category = await categories.get_category(self.gamespace, item.category, db=db)
+                schemes = await categories.get_category_schemes(self.gamespace, item.category, db=db)
             except CategoryNotFound:
                 raise a.ActionError("No such category")
 
@@ -2553,21 +2542,6 @@ class NewCampaignItemController(a.AdminController):
             except TierError as e:
                 raise a.ActionError(e.message)
 
-            try:
-                common_scheme = await categories.get_common_scheme(self.gamespace)
-            except CategoryNotFound:
-                common_public_item_scheme = {}
-                common_private_item_scheme = {}
-            else:
-                common_public_item_scheme = common_scheme.public_item_scheme
-                common_private_item_scheme = common_scheme.private_item_scheme
-
-            public_item_scheme = category.public_item_scheme
-            private_item_scheme = category.private_item_scheme
-
-            common_update(public_item_scheme, common_public_item_scheme)
-            common_update(private_item_scheme, common_private_item_scheme)
-
             data = {
                 "store_name": store.name,
                 "store_id": store_id,
@@ -2575,8 +2549,7 @@ class NewCampaignItemController(a.AdminController):
                 "item_name": item.name,
                 "campaign_item_public_data": item.public_data,
                 "campaign_item_private_data": item.private_data,
-                "public_item_scheme": public_item_scheme,
-                "private_item_scheme": private_item_scheme,
+                "item_data_fields": item_data_fields(schemes, "campaign_item_"),
                 "campaign_item_tier": item.tier,
                 "tiers_list": {tier.tier_id: u"{0} ({1})".format(tier.title, tier.name) for tier in tiers_list},
             }
@@ -2597,13 +2570,7 @@ class NewCampaignItemController(a.AdminController):
                 "campaign_item_tier": a.field(
                     "Updated Price Tier", "select", "primary",
                     values=data["tiers_list"], order=1),
-                "campaign_item_public_data": a.field(
-                    "Updated Public Item Properties", "dorn", "primary",
-                    schema=data["public_item_scheme"], order=4, description="Available to everyone"),
-                "campaign_item_private_data": a.field(
-                    "Updated Private Item Properties", "dorn", "primary",
-                    schema=data["private_item_scheme"], order=5,
-                    description="Available only as a response to successful purchase")
+                **data["item_data_fields"]
             }, methods={
                 "create": a.method("Add the Item To the Campaign", "primary"),
             }, data=data),
@@ -2658,7 +2625,7 @@ class CampaignItemController(a.AdminController):
             try:
                 updated = await campaigns.update_campaign_item(
                     self.gamespace, campaign_id, item_id, campaign_item_private_data,
-                    campaign_item_public_data, campaign_item_tier)
+                    campaign_item_public_data, campaign_item_tier, db=db)
             except CampaignError as e:
                 raise a.ActionError(e.message)
 
@@ -2702,7 +2669,7 @@ class CampaignItemController(a.AdminController):
 
             try:
                 deleted = await campaigns.delete_campaign_item(
-                    self.gamespace, campaign_id, item_id, )
+                    self.gamespace, campaign_id, item_id, db=db)
             except CampaignError as e:
                 raise a.ActionError(e.message)
 
@@ -2742,7 +2709,7 @@ class CampaignItemController(a.AdminController):
                 raise a.ActionError("Failed to get an item: " + e.message)
 
             try:
-                category = await categories.get_category(self.gamespace, item.category, db=db)
+                schemes = await categories.get_category_schemes(self.gamespace, item.category, db=db)
             except CategoryNotFound:
                 raise a.ActionError("No such category")
 
@@ -2761,21 +2728,6 @@ class CampaignItemController(a.AdminController):
             except TierError as e:
                 raise a.ActionError(e.message)
 
-            try:
-                common_scheme = await categories.get_common_scheme(self.gamespace)
-            except CategoryNotFound:
-                common_public_item_scheme = {}
-                common_private_item_scheme = {}
-            else:
-                common_public_item_scheme = common_scheme.public_item_scheme
-                common_private_item_scheme = common_scheme.private_item_scheme
-
-            public_item_scheme = category.public_item_scheme
-            private_item_scheme = category.private_item_scheme
-
-            common_update(public_item_scheme, common_public_item_scheme)
-            common_update(private_item_scheme, common_private_item_scheme)
-
             data = {
                 "store_name": store.name,
                 "store_id": store_id,
@@ -2784,8 +2736,7 @@ class CampaignItemController(a.AdminController):
                 "campaign_item_public_data": campaign_item.public_data,
                 "campaign_item_private_data": campaign_item.private_data,
                 "campaign_item_tier": campaign_item.tier,
-                "public_item_scheme": public_item_scheme,
-                "private_item_scheme": private_item_scheme,
+                "item_data_fields": item_data_fields(schemes, "campaign_item_"),
                 "tiers_list": {tier.tier_id: u"{0} ({1})".format(tier.title, tier.name) for tier in tiers_list},
             }
 
@@ -2805,13 +2756,7 @@ class CampaignItemController(a.AdminController):
                 "campaign_item_tier": a.field(
                     "Updated Price Tier", "select", "primary",
                     values=data["tiers_list"], order=1),
-                "campaign_item_public_data": a.field(
-                    "Updated Public Item Properties", "dorn", "primary",
-                    schema=data["public_item_scheme"], order=4, description="Available to everyone"),
-                "campaign_item_private_data": a.field(
-                    "Updated Private Item Properties", "dorn", "primary",
-                    schema=data["private_item_scheme"], order=5,
-                    description="Available only as a response to successful purchase")
+                **data["item_data_fields"]
             }, methods={
                 "update": a.method("Update an Item in the Campaign", "primary", order=2),
                 "remove": a.method("Remove from Campaign", "danger", order=1),
@@ -12,7 +12,8 @@ class AppStoreStoreComponentAdmin(StoreComponentAdmin):
     def get(self):
         result = super(AppStoreStoreComponentAdmin, self).get()
         result.update({
-            "sandbox": self.component.sandbox
+            "sandbox": self.component.sandbox,
+            "shared_secret": self.component.shared_secret
         })
         return result
 
@@ -22,13 +23,15 @@ class AppStoreStoreComponentAdmin(StoreComponentAdmin):
     def render(self):
         result = super(AppStoreStoreComponentAdmin, self).render()
         result.update({
-            "sandbox": a.field("Sandbox environment", "switch", "primary", "non-empty")
+            "sandbox": a.field("Sandbox environment", "switch", "primary", "non-empty"),
+            "shared_secret": a.field("Shared secret (for auto-renewable subscriptions)", "text", "primary")
         })
         return result
 
-    def update(self, sandbox=False, **fields):
+    def update(self, sandbox=False, shared_secret="", **fields):
         super(AppStoreStoreComponentAdmin, self).update(**fields)
         self.component.sandbox = sandbox
+        self.component.shared_secret = shared_secret
 
 
 class AppStoreTierComponentAdmin(TierComponentAdmin):
@@ -0,0 +1,99 @@
+
+from tornado.ioloop import IOLoop
+
+from concurrent.futures import ThreadPoolExecutor
+
+import ujson
+import time
+import zlib
+
+
+class StoreEncoder(object):
+    """
+    Encodes the store as it is delivered to the client (optionally, gzipped).
+
+    Small stores are encoded on the IOLoop right away. Large ones (of more than offload_threshold items,
+    tiers and campaign items in total) are encoded in a bounded thread pool instead, so the requests queued
+    behind them are not stalled. Since ujson holds the GIL while it encodes a single object, a large
+    store is encoded entry by entry there, which lets the IOLoop thread in between; zlib releases the GIL
+    by itself.
+
+    Every encoding is reported as the 'store_encode' action: how long it took and the size of the payload,
+    and, for the ones encoded on the IOLoop, for how long it was blocked. The IOLoop is not blocked by the
+    offloaded ones as such (only slowed down by the GIL), so no blocking is reported for those.
+    """
+
+    def __init__(self, app, threads=2, offload_threshold=500, gzip_min_size=0, gzip_level=6):
+        self.app = app
+        self.offload_threshold = offload_threshold
+        # 0 to never gzip
+        self.gzip_min_size = gzip_min_size
+        self.gzip_level = gzip_level
+        self.executor = ThreadPoolExecutor(max_workers=threads) if threads > 0 and offload_threshold > 0 else None
+
+    @staticmethod
+    def __entries__(store_data):
+        return len(store_data["items"]) + len(store_data["tiers"]) + sum(
+            len(campaign["items"]) for campaign in store_data["campaigns"])
+
+    @staticmethod
+    def __dumps__(value):
+        return ujson.dumps(value, escape_forward_slashes=False)
+
+    @staticmethod
+    def __encode_store__(store_data):
+        dumps = StoreEncoder.__dumps__
+
+        items = ",".join(dumps(item) for item in store_data["items"])
+        tiers = ",".join(dumps(name) + ":" + dumps(tier) for name, tier in store_data["tiers"].items())
+        campaigns = ",".join(dumps(campaign) for campaign in store_data["campaigns"])
+
+        return ('{"store":{"items":[' + items + '],"tiers":{' + tiers + '},"campaigns":[' +
+                campaigns + ']}}').encode("utf-8")
+
+    def __gzip__(self, body):
+        compressor = zlib.compressobj(self.gzip_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(body) + compressor.flush()
+
+    def __encode__(self, store_data, gzip):
+        body = StoreEncoder.__encode_store__(store_data)
+        size = len(body)
+
+        if gzip and self.gzip_min_size and size >= self.gzip_min_size:
+            return self.__gzip__(body), size, True
+
+        return body, size, False
+
+    def gzip_enabled(self):
+        return self.gzip_min_size > 0
+
+    async def encode(self, store_data, gzip=False):
+        """
+        Returns (body, gzipped)
+        """
+
+        offloaded = self.executor is not None and \
+            StoreEncoder.__entries__(store_data) >= self.offload_threshold
+
+        started = time.time()
+
+        if offloaded:
+            body, size, gzipped = await IOLoop.current().run_in_executor(
+                self.executor, self.__encode__, store_data, gzip)
+            values = {}
+        else:
+            body, size, gzipped = self.__encode__(store_data, gzip)
+            values = {"blocking": (time.time() - started) * 1000}
+
+        values.update({
+            "time": (time.time() - started) * 1000,
+            "size": size
+        })
+
+        self.app.monitor_action("store_encode", values=values, offloaded="1" if offloaded else "0")
+
+        return body, gzipped
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
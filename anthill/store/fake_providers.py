@@ -0,0 +1,195 @@
+"""
+A local stand-in for the payment providers, to test and load-test the order path offline.
+
+Implements Steam / MailRu ISteamMicroTxn InitTxn and FinalizeTxn calls, the Xsolla token API, and the
+App Store verifyReceipt call, with configurable latency and error rate. Optionally, every Xsolla token issued is followed by a signed
+'payment' web hook sent back to the store service, like Xsolla would do once the user has paid.
+
+Run it:
+
+    python -m anthill.store.fake_providers --port 9600 --latency 50 --error-rate 0.01 \\
+        --hook-url http://localhost:9516/hook/1/bench_0/xsolla --xsolla-project-key <project key>
+
+And start the store service with:
+
+    --provider_endpoints=steam=http://localhost:9600/steam,mailru=http://localhost:9600/mailru,xsolla=http://localhost:9600,appstore=http://localhost:9600/appstore
+
+The fake App Store takes any base64-encoded JSON {"bundle_id": ..., "in_app": [...]} as a valid receipt.
+
+Please note the provider private keys are still resolved through the login service (and cached in
+redis under auth_key:<gamespace>:<provider> for 5 minutes), so they have to be either configured there,
+or put into the cache before the test.
+"""
+
+from tornado.web import Application, RequestHandler
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.ioloop import IOLoop
+from tornado import gen
+
+import argparse
+import base64
+import binascii
+import hashlib
+import itertools
+import logging
+import random
+import ujson
+
+
+class FakeProviderHandler(RequestHandler):
+    def initialize(self, config):
+        self.config = config
+
+    async def simulate(self):
+        if self.config.latency:
+            await gen.sleep(random.uniform(0.5, 1.5) * self.config.latency / 1000.0)
+
+        return random.random() >= self.config.error_rate
+
+    def dumps(self, data):
+        self.set_header("Content-Type", "application/json")
+        self.write(ujson.dumps(data))
+
+
+class SteamTxnHandler(FakeProviderHandler):
+    async def post(self, operation):
+        order_id = self.get_body_argument("orderid")
+
+        if not await self.simulate():
+            # errorcode 7 stands for "try again later"
+            self.dumps({
+                "response": {
+                    "result": "Failure",
+                    "error": {
+                        "errorcode": 7,
+                        "errordesc": "Simulated failure"
+                    }
+                }
+            })
+            return
+
+        self.dumps({
+            "response": {
+                "result": "OK",
+                "params": {
+                    "orderid": order_id,
+                    "transid": next(self.config.transactions)
+                }
+            }
+        })
+
+
+class XsollaTokenHandler(FakeProviderHandler):
+    async def post(self, merchant_id):
+        if not await self.simulate():
+            self.set_status(503)
+            self.dumps({
+                "http_status_code": 503,
+                "message": "Simulated failure"
+            })
+            return
+
+        try:
+            body = ujson.loads(self.request.body)
+            order_id = body["settings"]["external_id"]
+        except (KeyError, ValueError, TypeError):
+            self.set_status(422)
+            self.dumps({
+                "http_status_code": 422,
+                "message": "Bad request"
+            })
+            return
+
+        token = "fake-{0}".format(next(self.config.transactions))
+
+        self.dumps({
+            "token": token
+        })
+
+        if self.config.hook_url:
+            IOLoop.current().spawn_callback(self.__payment_hook__, order_id)
+
+    async def __payment_hook__(self, order_id):
+        await gen.sleep(self.config.hook_delay)
+
+        body = ujson.dumps({
+            "notification_type": "payment",
+            "transaction": {
+                "id": next(self.config.transactions),
+                "external_id": order_id,
+                "dry_run": 1 if self.config.dry_run else 0
+            }
+        })
+
+        signature = hashlib.sha1(bytes(body + self.config.xsolla_project_key, "utf-8")).hexdigest().lower()
+
+        response = await AsyncHTTPClient().fetch(HTTPRequest(
+            self.config.hook_url, method="POST", body=body, headers={
+                "Authorization": "Signature " + signature
+            }), raise_error=False)
+
+        if response.code >= 400:
+            logging.warning("Payment hook for order {0} failed: {1} {2}".format(
+                order_id, response.code, response.body))
+
+
+class AppStoreVerifyReceiptHandler(FakeProviderHandler):
+    async def post(self):
+        if not await self.simulate():
+            # 21005 stands for "the receipt server is not currently available"
+            self.dumps({
+                "status": 21005
+            })
+            return
+
+        try:
+            body = ujson.loads(self.request.body)
+            receipt = ujson.loads(base64.b64decode(body["receipt-data"]))
+            in_app = receipt["in_app"]
+        except (KeyError, ValueError, TypeError, binascii.Error):
+            # 21002 stands for "the receipt data is malformed"
+            self.dumps({
+                "status": 21002
+            })
+            return
+
+        self.dumps({
+            "status": 0,
+            "receipt": {
+                "bundle_id": receipt.get("bundle_id"),
+                "in_app": in_app
+            }
+        })
+
+
+def make_app(settings):
+    settings.transactions = itertools.count(random.randint(1, 1 << 30))
+
+    return Application([
+        (r".*/(InitTxn|FinalizeTxn)/.*", SteamTxnHandler, dict(config=settings)),
+        (r"/merchant/merchants/([0-9]+)/token", XsollaTokenHandler, dict(config=settings)),
+        (r".*/verifyReceipt", AppStoreVerifyReceiptHandler, dict(config=settings)),
+    ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Payment providers stand-in")
+    parser.add_argument("--port", type=int, default=9600)
+    parser.add_argument("--latency", type=float, default=0, help="Average response latency, in milliseconds")
+    parser.add_argument("--error-rate", type=float, default=0, help="Share of failed calls, from 0 to 1")
+    parser.add_argument("--hook-url", default=None, help="Xsolla web hook URL of the store service")
+    parser.add_argument("--hook-delay", type=float, default=1, help="Delay before the web hook, in seconds")
+    parser.add_argument("--xsolla-project-key", default="", help="Project key to sign web hooks with")
+    parser.add_argument("--dry-run", action="store_true", help="Send web hooks as sandbox (dry run) payments")
+
+    settings = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    make_app(settings).listen(settings.port)
+    logging.info("Fake payment providers are listening on port {0}".format(settings.port))
+    IOLoop.current().start()
+
+
+if __name__ == "__main__":
+    main()
@@ -7,36 +7,51 @@ from anthill.common.validate import ValidationError, validate
 from anthill.common.internal import InternalError
 from anthill.common import to_int
 
-from . model.store import StoreNotFound, StoreError
-from . model.order import OrderError, NoOrderError, OrderQueryError
+from . model.store import StoreNotFound, StoreError, StoreComponentNotFound
+from . model.order import OrderError, NoOrderError, OrderQueryError, OrderQuery
+from . trace import traced_request
 
 import ujson
 
 
 class StoreHandler(AuthenticatedHandler):
     @scoped(["store"])
+    @traced_request("store")
     async def get(self, store_name):
         stores = self.application.stores
         gamespace = self.token.get(AccessToken.GAMESPACE)
 
         extra_start_time = self.get_argument("extra_start_time", 0)
         extra_end_time = self.get_argument("extra_end_time", self.get_argument("extra_time", 0))
+        language = self.get_argument("language", None)
 
         try:
             store_data = await stores.build_store_data(
-                gamespace, store_name, extra_start_time, extra_end_time)
+                gamespace, store_name, extra_start_time, extra_end_time, language=language)
         except StoreNotFound:
             raise HTTPError(404, "Store not found")
         except ValidationError as e:
             raise HTTPError(400, e.message)
 
-        self.dumps({
-            "store": store_data
-        })
+        encoder = self.application.store_encoder
+        gzip = encoder.gzip_enabled() and "gzip" in self.request.headers.get("Accept-Encoding", "")
+
+        body, gzipped = await encoder.encode(store_data, gzip=gzip)
+
+        self.set_header("Content-Type", "application/json")
+
+        if encoder.gzip_enabled():
+            self.set_header("Vary", "Accept-Encoding")
+
+        if gzipped:
+            self.set_header("Content-Encoding", "gzip")
+
+        self.write(body)
 
 
 class NewOrderHandler(AuthenticatedHandler):
     @scoped(["store_order"])
+    @traced_request("new_order")
     async def post(self):
         orders = self.application.orders
 
@@ -73,6 +88,7 @@ class NewOrderHandler(AuthenticatedHandler):
 
 class OrderHandler(AuthenticatedHandler):
     @scoped(["store_order"])
+    @traced_request("update_order")
     async def post(self, order_id):
         orders = self.application.orders
 
@@ -93,6 +109,7 @@ class OrderHandler(AuthenticatedHandler):
 
 class OrdersHandler(AuthenticatedHandler):
     @scoped(["store_order"])
+    @traced_request("update_orders")
     async def post(self):
         orders = self.application.orders
 
@@ -112,6 +129,7 @@ class OrdersHandler(AuthenticatedHandler):
 
 
 class WebHookHandler(AuthenticatedHandler):
+    @traced_request("web_hook")
     async def post(self, gamespace_id, store_name, component_name):
         orders = self.application.orders
 
@@ -149,6 +167,7 @@ class WebHookHandler(AuthenticatedHandler):
 
             self.write(result)
 
+    @traced_request("web_hook")
     async def get(self, gamespace_id, store_name, component_name):
         orders = self.application.orders
 
@@ -189,11 +208,11 @@ class InternalHandler(object):
     def __init__(self, application):
         self.application = application
 
-    @validate(gamespace="int", name="str_name")
-    async def get_store(self, gamespace, name):
+    @validate(gamespace="int", name="str_name", language="str_name")
+    async def get_store(self, gamespace, name, language=None):
 
         try:
-            store_data = await self.application.stores.build_store_data(gamespace, name)
+            store_data = await self.application.stores.build_store_data(gamespace, name, language=language)
         except StoreNotFound:
             raise InternalError(404, "Store not found")
         except ValidationError as e:
@@ -229,7 +248,7 @@ class InternalHandler(object):
 
         if store:
             try:
-                store_id = await stores.find_store(gamespace, store)
+                store_id = (await stores.find_store(gamespace, store)).store_id
             except StoreNotFound:
                 raise InternalError(404, "No such store")
             except StoreError as e:
@@ -238,6 +257,7 @@ class InternalHandler(object):
             store_id = None
 
         q = orders.orders_query(gamespace, store_id)
+        q.projection = OrderQuery.PROJECTION_INTERNAL
 
         if account:
             q.account_id = account
@@ -274,6 +294,44 @@ class InternalHandler(object):
             "orders": result
         }
 
+    @validate(gamespace="int", store="str_name", component="str_name", transaction_id="str")
+    async def get_order_by_transaction(self, gamespace, store, component, transaction_id):
+
+        orders = self.application.orders
+        stores = self.application.stores
+
+        try:
+            store_component = await stores.find_store_name_component(gamespace, store, component)
+        except StoreComponentNotFound:
+            raise InternalError(404, "No such store component")
+        except StoreError as e:
+            raise InternalError(500, str(e))
+
+        try:
+            order = await orders.get_order_by_transaction(
+                gamespace, store_component.component_id, transaction_id)
+        except NoOrderError:
+            raise InternalError(404, "No such order")
+        except OrderError as e:
+            raise InternalError(e.code, e.message)
+        except ValidationError as e:
+            raise InternalError(400, e.message)
+
+        return {
+            "order": {
+                "order_id": order.order_id,
+                "store_id": order.store_id,
+                "item_id": order.item_id,
+                "account": order.account_id,
+                "status": order.status,
+                "time": str(order.time),
+                "currency": order.currency,
+                "amount": order.amount,
+                "total": order.total,
+                "info": order.info
+            }
+        }
+
     @validate(gamespace="int", account="int", order_id="int")
     async def update_order(self, gamespace, account, order_id):
 
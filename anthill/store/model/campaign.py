@@ -1,12 +1,16 @@
 
 from . tier import TierAdapter
 from . item import StoreItemAdapter
+from . invalidation import CatalogInvalidation
+from . category import CategoryError, CategoryNotFound, ItemDataError
 
 from anthill.common.validate import validate
 from anthill.common.model import Model
 from anthill.common.database import DatabaseError, DuplicateError
 from anthill.common.access import utc_time
 
+from .. import trace
+
 import ujson
 import datetime
 import pytz
@@ -74,8 +78,11 @@ class CampaignItemTierAdapter(object):
 
 
 class CampaignsModel(Model):
-    def __init__(self, db):
+    def __init__(self, db, invalidation=None, categories=None):
         self.db = db
+        self.invalidation = invalidation or CatalogInvalidation()
+        # to validate the campaign item data with, if set
+        self.categories = categories
 
     def get_setup_db(self):
         return self.db
@@ -83,6 +90,34 @@ class CampaignsModel(Model):
     def get_setup_tables(self):
         return ["campaigns", "campaign_items"]
 
+    async def __validate_item_data__(self, gamespace_id, item_id, campaign_item_public_data,
+                                     campaign_item_private_data, db=None):
+        if self.categories is None:
+            return
+
+        try:
+            item = await (db or self.db).get(
+                """
+                SELECT `item_category`
+                FROM `items`
+                WHERE `gamespace_id`=%s AND `item_id`=%s;
+                """, gamespace_id, item_id)
+        except DatabaseError as e:
+            raise CampaignError(500, "Failed to get item: " + e.args[1])
+
+        if item is None:
+            raise CampaignError(404, "No such item")
+
+        try:
+            await self.categories.validate_item_data(
+                gamespace_id, item["item_category"], campaign_item_public_data, campaign_item_private_data, db=db)
+        except ItemDataError as e:
+            raise CampaignError(400, e.message)
+        except CategoryNotFound:
+            raise CampaignError(404, "No such category")
+        except CategoryError as e:
+            raise CampaignError(500, "Failed to validate item: " + str(e))
+
     @validate(gamespace_id="int", store_id="int", campaign_name="str",
               campaign_time_start="datetime", campaign_time_end="datetime",
               campaign_data="json_dict", campaign_enabled="bool")
@@ -100,8 +135,10 @@ class CampaignsModel(Model):
             )
         except DatabaseError as e:
             raise CampaignError(500, "Failed to create a campaign: " + e.args[1])
-        else:
-            return campaign_id
+
+        await self.invalidation.publish(gamespace_id, CatalogInvalidation.CAMPAIGN, campaign_id)
+
+        return campaign_id
 
     @validate(gamespace_id="int", campaign_id="int", campaign_name="str",
               campaign_time_start="datetime", campaign_time_end="datetime",
@@ -121,8 +158,10 @@ class CampaignsModel(Model):
             )
         except DatabaseError as e:
             raise CampaignError(500, "Failed to update a campaign: " + e.args[1])
-        else:
-            return updated
+
+        await self.invalidation.publish(gamespace_id, CatalogInvalidation.CAMPAIGN, campaign_id)
+
+        return updated
 
     @validate(gamespace_id="int", campaign_id="int")
     async def delete_campaign(self, gamespace_id, campaign_id):
@@ -136,8 +175,10 @@ class CampaignsModel(Model):
             )
         except DatabaseError as e:
             raise CampaignError(500, "Failed to delete a campaign: " + e.args[1])
-        else:
-            return deleted
+
+        await self.invalidation.publish(gamespace_id, CatalogInvalidation.CAMPAIGN, campaign_id)
+
+        return deleted
 
     @validate(gamespace_id="int", store_id="int", offset="int", limit="int")
     async def list_campaigns_count(self, gamespace_id, store_id, offset=0, limit=0):
@@ -185,9 +226,13 @@ class CampaignsModel(Model):
     @validate(gamespace_id="int", campaign_id="int", item_id="int", campaign_item_private_data="json_dict",
               campaign_item_public_data="json_dict", campaign_item_tier="int")
     async def add_campaign_item(self, gamespace_id, campaign_id, item_id, campaign_item_private_data,
-                          campaign_item_public_data, campaign_item_tier):
+                          campaign_item_public_data, campaign_item_tier, db=None):
+
+        await self.__validate_item_data__(
+            gamespace_id, item_id, campaign_item_public_data, campaign_item_private_data, db=db)
+
         try:
-            await self.db.insert(
+            await (db or self.db).insert(
                 """
                 INSERT INTO `campaign_items`
                 (`gamespace_id`, `campaign_id`, `item_id`, `campaign_item_private_data`, 
@@ -201,12 +246,18 @@ class CampaignsModel(Model):
         except DatabaseError as e:
             raise CampaignError(500, "Failed to add item into campaign: " + e.args[1])
 
+        await self.invalidation.publish(gamespace_id, CatalogInvalidation.CAMPAIGN_ITEM, campaign_id)
+
     @validate(gamespace_id="int", campaign_id="int", item_id="int", campaign_item_private_data="json_dict",
               campaign_item_public_data="json_dict", campaign_item_tier="int")
     async def update_campaign_item(self, gamespace_id, campaign_id, item_id,
-                             campaign_item_private_data, campaign_item_public_data, campaign_item_tier):
+                             campaign_item_private_data, campaign_item_public_data, campaign_item_tier, db=None):
+
+        await self.__validate_item_data__(
+            gamespace_id, item_id, campaign_item_public_data, campaign_item_private_data, db=db)
+
         try:
-            updated = await self.db.execute(
+            updated = await (db or self.db).execute(
                 """
                 UPDATE `campaign_items`
                 SET `campaign_item_private_data`=%s, `campaign_item_public_data`=%s, `campaign_item_tier`=%s
@@ -218,13 +269,15 @@ class CampaignsModel(Model):
             )
         except DatabaseError as e:
             raise CampaignError(500, "Failed to update item in campaign: " + e.args[1])
-        else:
-            return updated
+
+        await self.invalidation.publish(gamespace_id, CatalogInvalidation.CAMPAIGN_ITEM, campaign_id)
+
+        return updated
 
     @validate(gamespace_id="int", campaign_id="int", item_id="int")
-    async def delete_campaign_item(self, gamespace_id, campaign_id, item_id):
+    async def delete_campaign_item(self, gamespace_id, campaign_id, item_id, db=None):
         try:
-            deleted = await self.db.execute(
+            deleted = await (db or self.db).execute(
                 """
                 DELETE FROM `campaign_items`
                 WHERE `gamespace_id`=%s AND `campaign_id`=%s AND `item_id`=%s
@@ -233,8 +286,10 @@ class CampaignsModel(Model):
             )
         except DatabaseError as e:
             raise CampaignError(500, "Failed to delete a campaign item: " + e.args[1])
-        else:
-            return deleted
+
+        await self.invalidation.publish(gamespace_id, CatalogInvalidation.CAMPAIGN_ITEM, campaign_id)
+
+        return deleted
 
     @validate(gamespace_id="int", campaign_id="int")
     async def list_campaign_items(self, gamespace_id, campaign_id):
@@ -311,11 +366,12 @@ class CampaignsModel(Model):
             return CampaignItemTierAdapter(campaign_item)
 
     @validate(gamespace_id="int", store_id="int", extra_start_time="int", extra_end_time="int")
-    async def list_store_campaign_items(self, gamespace_id, store_id, extra_start_time=0, extra_end_time=0):
+    async def list_store_campaign_items(self, gamespace_id, store_id, extra_start_time=0, extra_end_time=0,
+                                        db=None):
         try:
             dt = datetime.datetime.fromtimestamp(utc_time(), tz=pytz.utc).strftime('%Y-%m-%d %H:%M:%S')
 
-            campaign_items = await self.db.query(
+            campaign_items = await (db or self.db).query(
                 """
                 SELECT 
                     `campaign_items`.`campaign_item_private_data`,
@@ -389,3 +445,8 @@ class CampaignsModel(Model):
             )
         except DatabaseError as e:
             raise CampaignError(500, "Failed to clone campaign items: " + e.args[1])
+
+        await self.invalidation.publish(gamespace_id, CatalogInvalidation.CAMPAIGN_ITEM, clone_id_to)
+
+
+trace.instrument(CampaignsModel, "campaigns")
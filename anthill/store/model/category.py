@@ -1,9 +1,19 @@
 
+from . invalidation import CatalogInvalidation
+
 from anthill.common.database import DatabaseError
 from anthill.common.model import Model
 from anthill.common.validate import validate
+from anthill.common import update as common_update
 
+import logging
 import ujson
+import copy
+
+try:
+    import jsonschema
+except ImportError:
+    jsonschema = None
 
 
 class CategoryAdapter(object):
@@ -14,6 +24,17 @@ class CategoryAdapter(object):
         self.private_item_scheme = record.get("category_private_item_scheme")
 
 
+class CategorySchemesAdapter(object):
+    def __init__(self, category, public_item_scheme, private_item_scheme):
+        self.category_id = category.category_id
+        self.name = category.name
+        # shared between the callers, so should not be modified
+        self.public_item_scheme = public_item_scheme
+        self.private_item_scheme = private_item_scheme
+        # the editor forms built from these schemes, kept along with them by the admin
+        self.layout = {}
+
+
 class CommonCategoryAdapter(object):
     def __init__(self, record):
         self.public_item_scheme = record.get("public_item_scheme")
@@ -24,6 +45,14 @@ class CategoryError(Exception):
     pass
 
 
+class ItemDataError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+
 class CategoryModel(Model):
     DEFAULT_PUBLIC_SCHEME = {
         "type": "object",
@@ -37,8 +66,144 @@ class CategoryModel(Model):
         "title": "Private part of the item, available only after the purchase"
     }
 
-    def __init__(self, db):
+    def __init__(self, db, invalidation=None, validate_items=True):
         self.db = db
+        # (gamespace, category) -> CategorySchemesAdapter
+        self.schemes = {}
+        # (gamespace, category) -> (public validator, private validator), None for a scheme not to check with
+        self.validators = {}
+        # bumped on every scheme change, so the schemes (or validators) read before it are not cached
+        self.schemes_version = 0
+        self.validate_items = validate_items and jsonschema is not None
+
+        if validate_items and jsonschema is None:
+            logging.warning("jsonschema is not installed, item data will not be validated")
+
+        self.invalidation = invalidation or CatalogInvalidation()
+        self.invalidation.add_listener(self.__schemes_changed__)
+
+    def __schemes_changed__(self, gamespace_id, entity, entity_id):
+        if gamespace_id is None:
+            self.schemes_version += 1
+            self.schemes.clear()
+            self.validators.clear()
+            return
+
+        if entity == CatalogInvalidation.CATEGORY:
+            self.schemes_version += 1
+            self.schemes.pop((gamespace_id, entity_id), None)
+            self.validators.pop((gamespace_id, entity_id), None)
+        elif entity == CatalogInvalidation.COMMON_SCHEME:
+            self.schemes_version += 1
+            for cache in (self.schemes, self.validators):
+                for key in [key for key in cache if key[0] == gamespace_id]:
+                    del cache[key]
+
+    @staticmethod
+    def merge_schemes(category_scheme, common_scheme):
+        """
+        Merges the common scheme into the category one, the same way the item editors do
+        """
+        return common_update(copy.deepcopy(category_scheme), copy.deepcopy(common_scheme))
+
+    @validate(gamespace_id="int", category_id="int")
+    async def get_category_schemes(self, gamespace_id, category_id, db=None):
+        """
+        Returns the schemes of the category with the common scheme merged in (CategorySchemesAdapter),
+        cached until either of them is changed
+        """
+
+        key = (str(gamespace_id), str(category_id))
+        schemes = self.schemes.get(key)
+
+        if schemes is not None:
+            return schemes
+
+        version = self.schemes_version
+        category = await self.get_category(gamespace_id, category_id, db=db)
+
+        try:
+            common_scheme = await self.get_common_scheme(gamespace_id, db=db)
+        except CategoryNotFound:
+            common_public_item_scheme = {}
+            common_private_item_scheme = {}
+        else:
+            common_public_item_scheme = common_scheme.public_item_scheme
+            common_private_item_scheme = common_scheme.private_item_scheme
+
+        schemes = CategorySchemesAdapter(
+            category,
+            CategoryModel.merge_schemes(category.public_item_scheme, common_public_item_scheme),
+            CategoryModel.merge_schemes(category.private_item_scheme, common_private_item_scheme))
+
+        if version == self.schemes_version:
+            self.schemes[key] = schemes
+
+        return schemes
+
+    @staticmethod
+    def __compile__(scheme):
+        validator_class = jsonschema.validators.validator_for(scheme, default=jsonschema.Draft4Validator)
+
+        try:
+            validator_class.check_schema(scheme)
+        except jsonschema.SchemaError as e:
+            # a broken scheme does not prevent the items from being edited
+            logging.warning("Category scheme is not valid, item data is not checked against it: {0}".format(
+                e.message))
+            return None
+
+        return validator_class(scheme)
+
+    async def __get_validators__(self, gamespace_id, category_id, db=None):
+        key = (str(gamespace_id), str(category_id))
+        validators = self.validators.get(key)
+
+        if validators is not None:
+            return validators
+
+        version = self.schemes_version
+        schemes = await self.get_category_schemes(gamespace_id, category_id, db=db)
+
+        validators = (CategoryModel.__compile__(schemes.public_item_scheme),
+                      CategoryModel.__compile__(schemes.private_item_scheme))
+
+        if version == self.schemes_version:
+            self.validators[key] = validators
+
+        return validators
+
+    @staticmethod
+    def __check__(validator, data, title):
+        if validator is None:
+            return
+
+        error = jsonschema.exceptions.best_match(validator.iter_errors(data))
+
+        if error is None:
+            return
+
+        path = "/".join(str(part) for part in error.absolute_path)
+
+        if path:
+            raise ItemDataError("{0} is not valid at '{1}': {2}".format(title, path, error.message))
+
+        raise ItemDataError("{0} is not valid: {1}".format(title, error.message))
+
+    @validate(gamespace_id="int", category_id="int", public_data="json", private_data="json")
+    async def validate_item_data(self, gamespace_id, category_id, public_data, private_data, db=None):
+        """
+        Checks the public and private data of an item (or a campaign item) against the schemes of its category.
+        Raises ItemDataError if they do not match.
+        """
+
+        if not self.validate_items:
+            return
+
+        public_validator, private_validator = await self.__get_validators__(gamespace_id, category_id, db=db)
+
+        CategoryModel.__check__(public_validator, public_data, "Public data")
+        CategoryModel.__check__(private_validator, private_data, "Private data")
 
     def get_setup_db(self):
         return self.db
@@ -57,6 +222,8 @@ class CategoryModel(Model):
         except DatabaseError as e:
             raise CategoryError("Failed to delete category: " + e.args[1])
 
+        await self.invalidation.publish(gamespace_id, CatalogInvalidation.CATEGORY, category_id)
+
     @validate(gamespace_id="int", category_name="str")
     async def find_category(self, gamespace_id, category_name):
         try:
@@ -90,9 +257,9 @@ class CategoryModel(Model):
         return CategoryAdapter(result)
 
     @validate(gamespace_id="int")
-    async def get_common_scheme(self, gamespace_id):
+    async def get_common_scheme(self, gamespace_id, db=None):
         try:
-            result = await self.db.get("""
+            result = await (db or self.db).get("""
                 SELECT `public_item_scheme`, `private_item_scheme`
                 FROM `categories_common`
                 WHERE `gamespace_id`=%s;
@@ -143,6 +310,8 @@ class CategoryModel(Model):
         except DatabaseError as e:
             raise CategoryError("Failed to add new category: " + e.args[1])
 
+        await self.invalidation.publish(gamespace_id, CatalogInvalidation.CATEGORY, result)
+
         return result
 
     @validate(gamespace_id="int", category_id="int", category_name="str",
@@ -163,6 +332,8 @@ class CategoryModel(Model):
         except DatabaseError as e:
             raise CategoryError("Failed to update category: " + e.args[1])
 
+        await self.invalidation.publish(gamespace_id, CatalogInvalidation.CATEGORY, category_id)
+
     @validate(gamespace_id="int", public_item_scheme="json_dict", private_item_scheme="json_dict")
     async def update_common_scheme(self, gamespace_id, public_item_scheme, private_item_scheme):
 
@@ -180,6 +351,8 @@ class CategoryModel(Model):
         except DatabaseError as e:
             raise CategoryError("Failed to create a common scheme: " + e.args[1])
 
+        await self.invalidation.publish(gamespace_id, CatalogInvalidation.COMMON_SCHEME)
+
 
 class CategoryNotFound(Exception):
     pass
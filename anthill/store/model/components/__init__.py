@@ -1,4 +1,10 @@
 
+from tornado import gen
+
+from . guard import ProviderGuards, ProviderUnavailable
+
+import datetime
+
 
 class NoSuchStoreComponentError(Exception):
     pass
@@ -17,12 +23,62 @@ class StoreComponentError(Exception):
 class StoreComponent(object):
     def __init__(self):
         self.bundle = ""
+        # a base URL that replaces the provider API (for example, a local stand-in), if any
+        self.endpoint = None
+        self.name = None
 
     def dump(self):
         return {
             "bundle": self.bundle
         }
 
+    def guard(self):
+        return ProviderGuards.guard(self.name)
+
+    async def guarded_fetch(self, client, request):
+        """
+        Fetches a provider API request within the provider's deadline, concurrency limit and circuit breaker.
+        If the provider is not available, fails right away with a 503 StoreComponentError, so the order
+        can be tried again later.
+        """
+
+        guard = self.guard()
+        request.connect_timeout = guard.timeout
+        request.request_timeout = guard.timeout
+
+        try:
+            async with guard:
+                response = await client.fetch(request)
+        except ProviderUnavailable as e:
+            raise StoreComponentError(503, str(e))
+
+        return response
+
+    async def guarded_call(self, awaitable):
+        """
+        Same as guarded_fetch, but for calls made by other means than a HTTPRequest
+        """
+
+        guard = self.guard()
+
+        try:
+            async with guard:
+                # started only once let through, and as a task of its own, so it can be cancelled
+                future = gen.convert_yielded(awaitable)
+
+                try:
+                    result = await gen.with_timeout(datetime.timedelta(seconds=guard.timeout), future)
+                finally:
+                    # gen.with_timeout leaves the call running, it should not outlive the deadline
+                    if not future.done():
+                        future.cancel()
+        except ProviderUnavailable as e:
+            raise StoreComponentError(503, str(e))
+        except gen.TimeoutError:
+            raise StoreComponentError(504, "Provider '{0}' has timed out".format(self.name))
+
+        return result
+
     def is_hook_applicable(self):
         return False
 
@@ -49,6 +105,7 @@ class TierComponent(object):
 
 class StoreComponents(object):
     COMPONENTS = {}
+    ENDPOINTS = {}
 
     @staticmethod
     def component(component_name, data):
@@ -59,6 +116,8 @@ class StoreComponents(object):
             raise NoSuchStoreComponentError()
 
         instance = cmp_class()
+        instance.name = component_name
+        instance.endpoint = StoreComponents.ENDPOINTS.get(component_name, None)
         instance.load(data)
         return instance
 
@@ -74,6 +133,10 @@ class StoreComponents(object):
     def register_component(component_name, component):
         StoreComponents.COMPONENTS[component_name] = component
 
+    @staticmethod
+    def override_endpoint(component_name, url):
+        StoreComponents.ENDPOINTS[component_name] = url.rstrip("/")
+
 
 class TierComponents(object):
     COMPONENTS = {}
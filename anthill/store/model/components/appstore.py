@@ -1,26 +1,236 @@
 
-from . import StoreComponent, TierComponent, StoreComponents, TierComponents
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest, HTTPError
+
+from . import StoreComponent, TierComponent, StoreComponents, TierComponents, StoreComponentError
+from .. order import OrdersModel, OrderError, NoOrderError
+from .. tier import TierNotFound, TierError
+
+import hashlib
+import logging
+import ujson
 
 
 class AppStoreStoreComponent(StoreComponent):
+    """
+    Validates App Store purchases server-side: the client passes the receipt of the purchase as the 'receipt'
+    env variable (and, optionally, 'transaction_id' to point at the exact purchase), the receipt is verified
+    with Apple, and the purchase is claimed by the order.
+
+    Verification results are cached by the receipt's hash, and every purchase (by its transaction_id)
+    can be claimed by a single order only. A replayed purchase is rejected without asking Apple again
+    if its 'transaction_id' is passed, or if the very same receipt has been verified recently.
+    Every renewal of an auto-renewable subscription has a transaction_id of its own,
+    so renewals are claimed just like other purchases.
+    """
+
+    LIVE_VERIFY_URL = "https://buy.itunes.apple.com/verifyReceipt"
+    SANDBOX_VERIFY_URL = "https://sandbox.itunes.apple.com/verifyReceipt"
+
+    # for how long (in seconds) a verification result is cached, configured by the server
+    RECEIPT_CACHE_TTL = 86400
+
+    # receipt statuses that will not change if the receipt is verified again
+    FINAL_STATUSES = {21000, 21002, 21003, 21004, 21006, 21008, 21010}
 
-    LIVE_VERIFY_URL = "https://sandbox.itunes.apple.com/verifyReceipt"
-    SANDBOX_VERIFY_URL = "https://buy.itunes.apple.com/verifyReceipt"
+    # a sandbox receipt (TestFlight, App Review) sent to production, should be verified with the sandbox
+    STATUS_SANDBOX_RECEIPT = 21007
 
     def __init__(self):
         super(AppStoreStoreComponent, self).__init__()
         self.sandbox = False
+        self.shared_secret = ""
+        self.client = AsyncHTTPClient()
 
     def dump(self):
         result = super(AppStoreStoreComponent, self).dump()
         result.update({
-            "sandbox": self.sandbox
+            "sandbox": self.sandbox,
+            "shared_secret": self.shared_secret
         })
         return result
 
     def load(self, data):
         super(AppStoreStoreComponent, self).load(data)
         self.sandbox = data.get("sandbox")
+        self.shared_secret = data.get("shared_secret", "")
+
+    def __url__(self, sandbox=False):
+        if self.endpoint:
+            return self.endpoint + "/verifyReceipt"
+        if self.sandbox or sandbox:
+            return AppStoreStoreComponent.SANDBOX_VERIFY_URL
+        return AppStoreStoreComponent.LIVE_VERIFY_URL
+
+    @staticmethod
+    def __cache_key__(receipt_hash):
+        return "appstore_receipt:" + receipt_hash
+
+    async def __request_verification__(self, receipt, sandbox=False):
+        arguments = {
+            "receipt-data": receipt,
+            "exclude-old-transactions": False
+        }
+
+        if self.shared_secret:
+            arguments["password"] = self.shared_secret
+
+        request = HTTPRequest(
+            url=self.__url__(sandbox=sandbox),
+            method="POST",
+            body=ujson.dumps(arguments))
+
+        try:
+            response = await self.guarded_fetch(self.client, request)
+        except HTTPError as e:
+            # 599 stands for a timeout or a connection failure
+            raise StoreComponentError(504 if e.code == 599 else 502, "Failed to verify receipt: " + e.message)
+
+        try:
+            response = ujson.loads(response.body)
+            status = response.get("status", -1)
+
+            if status != 0:
+                return {
+                    "status": status
+                }
+
+            receipt_data = response.get("receipt", {})
+
+            return {
+                "status": 0,
+                "bundle_id": receipt_data.get("bundle_id"),
+                "in_app": [
+                    {
+                        "product_id": purchase.get("product_id"),
+                        "quantity": int(purchase.get("quantity", 1)),
+                        "transaction_id": str(purchase["transaction_id"])
+                    }
+                    for purchase in receipt_data.get("in_app", [])
+                ]
+            }
+        except (KeyError, ValueError, TypeError, AttributeError):
+            raise StoreComponentError(502, "Corrupted verifyReceipt response")
+
+    async def verify_receipt(self, app, receipt):
+        receipt_hash = hashlib.sha256(receipt.encode("utf-8")).hexdigest()
+        key = AppStoreStoreComponent.__cache_key__(receipt_hash)
+
+        try:
+            async with app.cache.acquire() as db:
+                cached = await db.get(key)
+        except Exception as e:
+            logging.warning("Failed to get cached receipt verification: {0}".format(str(e)))
+            cached = None
+
+        if cached:
+            return ujson.loads(cached)
+
+        verification = await self.__request_verification__(receipt)
+
+        if verification["status"] == AppStoreStoreComponent.STATUS_SANDBOX_RECEIPT \
+                and not self.sandbox and not self.endpoint:
+            # as Apple suggests, production first, then the sandbox
+            verification = await self.__request_verification__(receipt, sandbox=True)
+
+        status = verification["status"]
+
+        # temporary failures are not cached, so the receipt would be verified again
+        if status == 0 or status in AppStoreStoreComponent.FINAL_STATUSES:
+            try:
+                async with app.cache.acquire() as db:
+                    await db.setex(key, AppStoreStoreComponent.RECEIPT_CACHE_TTL, ujson.dumps(verification))
+            except Exception as e:
+                logging.warning("Failed to cache receipt verification: {0}".format(str(e)))
+
+        return verification
+
+    async def new_order(self, app, gamespace_id, account_id, order_id, currency,
+                        price, amount, total, store, item, env, campaign_item):
+
+        receipt = env.get("receipt")
+
+        if not receipt or not isinstance(receipt, str):
+            raise StoreComponentError(400, "No receipt environment variable")
+
+        try:
+            order = await app.orders.get_order(gamespace_id, order_id)
+        except NoOrderError:
+            raise StoreComponentError(404, "No such order")
+        except OrderError as e:
+            raise StoreComponentError(e.code, e.message)
+
+        transaction_id = env.get("transaction_id")
+
+        if transaction_id:
+            transaction_id = str(transaction_id)
+
+            # a purchase that has been claimed already costs no verification
+            try:
+                await app.orders.get_order_by_transaction(gamespace_id, order.component_id, transaction_id)
+            except NoOrderError:
+                pass
+            except OrderError as e:
+                raise StoreComponentError(e.code, e.message)
+            else:
+                raise StoreComponentError(409, "The purchase has been used already")
+
+        verification = await self.verify_receipt(app, receipt)
+        status = verification["status"]
+
+        if status != 0:
+            if status in AppStoreStoreComponent.FINAL_STATUSES:
+                raise StoreComponentError(400, "Receipt is not valid: {0}".format(status))
+            raise StoreComponentError(503, "Receipt cannot be verified right now: {0}".format(status))
+
+        if self.bundle and verification["bundle_id"] != self.bundle:
+            raise StoreComponentError(400, "Receipt is for another application")
+
+        purchases = verification["in_app"]
+
+        if transaction_id:
+            purchases = [purchase for purchase in purchases if purchase["transaction_id"] == transaction_id]
+
+        # only the purchases of what has been ordered
+        matching = []
+
+        for purchase in purchases:
+            if purchase["quantity"] != amount:
+                continue
+
+            try:
+                tier = await app.tiers.find_tier_by_product(
+                    gamespace_id, store.store_id, self.name, purchase["product_id"])
+            except TierNotFound:
+                continue
+            except TierError as e:
+                raise StoreComponentError(500, e.message)
+
+            if str(tier.tier_id) == str(order.tier_id):
+                matching.append(purchase)
+
+        if not matching:
+            raise StoreComponentError(404, "No such purchase in the receipt")
+
+        for purchase in matching:
+            purchase_transaction_id = purchase["transaction_id"]
+
+            # the purchase may only be claimed once, so the same receipt cannot be used for another order
+            try:
+                claimed = await app.orders.claim_transaction(gamespace_id, order_id, purchase_transaction_id)
+            except OrderError as e:
+                raise StoreComponentError(e.code, e.message)
+
+            if claimed:
+                return {
+                    "transaction_id": purchase_transaction_id
+                }
+
+        raise StoreComponentError(409, "The purchase has been used already")
+
+    async def update_order(self, app, gamespace_id, account_id, order, order_info):
+        # the purchase has been verified and claimed by the order when it was created
+        result = (OrdersModel.STATUS_SUCCEEDED, {})
+        return result
 
 
 class AppStoreTierComponent(TierComponent):
@@ -0,0 +1,162 @@
+from tornado.httpclient import HTTPError
+from tornado import gen
+
+from anthill.common.social import APIError
+
+import asyncio
+import logging
+import socket
+import time
+
+
+class ProviderUnavailable(Exception):
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+
+class CircuitBreaker(object):
+    """
+    Opens after a number of consecutive failures, so calls fail fast instead of waiting for
+    a provider that is down. After reset_timeout seconds a single probe call is let through:
+    if it succeeds, the breaker closes again, otherwise it stays open for another period.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failures_threshold, reset_timeout):
+        self.failures_threshold = failures_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.probing = False
+
+    def allow(self):
+        if self.state == CircuitBreaker.CLOSED:
+            return True
+
+        if self.state == CircuitBreaker.OPEN:
+            if time.time() - self.opened_at < self.reset_timeout:
+                return False
+            self.state = CircuitBreaker.HALF_OPEN
+
+        if self.probing:
+            return False
+
+        self.probing = True
+        return True
+
+    def success(self):
+        self.failures = 0
+        self.probing = False
+        self.state = CircuitBreaker.CLOSED
+
+    def cancelled(self):
+        # the probe call has not completed either way, let another one through
+        self.probing = False
+
+    def failure(self):
+        self.failures += 1
+        self.probing = False
+
+        if self.state == CircuitBreaker.HALF_OPEN or self.failures >= self.failures_threshold:
+            self.state = CircuitBreaker.OPEN
+            self.opened_at = time.time()
+
+
+class ProviderGuard(object):
+    """
+    Guards calls to a single payment provider:
+
+    * every call has a deadline
+    * the number of calls in flight is limited; the limit is adaptive (additive increase on success,
+      multiplicative decrease on failure), so it shrinks when the provider slows down
+    * a circuit breaker fails the calls fast when the provider keeps failing
+
+    Calls that are not let through raise ProviderUnavailable right away.
+
+    async with guard:
+        response = await client.fetch(request)
+    """
+
+    def __init__(self, name, timeout, max_inflight, min_inflight, failures_threshold, reset_timeout):
+        self.name = name
+        self.timeout = timeout
+        self.max_inflight = max_inflight
+        self.min_inflight = min_inflight
+        self.limit = float(max_inflight)
+        self.inflight = 0
+        self.breaker = CircuitBreaker(failures_threshold, reset_timeout)
+
+    @staticmethod
+    def is_failure(exc):
+        if isinstance(exc, HTTPError):
+            # 599 is a timeout or a connection error
+            return exc.code >= 500
+        if isinstance(exc, APIError):
+            return exc.code >= 500
+        return isinstance(exc, (socket.error, gen.TimeoutError))
+
+    async def __aenter__(self):
+        if not self.breaker.allow():
+            raise ProviderUnavailable("Provider '{0}' is temporarily unavailable".format(self.name))
+
+        if self.inflight >= int(self.limit):
+            raise ProviderUnavailable("Too many requests to provider '{0}' in flight".format(self.name))
+
+        self.inflight += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.inflight -= 1
+
+        if isinstance(exc, asyncio.CancelledError):
+            # the call has been given up on (a deadline has passed, or the caller has gone away),
+            # so it says nothing about the provider: neither the breaker nor the limit are changed
+            self.breaker.cancelled()
+        elif exc is not None and ProviderGuard.is_failure(exc):
+            was_open = self.breaker.state == CircuitBreaker.OPEN
+            self.breaker.failure()
+            self.limit = max(float(self.min_inflight), self.limit / 2)
+
+            if not was_open and self.breaker.state == CircuitBreaker.OPEN:
+                logging.warning("Circuit breaker for provider '{0}' is open".format(self.name))
+        else:
+            self.breaker.success()
+            self.limit = min(float(self.max_inflight), self.limit + 1.0 / self.limit)
+
+
+class ProviderGuards(object):
+    GUARDS = {}
+
+    TIMEOUT = 10
+    MAX_INFLIGHT = 256
+    MIN_INFLIGHT = 4
+    FAILURES_THRESHOLD = 10
+    RESET_TIMEOUT = 30
+
+    @staticmethod
+    def configure(timeout, max_inflight, min_inflight, failures_threshold, reset_timeout):
+        ProviderGuards.TIMEOUT = timeout
+        ProviderGuards.MAX_INFLIGHT = max_inflight
+        ProviderGuards.MIN_INFLIGHT = min(min_inflight, max_inflight)
+        ProviderGuards.FAILURES_THRESHOLD = failures_threshold
+        ProviderGuards.RESET_TIMEOUT = reset_timeout
+        ProviderGuards.GUARDS = {}
+
+    @staticmethod
+    def guard(name):
+        guard = ProviderGuards.GUARDS.get(name, None)
+
+        if guard is None:
+            guard = ProviderGuard(
+                name, ProviderGuards.TIMEOUT, ProviderGuards.MAX_INFLIGHT, ProviderGuards.MIN_INFLIGHT,
+                ProviderGuards.FAILURES_THRESHOLD, ProviderGuards.RESET_TIMEOUT)
+            ProviderGuards.GUARDS[name] = guard
+
+        return guard
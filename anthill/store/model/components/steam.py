@@ -52,6 +52,8 @@ class SteamStoreComponent(StoreComponent):
         self.sandbox = data.get("sandbox")
 
     def __url__(self):
+        if self.endpoint:
+            return self.endpoint
         return self.sandbox_api_url if self.sandbox else self.api_url
 
     def get_api(self, app):
@@ -79,7 +81,7 @@ class SteamStoreComponent(StoreComponent):
             body=parse.urlencode(arguments))
 
         try:
-            response = await self.client.fetch(request)
+            response = await self.guarded_fetch(self.client, request)
         except HTTPError as e:
             if e.code == 400:
                 raise StoreComponentError(
@@ -199,7 +201,7 @@ class SteamStoreComponent(StoreComponent):
             body=parse.urlencode(arguments))
 
         try:
-            response = await self.client.fetch(request)
+            response = await self.guarded_fetch(self.client, request)
         except HTTPError as e:
             raise StoreComponentError(e.code, e.message)
 
@@ -1,9 +1,9 @@
 
-from tornado.httpclient import AsyncHTTPClient
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest, HTTPError
 
 from . import StoreComponent, StoreComponents, StoreComponentError
 
-from ..order import OrdersModel, OrderError
+from ..order import OrdersModel, OrderError, NoOrderError
 
 from anthill.common import to_int
 from anthill.common.social import APIError
@@ -14,6 +14,7 @@ import logging
 from urllib import parse
 import ujson
 import hashlib
+import socket
 
 
 class XsollaStoreComponent(StoreComponent):
@@ -46,7 +47,40 @@ class XsollaStoreComponent(StoreComponent):
         self.project_id = to_int(data.get("project_id", 0))
 
     def __url__(self):
-        return XsollaStoreComponent.API_URL
+        return self.endpoint or XsollaStoreComponent.API_URL
+
+    async def __api_post__(self, operation, merchant_id, api_key, **arguments):
+        # like XsollaAPI.api_post, but against the component's own endpoint, and within the provider guard
+        request = HTTPRequest(
+            self.__url__() + "/merchant/merchants/" + str(merchant_id) + "/" + operation,
+            body=ujson.dumps(arguments),
+            method="POST",
+            auth_mode="basic",
+            auth_username=str(merchant_id),
+            auth_password=str(api_key),
+            headers={
+                "Content-Type": "application/json",
+                "Accept": "application/json"
+            })
+
+        try:
+            response = await self.guarded_fetch(self.client, request)
+        except socket.error as e:
+            raise APIError(500, "Connection error: " + str(e))
+        except HTTPError as e:
+            try:
+                parsed = ujson.loads(e.response.body)
+            except (AttributeError, TypeError, KeyError, ValueError):
+                raise APIError(e.code, "Internal API error")
+            else:
+                code = parsed.get("http_status_code", e.code)
+                message = parsed.get("message", "Internal API error")
+                raise APIError(code, message)
+
+        try:
+            return ujson.loads(response.body)
+        except (KeyError, ValueError):
+            raise APIError(500, "Corrupted xsolla response")
 
     def is_hook_applicable(self):
         return True
@@ -204,7 +238,7 @@ class XsollaStoreComponent(StoreComponent):
             arguments["settings"]["mode"] = "sandbox"
 
         try:
-            response = await xsolla_api.api_post("token", merchant_id, api_key, **arguments)
+            response = await self.__api_post__("token", merchant_id, api_key, **arguments)
         except APIError as e:
             raise StoreComponentError(e.code, e.body)
 
@@ -273,7 +307,7 @@ class XsollaStoreComponent(StoreComponent):
 
         if dry_run:
             try:
-                await orders.update_order_info(
+                result = await orders.update_order_info(
                     gamespace_id, order_id, OrdersModel.STATUS_APPROVED,
                     {
                         "transaction_id": transaction_id
@@ -285,8 +319,6 @@ class XsollaStoreComponent(StoreComponent):
                         "message": e.message
                     }
                 })
-            else:
-                result = True
         else:
             try:
                 result = await orders.update_order_status_reliable(
@@ -302,7 +334,7 @@ class XsollaStoreComponent(StoreComponent):
                     }
                 })
 
-        if not result:
+        if not result and not (await self.__approved_already__(orders, gamespace_id, order_id, transaction_id)):
             raise StoreComponentError(409, {
                 "error": {
                     "code": "WRONG_STATE",
@@ -314,6 +346,23 @@ class XsollaStoreComponent(StoreComponent):
             "status": "OK"
         }
 
+    # noinspection PyMethodMayBeStatic
+    async def __approved_already__(self, orders, gamespace_id, order_id, transaction_id):
+        """
+        Xsolla retries the payment notification until it gets OK, so a retry for an order that has been
+        approved (or even succeeded) by the very same transaction is a success, not a wrong state
+        """
+
+        try:
+            order = await orders.get_order(gamespace_id, order_id)
+        except (NoOrderError, OrderError):
+            return False
+
+        if order.status not in (OrdersModel.STATUS_APPROVED, OrdersModel.STATUS_SUCCEEDED):
+            return False
+
+        return str((order.info or {}).get("transaction_id")) == str(transaction_id)
+
     async def __notification_user_validation__(self, app, gamespace_id, store_id, arguments, headers, body):
 
         logging.info("__notification_user_validation__: {0} {1} {2} {3} {4}".format(
@@ -0,0 +1,119 @@
+
+from tornado.ioloop import IOLoop
+from tornado import gen
+
+from anthill.common.model import Model
+
+from aioredis import Redis
+
+import logging
+import ujson
+import uuid
+
+
+class CatalogInvalidation(Model):
+    """
+    Lets every node know the catalog (stores, items, tiers, currencies, campaigns, categories) or the order
+    shard map has changed, so local caches of it can be dropped.
+
+    Catalog models publish (gamespace, entity, id) on every write, the event is delivered
+    to the local listeners right away, and to the other nodes through the cache's pub/sub channel.
+
+    Listeners are called as listener(gamespace_id, entity, entity_id); gamespace_id is None if anything
+    might have changed (for example, the subscription has been lost for a while).
+    """
+
+    CHANNEL = "store_catalog_invalidation"
+
+    STORE = "store"
+    STORE_COMPONENT = "store_component"
+    ITEM = "item"
+    TIER = "tier"
+    TIER_COMPONENT = "tier_component"
+    CURRENCY = "currency"
+    CAMPAIGN = "campaign"
+    CAMPAIGN_ITEM = "campaign_item"
+    CATEGORY = "category"
+    COMMON_SCHEME = "common_scheme"
+    ORDER_SHARD = "order_shard"
+
+    # delay before subscribing again if the subscription is lost
+    RECONNECT_DELAY = 1
+
+    def __init__(self, cache=None):
+        self.cache = cache
+        self.listeners = []
+        self.node_id = uuid.uuid4().hex
+        self.redis = None
+        self.running = False
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def __dispatch__(self, gamespace_id, entity, entity_id):
+        for listener in self.listeners:
+            try:
+                listener(gamespace_id, entity, entity_id)
+            except Exception:
+                logging.exception("Catalog invalidation listener has failed")
+
+    async def publish(self, gamespace_id, entity, entity_id=None):
+        gamespace_id = str(gamespace_id)
+        entity_id = str(entity_id) if entity_id is not None else None
+
+        self.__dispatch__(gamespace_id, entity, entity_id)
+
+        if self.cache is None:
+            return
+
+        try:
+            async with self.cache.acquire() as db:
+                await db.publish(CatalogInvalidation.CHANNEL, ujson.dumps({
+                    "node": self.node_id,
+                    "gamespace": gamespace_id,
+                    "entity": entity,
+                    "id": entity_id
+                }))
+        except Exception as e:
+            # the other nodes will catch up when their caches expire
+            logging.error("Failed to publish catalog invalidation: {0}".format(str(e)))
+
+    async def __listen__(self):
+        while self.running:
+            try:
+                self.redis = Redis(self.cache.connection_pool)
+                channel, = await self.redis.subscribe(CatalogInvalidation.CHANNEL)
+
+                while await channel.wait_message():
+                    try:
+                        message = ujson.loads(await channel.get())
+                        if message.get("node") == self.node_id:
+                            continue
+                        self.__dispatch__(message["gamespace"], message["entity"], message.get("id"))
+                    except (KeyError, ValueError, TypeError):
+                        logging.warning("Bad catalog invalidation message")
+            except Exception as e:
+                logging.error("Catalog invalidation subscription has failed: {0}".format(str(e)))
+
+            if self.running:
+                # the messages sent in between are lost, so all of the local caches are dropped
+                self.__dispatch__(None, None, None)
+                await gen.sleep(CatalogInvalidation.RECONNECT_DELAY)
+
+    async def started(self, application):
+        await super(CatalogInvalidation, self).started(application)
+
+        if self.cache is not None:
+            self.running = True
+            IOLoop.current().spawn_callback(self.__listen__)
+
+    async def stopped(self):
+        self.running = False
+
+        if self.redis is not None:
+            try:
+                await self.redis.unsubscribe(CatalogInvalidation.CHANNEL)
+            except Exception:
+                pass
+
+        await super(CatalogInvalidation, self).stopped()
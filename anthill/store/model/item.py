@@ -1,6 +1,7 @@
 
-from . category import CategoryAdapter
+from . category import CategoryAdapter, CategoryError, CategoryNotFound, ItemDataError
 from . tier import TierAdapter
+from . invalidation import CatalogInvalidation
 
 from anthill.common.database import DatabaseError, DuplicateError
 from anthill.common.model import Model
@@ -20,25 +21,40 @@ class StoreItemAdapter(object):
         self.tier = str(record.get("item_tier"))
         self.enabled = bool(record.get("item_enabled"))
 
-    def description(self, language):
-        descriptions = self.public_data.get("description", {})
+    # public fields that may hold a {language: string} dict instead of a plain string
+    LOCALIZED_FIELDS = ["title", "description"]
 
-        if isinstance(descriptions, str):
-            return descriptions
-        elif isinstance(descriptions, dict):
-            return descriptions.get(language, descriptions.get("EN", "Unknown"))
+    @staticmethod
+    def localize(value, language):
+        if isinstance(value, str):
+            return value
+        elif isinstance(value, dict):
+            return value.get(language, value.get("EN", "Unknown"))
 
         return "Unknown"
 
-    def title(self, language):
-        titles = self.public_data.get("title", {})
+    @staticmethod
+    def localize_public_data(public_data, language):
+        """
+        Returns a copy of public_data with every localized field resolved into a single string
+        for the language requested (falling back to EN), other fields are left as is
+        """
+        if not isinstance(public_data, dict):
+            return public_data
 
-        if isinstance(titles, str):
-            return titles
-        elif isinstance(titles, dict):
-            return titles.get(language, titles.get("EN", "Unknown"))
+        result = dict(public_data)
 
-        return "Unknown"
+        for field in StoreItemAdapter.LOCALIZED_FIELDS:
+            if field in result:
+                result[field] = StoreItemAdapter.localize(result[field], language)
+
+        return result
+
+    def description(self, language):
+        return StoreItemAdapter.localize(self.public_data.get("description", {}), language)
+
+    def title(self, language):
+        return StoreItemAdapter.localize(self.public_data.get("title", {}), language)
 
     def apply_campaign(self, campaign_item):
         self.public_data = campaign_item.public_data
@@ -68,12 +84,28 @@ class ItemError(Exception):
 
 
 class ItemModel(Model):
-    def __init__(self, db):
+    def __init__(self, db, invalidation=None, categories=None):
         self.db = db
+        self.invalidation = invalidation or CatalogInvalidation()
+        # to validate the item data with, if set
+        self.categories = categories
 
     def get_setup_tables(self):
         return ["items"]
 
+    async def __validate_data__(self, gamespace_id, category_id, item_public_data, item_private_data):
+        if self.categories is None:
+            return
+
+        try:
+            await self.categories.validate_item_data(gamespace_id, category_id, item_public_data, item_private_data)
+        except ItemDataError as e:
+            raise ItemError(e.message)
+        except CategoryNotFound:
+            raise ItemError("No such category")
+        except CategoryError as e:
+            raise ItemError("Failed to validate item: " + str(e))
+
     def get_setup_db(self):
         return self.db
 
@@ -94,6 +126,8 @@ class ItemModel(Model):
         except DatabaseError as e:
             raise ItemError("Failed to delete item: " + e.args[1])
 
+        await self.invalidation.publish(gamespace_id, CatalogInvalidation.ITEM, item_id)
+
     @validate(gamespace_id="int", store_id="int", item_name="str")
     async def find_item(self, gamespace_id, store_id, item_name):
         try:
@@ -189,6 +223,9 @@ class ItemModel(Model):
               item_enabled="bool", item_public_data="json", item_private_data="json", item_tier="int")
     async def new_item(self, gamespace_id, store_id, category_id, item_name, item_enabled,
                  item_public_data, item_private_data, item_tier):
+
+        await self.__validate_data__(gamespace_id, category_id, item_public_data, item_private_data)
+
         try:
             item_id = await self.db.insert(
                 """
@@ -203,6 +240,8 @@ class ItemModel(Model):
         except DatabaseError as e:
             raise ItemError("Failed to add new item: " + e.args[1])
 
+        await self.invalidation.publish(gamespace_id, CatalogInvalidation.ITEM, item_id)
+
         return item_id
 
     @validate(gamespace_id="int", item_id="int", item_name="str", item_enabled="bool",
@@ -210,6 +249,14 @@ class ItemModel(Model):
     async def update_item(self, gamespace_id, item_id, item_name, item_enabled,
                     item_public_data, item_private_data, item_tier):
 
+        if self.categories is not None:
+            try:
+                item = await self.get_item(gamespace_id, item_id)
+            except ItemNotFound:
+                raise ItemError("No such item")
+
+            await self.__validate_data__(gamespace_id, item.category, item_public_data, item_private_data)
+
         try:
             await self.db.execute("""
                 UPDATE `items`
@@ -223,6 +270,8 @@ class ItemModel(Model):
         except DatabaseError as e:
             raise ItemError("Failed to update item: " + e.args[1])
 
+        await self.invalidation.publish(gamespace_id, CatalogInvalidation.ITEM, item_id)
+
 
 class ItemNotFound(Exception):
     pass
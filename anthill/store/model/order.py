@@ -1,20 +1,26 @@
 
-from tornado.ioloop import PeriodicCallback
+from tornado.ioloop import PeriodicCallback, IOLoop
+from tornado.gen import Future, convert_yielded, multi
 
 from . store import StoreAdapter, StoreComponentAdapter, StoreError, StoreComponentNotFound
 from . item import StoreItemAdapter
 from . tier import TierError, TierNotFound, TierAdapter
 from . campaign import CampaignError, CampaignItemNotFound
 from . components import StoreComponents, StoreComponentError, NoSuchStoreComponentError
+from . shard import OrderShards, OrderShardError
 
 from anthill.common.model import Model
 from anthill.common.database import DatabaseError, format_conditions_json
 from anthill.common.validate import validate
 from anthill.common import to_int
 
+from .. import trace
+
 
 import logging
 import ujson
+import re
+import time
 
 
 class OrderAdapter(object):
@@ -32,6 +38,7 @@ class OrderAdapter(object):
         self.total = data.get("order_total")
         self.info = data.get("order_info")
         self.campaign_id = data.get("order_campaign_id")
+        self.version = data.get("order_version", 0)
 
 
 class StoreComponentItemTierAdapter(object):
@@ -74,10 +81,59 @@ class OrderQueryError(Exception):
 
 
 class OrderQuery(object):
-    def __init__(self, gamespace_id, db, store_id=None):
+    # values of indexed order info keys are cut to this length
+    INFO_INDEX_LENGTH = 191
+
+    # every column of every joined table, like it used to be
+    PROJECTION_FULL = "full"
+    # what the admin orders list renders
+    PROJECTION_ADMIN = "admin"
+    # what the internal list_orders returns
+    PROJECTION_INTERNAL = "internal"
+
+    PROJECTIONS = {
+        PROJECTION_FULL: ["`orders`.*", "`items`.*", "`store_components`.*", "`tiers`.*"],
+        PROJECTION_ADMIN: [
+            "`orders`.`order_id`", "`orders`.`store_id`", "`orders`.`tier_id`", "`orders`.`item_id`",
+            "`orders`.`account_id`", "`orders`.`order_amount`", "`orders`.`order_status`", "`orders`.`order_time`",
+            "`orders`.`order_currency`", "`orders`.`order_total`", "`orders`.`order_campaign_id`",
+            "`items`.`item_name`", "`tiers`.`tier_name`", "`store_components`.`component`"
+        ],
+        PROJECTION_INTERNAL: [
+            "`orders`.`order_id`", "`orders`.`account_id`", "`orders`.`order_amount`", "`orders`.`order_status`",
+            "`orders`.`order_time`", "`orders`.`order_currency`",
+            "`items`.`item_name`", "`items`.`item_public_data`", "`store_components`.`component`"
+        ]
+    }
+
+    JOINS = {
+        "items": """
+            INNER JOIN `items` ON `items`.`item_id`=`orders`.`item_id`
+                AND `items`.`gamespace_id`=`orders`.`gamespace_id`
+        """,
+        "store_components": """
+            INNER JOIN `store_components` ON `store_components`.`component_id`=`orders`.`component_id`
+                AND `store_components`.`gamespace_id`=`orders`.`gamespace_id`
+        """,
+        "tiers": """
+            INNER JOIN `tiers` ON `tiers`.`tier_id`=`orders`.`tier_id`
+        """
+    }
+
+    CATALOG_KEYS = {
+        "items": "item_id",
+        "store_components": "component_id",
+        "tiers": "tier_id"
+    }
+
+    def __init__(self, gamespace_id, db, store_id=None, info_indexes=None, shards=None):
         self.gamespace_id = gamespace_id
         self.store_id = store_id
         self.db = db
+        # if set, the orders are looked up on the gamespace's shard, and joined with the catalog (on db) here
+        self.shards = shards
+        # order info key -> indexed column that has its value
+        self.info_indexes = info_indexes or {}
 
         self.tier_id = None
         self.item_id = None
@@ -90,14 +146,30 @@ class OrderQuery(object):
         self.offset = 0
         self.limit = 0
 
+        # either a name of one of PROJECTIONS, or a list of `table`.`column` to select
+        self.projection = OrderQuery.PROJECTION_FULL
+
+    def __columns__(self):
+        if isinstance(self.projection, (list, tuple)):
+            return list(self.projection)
+
+        try:
+            return OrderQuery.PROJECTIONS[self.projection]
+        except KeyError:
+            raise OrderQueryError(400, "No such projection: " + str(self.projection))
+
+    @staticmethod
+    def __joins__(columns):
+        # only the tables the columns come from are joined, every order has all of them anyway
+        return [
+            join
+            for table, join in OrderQuery.JOINS.items()
+            if any(column.startswith("`" + table + "`.") for column in columns)
+        ]
+
     def __values__(self):
         conditions = [
-            "`orders`.`gamespace_id`=%s",
-            "`orders`.`component_id`=`store_components`.`component_id`",
-            "`orders`.`gamespace_id`=`store_components`.`gamespace_id`",
-            "`items`.`item_id`=`orders`.`item_id`",
-            "`items`.`gamespace_id`=`orders`.`gamespace_id`",
-            "`orders`.`tier_id`=`tiers`.`tier_id`"
+            "`orders`.`gamespace_id`=%s"
         ]
 
         data = [
@@ -133,24 +205,146 @@ class OrderQuery(object):
             data.append(str(self.status))
 
         if self.info:
-            for condition, values in format_conditions_json('order_info', self.info):
-                conditions.append(condition)
-                data.extend(values)
+            info = self.__info_indexed_conditions__(conditions, data)
+
+            if info:
+                for condition, values in format_conditions_json('order_info', info):
+                    conditions.append(condition)
+                    data.extend(values)
 
         return conditions, data
 
+    @staticmethod
+    def __index_value__(value):
+        if isinstance(value, bool):
+            return "true" if value else "false"
+
+        if isinstance(value, (str, int, float)):
+            value = str(value)
+            if len(value) < OrderQuery.INFO_INDEX_LENGTH:
+                return value
+
+        return None
+
+    def __info_indexed_conditions__(self, conditions, data):
+        """
+        Turns the info filters that can be served by an indexed column into conditions on that column,
+        returns the rest of them
+        """
+
+        rest = {}
+
+        for key, value in self.info.items():
+            column = self.info_indexes.get(key, None)
+
+            if column is None:
+                rest[key] = value
+                continue
+
+            if isinstance(value, dict) and value.get("@func") == "=":
+                value = value.get("@value")
+
+            if isinstance(value, list):
+                values = [OrderQuery.__index_value__(v) for v in value]
+                if value and None not in values:
+                    conditions.append("`orders`.`" + column + "` IN %s")
+                    data.append(values)
+                    continue
+            else:
+                index_value = OrderQuery.__index_value__(value)
+                if index_value is not None:
+                    conditions.append("`orders`.`" + column + "`=%s")
+                    data.append(index_value)
+                    continue
+
+            rest[key] = self.info[key]
+
+        return rest
+
+    async def __join_catalog__(self, columns, rows):
+        """
+        Joins the orders with the catalog rows they refer to, for the orders that are not on the main database
+        """
+
+        tables = [
+            table
+            for table in OrderQuery.CATALOG_KEYS
+            if any(column.startswith("`" + table + "`.") for column in columns)
+        ]
+
+        catalog = {}
+
+        for table in tables:
+            key = OrderQuery.CATALOG_KEYS[table]
+            ids = list(set(row[key] for row in rows))
+
+            if not ids:
+                catalog[table] = {}
+                continue
+
+            entries = await self.db.query(
+                """
+                    SELECT *
+                    FROM `{0}`
+                    WHERE `{1}` IN %s;
+                """.format(table, key), ids)
+
+            catalog[table] = {entry[key]: entry for entry in entries}
+
+        result = []
+
+        for row in rows:
+            joined = {}
+            missing = False
+
+            # like with the join, the columns of the orders come first, then of the items, and so on
+            for table in reversed(tables):
+                entry = catalog[table].get(row[OrderQuery.CATALOG_KEYS[table]], None)
+                if entry is None:
+                    missing = True
+                    break
+                joined.update(entry)
+
+            if missing:
+                continue
+
+            joined.update(row)
+            result.append(joined)
+
+        return result
+
     async def query(self, one=False, count=False):
         conditions, data = self.__values__()
+        columns = self.__columns__()
+
+        if self.shards is not None:
+            try:
+                orders_db = self.shards.db_for(self.gamespace_id)
+            except OrderShardError as e:
+                raise OrderQueryError(e.code, e.message)
+        else:
+            orders_db = self.db
+
+        if orders_db is not self.db:
+            # the catalog is not there to join with
+            catalog_columns = columns
+            columns = ["`orders`.*"]
+        else:
+            catalog_columns = None
 
         query = """
-            SELECT {0} * FROM `orders`, `items`, `store_components`, `tiers`
-            WHERE {1}
+            SELECT {0} {1}
+            FROM `orders`
+            {2}
+            WHERE {3}
         """.format(
             "SQL_CALC_FOUND_ROWS" if count else "",
+            ", ".join(columns),
+            "".join(OrderQuery.__joins__(columns)),
             " AND ".join(conditions))
 
         query += """
-            ORDER BY `order_time` DESC
+            ORDER BY `orders`.`order_time` DESC
         """
 
         if self.limit:
@@ -164,7 +358,9 @@ class OrderQuery(object):
 
         if one:
             try:
-                result = await self.db.get(query, *data)
+                result = await orders_db.get(query, *data)
+                if result and catalog_columns is not None:
+                    result = next(iter(await self.__join_catalog__(catalog_columns, [result])), None)
             except DatabaseError as e:
                 raise OrderQueryError(500, "Failed to get message: " + e.args[1])
 
@@ -173,19 +369,27 @@ class OrderQuery(object):
 
             return OrderComponentTierItemAdapter(result)
         else:
-            try:
-                result = await self.db.query(query, *data)
-            except DatabaseError as e:
-                raise OrderQueryError(500, "Failed to query messages: " + e.args[1])
+            # FOUND_ROWS() only works on the same connection
+            async with orders_db.acquire() as db:
+                try:
+                    result = await db.query(query, *data)
+                except DatabaseError as e:
+                    raise OrderQueryError(500, "Failed to query messages: " + e.args[1])
 
-            count_result = 0
+                count_result = 0
 
-            if count:
-                count_result = await self.db.get(
-                    """
-                        SELECT FOUND_ROWS() AS count;
-                    """)
-                count_result = count_result["count"]
+                if count:
+                    count_result = await db.get(
+                        """
+                            SELECT FOUND_ROWS() AS count;
+                        """)
+                    count_result = count_result["count"]
+
+            if catalog_columns is not None:
+                try:
+                    result = await self.__join_catalog__(catalog_columns, result)
+                except DatabaseError as e:
+                    raise OrderQueryError(500, "Failed to query messages: " + e.args[1])
 
             items = map(OrderComponentTierItemAdapter, result)
 
@@ -195,6 +399,409 @@ class OrderQuery(object):
             return items
 
 
+class OrderStatusWriter(object):
+    """
+    Applies the order status UPDATEs of the state machine. If the batch window is set, the UPDATEs made
+    within it are applied on a single connection in a single transaction (one commit instead of many),
+    every caller still gets the number of rows its own UPDATE has changed.
+
+    The UPDATEs of a batch are applied in the order_id order, so concurrent batches lock the rows in the same
+    order. If the batch fails (say, on a deadlock), its UPDATEs are retried one by one.
+    """
+
+    def __init__(self, db, window=0, max_batch=100):
+        self.db = db
+        # in seconds, 0 to apply every UPDATE right away
+        self.window = window
+        self.max_batch = max_batch
+        self.pending = []
+        self.flush_handle = None
+        # batches being written right now
+        self.writes = set()
+
+    async def execute(self, order_id, query, *data):
+        if not self.window:
+            updated = await self.db.execute(query, *data)
+            return updated
+
+        future = Future()
+        self.pending.append((int(order_id), query, data, future))
+
+        if len(self.pending) >= self.max_batch:
+            self.__flush__()
+        elif self.flush_handle is None:
+            self.flush_handle = IOLoop.current().call_later(self.window, self.__flush__)
+
+        updated = await future
+        return updated
+
+    async def stopped(self):
+        self.window = 0
+        if self.pending:
+            self.__flush__()
+        if self.writes:
+            await multi(list(self.writes))
+
+    def __flush__(self):
+        if self.flush_handle is not None:
+            IOLoop.current().remove_timeout(self.flush_handle)
+            self.flush_handle = None
+
+        batch, self.pending = self.pending, []
+
+        if batch:
+            # sorted is stable, so the UPDATEs of the same order keep their order
+            write = convert_yielded(self.__write__(sorted(batch, key=lambda entry: entry[0])))
+            self.writes.add(write)
+            write.add_done_callback(self.writes.discard)
+
+    async def __write__(self, batch):
+        error = None
+
+        try:
+            try:
+                results = []
+
+                async with self.db.acquire(auto_commit=False) as db:
+                    try:
+                        for order_id, query, data, future in batch:
+                            results.append(await db.execute(query, *data))
+                        await db.commit()
+                    except Exception:
+                        # the connection goes back to the pool, it should not keep the transaction open
+                        await db.rollback()
+                        raise
+            except DatabaseError:
+                # one bad UPDATE should not fail the others
+                for order_id, query, data, future in batch:
+                    try:
+                        updated = await self.db.execute(query, *data)
+                    except DatabaseError as e:
+                        future.set_exception(e)
+                    else:
+                        future.set_result(updated)
+            else:
+                for (order_id, query, data, future), updated in zip(batch, results):
+                    future.set_result(updated)
+        except Exception as e:
+            logging.exception("Failed to update a batch of {0} orders".format(len(batch)))
+            error = e
+        finally:
+            # whatever has happened, none of the callers may be left waiting
+            for order_id, query, data, future in batch:
+                if not future.done():
+                    future.set_exception(DatabaseError(0, "Failed to update order: {0}".format(
+                        str(error) if error is not None else "interrupted")))
+
+
+class OrderStateMachine(object):
+    """
+    The only way an order changes its status. Every transition is a single conditional UPDATE, that is applied
+    only if the order is in a status the new one can be reached from (and, optionally, in the expected
+    status and version), so an order can never make the same transition twice. The order info is patched
+    in place with JSON_SET instead of being rewritten as a whole, so the write stays small however large
+    the info is.
+
+    If history is enabled, every transition is also appended to the "history" list of the order info,
+    as {"status": <new status>, "from": <old status>, "time": <unix time>}.
+
+    If the batch window is set, the transitions made within it are committed together, see OrderStatusWriter.
+
+    Hooks are coroutines awaited as hook(gamespace_id, order_id, old_status, new_status, info, account_id) after
+    every successful transition; old_status is None if the transition was not made from a known status,
+    and account_id is None if the transition was not made for a known account.
+    """
+
+    STATUS_NEW = "NEW"
+    STATUS_CREATED = "CREATED"
+    STATUS_ERROR = "ERROR"
+    STATUS_RETRY = "RETRY"
+    STATUS_APPROVED = "APPROVED"
+    STATUS_REJECTED = "REJECTED"
+    STATUS_SUCCEEDED = "SUCCEEDED"
+
+    # status -> statuses it can be changed to
+    TRANSITIONS = {
+        STATUS_NEW: {STATUS_CREATED, STATUS_ERROR},
+        STATUS_CREATED: {STATUS_APPROVED, STATUS_SUCCEEDED, STATUS_RETRY, STATUS_ERROR, STATUS_REJECTED},
+        STATUS_RETRY: {STATUS_APPROVED, STATUS_SUCCEEDED, STATUS_RETRY, STATUS_ERROR, STATUS_REJECTED},
+        STATUS_APPROVED: {STATUS_SUCCEEDED, STATUS_RETRY, STATUS_ERROR, STATUS_REJECTED},
+        STATUS_SUCCEEDED: set(),
+        STATUS_ERROR: set(),
+        STATUS_REJECTED: set()
+    }
+
+    def __init__(self, shards, history=False, batch_window=0):
+        # the orders of a gamespace are updated on its shard
+        self.shards = shards
+        self.history = history
+        self.hooks = []
+        self.batch_window = batch_window
+        # database -> OrderStatusWriter
+        self.writers = {}
+
+    def __writer__(self, db):
+        writer = self.writers.get(db)
+        if writer is None:
+            writer = OrderStatusWriter(db, window=self.batch_window)
+            self.writers[db] = writer
+        return writer
+
+    async def stopped(self):
+        for writer in list(self.writers.values()):
+            await writer.stopped()
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    @staticmethod
+    def sources(new_status):
+        return [
+            status
+            for status, targets in OrderStateMachine.TRANSITIONS.items()
+            if new_status in targets
+        ]
+
+    @staticmethod
+    def __info_path__(key):
+        return '$."' + str(key).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+    @staticmethod
+    def is_legal(old_status, new_status):
+        return new_status in OrderStateMachine.TRANSITIONS.get(old_status, ())
+
+    async def transition(self, gamespace_id, order_id, new_status, info=None, old_status=None,
+                         version=None, account_id=None, conditions=None, release_lease=False, db=None):
+        """
+        Changes the order status to new_status, and patches the order info with info, if any.
+
+        :param old_status: apply only if the order is in this status
+        :param version: apply only if the order has this version
+        :param account_id: apply only if the order belongs to this account
+        :param conditions: additional column=value conditions
+        :param release_lease: clear the order lease
+        :param db: apply on this connection right away, instead of the gamespace's shard
+        :returns: True if the transition is made, False if the order is not found or not in the right condition
+        :raises OrderError: 400 if there is no such status, 409 if the transition from old_status to new_status
+            is not a legal one
+        """
+
+        if new_status not in OrderStateMachine.TRANSITIONS:
+            raise OrderError(400, "No such order status: " + str(new_status))
+
+        if old_status is not None:
+            if old_status not in OrderStateMachine.TRANSITIONS:
+                # no order can be in that status, so the condition is just not met
+                return False
+            if not OrderStateMachine.is_legal(old_status, new_status):
+                raise OrderError(409, "Order cannot be changed from {0} to {1}".format(old_status, new_status))
+            sources = [old_status]
+        else:
+            sources = OrderStateMachine.sources(new_status)
+
+        if not sources:
+            return False
+
+        updates = ["`order_status`=%s", "`order_version`=`order_version`+1"]
+        data = [new_status]
+
+        if info:
+            # same as dict.update, but on the server side
+            paths = []
+            for key, value in info.items():
+                paths.append("%s, CAST(%s AS JSON)")
+                data.extend([OrderStateMachine.__info_path__(key), ujson.dumps(value)])
+
+            updates.append("`order_info`=JSON_SET(COALESCE(`order_info`, JSON_OBJECT()), {0})".format(
+                ", ".join(paths)))
+
+        if self.history:
+            # assignments are applied left to right, so this one sees the info patched above
+            updates.append("`order_info`=JSON_ARRAY_APPEND("
+                           "IF(JSON_CONTAINS_PATH(COALESCE(`order_info`, JSON_OBJECT()), 'one', '$.history'), "
+                           "`order_info`, JSON_SET(COALESCE(`order_info`, JSON_OBJECT()), '$.history', JSON_ARRAY())), "
+                           "'$.history', JSON_OBJECT('status', %s, 'from', %s, 'time', UNIX_TIMESTAMP()))")
+            data.extend([new_status, old_status])
+
+        if release_lease:
+            updates.append("`order_lease`=NULL")
+
+        where = ["`order_id`=%s", "`gamespace_id`=%s", "`order_status` IN %s"]
+        data.extend([order_id, gamespace_id, sources])
+
+        if version is not None:
+            where.append("`order_version`=%s")
+            data.append(version)
+
+        if account_id is not None:
+            where.append("`account_id`=%s")
+            data.append(account_id)
+
+        if conditions:
+            for column, value in conditions.items():
+                where.append("`" + column + "`=%s")
+                data.append(value)
+
+        query = """
+            UPDATE `orders`
+            SET {0}
+            WHERE {1};
+        """.format(", ".join(updates), " AND ".join(where))
+
+        try:
+            if db is None:
+                try:
+                    shard_db = self.shards.db_for(gamespace_id)
+                except OrderShardError as e:
+                    raise OrderError(e.code, e.message)
+
+                updated = await self.__writer__(shard_db).execute(order_id, query, *data)
+            else:
+                updated = await db.execute(query, *data)
+        except DatabaseError as e:
+            raise OrderError(500, "Failed to update order: " + e.args[1])
+
+        if not updated:
+            return False
+
+        for hook in self.hooks:
+            await hook(gamespace_id, order_id, old_status, new_status, info, account_id)
+
+        return True
+
+
+class OrderWriter(object):
+    """
+    Inserts new orders. If the batch window is set, concurrent inserts are collected for that long
+    and written with a single multi-row INSERT (and a single commit), every caller gets its own order_id back.
+
+    A multi-row INSERT gets consecutive auto increment ids only with innodb_autoinc_lock_mode 0 or 1
+    and auto_increment_increment 1, so batching is turned off if the database is configured otherwise.
+    """
+
+    COLUMNS = ["gamespace_id", "store_id", "tier_id", "item_id", "account_id", "component_id",
+               "order_amount", "order_status", "order_currency", "order_total", "order_campaign_id"]
+
+    def __init__(self, app, db, window=0, max_batch=100):
+        self.app = app
+        self.db = db
+        # in seconds, 0 to insert every order right away
+        self.window = window
+        self.max_batch = max_batch
+        self.enabled = False
+        self.pending = []
+        self.flush_handle = None
+        # batches being written right now
+        self.writes = set()
+
+    async def started(self):
+        if not self.window:
+            return
+
+        try:
+            settings = await self.db.get(
+                """
+                    SELECT @@innodb_autoinc_lock_mode AS `lock_mode`,
+                        @@auto_increment_increment AS `increment`;
+                """)
+        except DatabaseError as e:
+            logging.error("Failed to check auto increment settings: {0}".format(e.args[1]))
+            return
+
+        if int(settings["lock_mode"]) not in (0, 1) or int(settings["increment"]) != 1:
+            logging.warning("Order insert batching is disabled: multi-row inserts do not get consecutive ids "
+                            "with innodb_autoinc_lock_mode={0} and auto_increment_increment={1}".format(
+                                settings["lock_mode"], settings["increment"]))
+            return
+
+        self.enabled = True
+        logging.info("Order insert batching is enabled, window: {0}ms".format(int(self.window * 1000)))
+
+    async def stopped(self):
+        self.enabled = False
+        if self.pending:
+            self.__flush__()
+        if self.writes:
+            await multi(list(self.writes))
+
+    @staticmethod
+    def __query__(count):
+        return """
+            INSERT INTO `orders`
+                ({0})
+            VALUES {1};
+        """.format(
+            ", ".join("`" + column + "`" for column in OrderWriter.COLUMNS),
+            ", ".join(["(" + ", ".join(["%s"] * len(OrderWriter.COLUMNS)) + ")"] * count))
+
+    async def insert(self, *values):
+        if not self.enabled:
+            order_id = await self.db.insert(OrderWriter.__query__(1), *values)
+            return order_id
+
+        future = Future()
+        self.pending.append((values, future))
+
+        if len(self.pending) >= self.max_batch:
+            self.__flush__()
+        elif self.flush_handle is None:
+            self.flush_handle = IOLoop.current().call_later(self.window, self.__flush__)
+
+        order_id = await future
+        return order_id
+
+    def __flush__(self):
+        if self.flush_handle is not None:
+            IOLoop.current().remove_timeout(self.flush_handle)
+            self.flush_handle = None
+
+        batch, self.pending = self.pending, []
+
+        if batch:
+            write = convert_yielded(self.__write__(batch))
+            self.writes.add(write)
+            write.add_done_callback(self.writes.discard)
+
+    async def __write__(self, batch):
+        started = time.time()
+
+        data = []
+        for values, future in batch:
+            data.extend(values)
+
+        error = None
+
+        try:
+            try:
+                first_id = await self.db.insert(OrderWriter.__query__(len(batch)), *data)
+            except DatabaseError:
+                # one bad order should not fail the others
+                for values, future in batch:
+                    try:
+                        order_id = await self.db.insert(OrderWriter.__query__(1), *values)
+                    except DatabaseError as e:
+                        future.set_exception(e)
+                    else:
+                        future.set_result(order_id)
+            else:
+                for i, (values, future) in enumerate(batch):
+                    future.set_result(first_id + i)
+
+            self.app.monitor_action("orders_insert_batch", values={
+                "size": len(batch),
+                "latency": (time.time() - started) * 1000
+            })
+        except Exception as e:
+            logging.exception("Failed to insert a batch of {0} orders".format(len(batch)))
+            error = e
+        finally:
+            # whatever has happened, none of the callers may be left waiting
+            for values, future in batch:
+                if not future.done():
+                    future.set_exception(DatabaseError(0, "Failed to insert order: {0}".format(
+                        str(error) if error is not None else "interrupted")))
+
+
 class OrdersModel(Model):
 
     # The order has been just created, but yet not filed into the system
@@ -212,13 +819,67 @@ class OrdersModel(Model):
     # The order has been finalized
     STATUS_SUCCEEDED = "SUCCEEDED"
 
-    def __init__(self, app, db, tiers, campaigns):
+    # columns added to the orders table after it was first released, created on start if missing
+    UPGRADE_COLUMNS = [
+        ("order_version", "ADD COLUMN `order_version` int(11) unsigned NOT NULL DEFAULT '0'"),
+        ("order_lease", "ADD COLUMN `order_lease` datetime DEFAULT NULL")
+    ]
+
+    TRANSACTION_ID_LENGTH = 191
+
+    # statuses update_orders looks for
+    PENDING_STATUSES = {STATUS_CREATED, STATUS_APPROVED, STATUS_RETRY}
+
+    INFO_INDEX_KEY_PATTERN = re.compile("^[a-zA-Z0-9_]{1,48}$")
+
+    # marks the account as having no pending orders, if the generation has not changed since
+    NO_PENDING_SCRIPT = """
+        local generation = redis.call('HGET', KEYS[1], 'generation') or '0'
+        if generation == ARGV[1] then
+            redis.call('HSET', KEYS[1], 'empty', ARGV[1])
+            redis.call('EXPIRE', KEYS[1], ARGV[2])
+            return 1
+        end
+        return 0
+    """
+
+    def __init__(self, app, db, tiers, campaigns, lease_time=60, history=False, info_indexes=None,
+                 cache=None, pending_marker_ttl=0, insert_batch_window=0, shards=None,
+                 report_monitoring=True, status_batch_window=0):
         self.app = app
+        # the catalog, and the orders of the gamespaces on the default shard
         self.db = db
+        self.shards = shards or OrderShards(db)
+        self.writers = {
+            name: OrderWriter(app, shard_db, window=insert_batch_window)
+            for name, shard_db in self.shards.all()
+        }
+        self.cache = cache
+        # for how long (in seconds) an account is known to have no pending orders, 0 to disable
+        self.pending_marker_ttl = pending_marker_ttl if cache is not None else 0
         self.tiers = tiers
         self.campaigns = campaigns
-
-        if app.monitoring:
+        # for how long (in seconds) an order is claimed while the payment provider is being called
+        self.lease_time = lease_time
+        # updates of orders currently in progress on this node, (gamespace, order, account) -> waiting futures
+        self.updates_in_flight = {}
+
+        self.states = OrderStateMachine(self.shards, history=history, batch_window=status_batch_window)
+        self.states.add_hook(self.__order_transitioned__)
+        self.states.add_hook(self.__order_transaction_hook__)
+        self.states.add_hook(self.__order_pending_hook__)
+
+        # order info keys to have indexed generated columns for, key -> column
+        self.info_indexes = {}
+
+        for key in (info_indexes or []):
+            if not OrdersModel.INFO_INDEX_KEY_PATTERN.match(key):
+                logging.error("Bad order info index key: {0}".format(key))
+                continue
+            self.info_indexes[key] = "order_info_" + key
+
+        # only one process of a node should report, if there are many of them
+        if app.monitoring and report_monitoring:
             logging.info("[room] Orders monitoring enabled.")
             self.monitoring_report_callback = PeriodicCallback(self.__update_monitoring_status__, 60000)
         else:
@@ -226,31 +887,119 @@ class OrdersModel(Model):
 
     async def __update_monitoring_status__(self):
 
-        successful_orders = await self.db.query("""
-            SELECT `order_currency`, SUM(`order_total`) AS `order_total`
-            FROM `orders`
-            WHERE `order_status`='SUCCEEDED' AND `orders`.`order_time` > DATE_SUB(NOW(), INTERVAL 1 MINUTE)
-            GROUP BY `order_currency`
-        """)
+        totals = {}
+
+        for name, db in self.shards.all():
+            try:
+                successful_orders = await db.query("""
+                    SELECT `order_currency`, SUM(`order_total`) AS `order_total`
+                    FROM `orders`
+                    WHERE `order_status`='SUCCEEDED' AND `orders`.`order_time` > DATE_SUB(NOW(), INTERVAL 1 MINUTE)
+                    GROUP BY `order_currency`
+                """)
+            except DatabaseError as e:
+                logging.error("Failed to count successful orders on shard '{0}': {1}".format(name, e.args[1]))
+                continue
 
-        for successful_order in successful_orders:
+            for successful_order in successful_orders:
+                currency = successful_order["order_currency"]
+                totals[currency] = totals.get(currency, 0) + successful_order["order_total"]
+
+        for currency, total in totals.items():
             self.app.monitor_action("successful_orders", values={
-                "total": successful_order["order_total"]
-            }, currency=successful_order["order_currency"])
+                "total": total
+            }, currency=currency)
+
+    @staticmethod
+    def __info_index_column__(column_name, key):
+        # binary collation, so the index compares the values exactly like JSON_EXTRACT would
+        return """
+            `{0}` varchar({2}) CHARACTER SET utf8mb4 COLLATE utf8mb4_bin GENERATED ALWAYS AS
+                (LEFT(JSON_UNQUOTE(JSON_EXTRACT(`order_info`, '$."{1}"')), {2})) VIRTUAL
+        """.format(column_name, key, OrderQuery.INFO_INDEX_LENGTH)
+
+    async def __upgrade_orders__(self, db):
+        # every node (and every worker process) upgrades the table on start, so the DDL is done under
+        # a named lock of the database server, the rest just find the table upgraded already
+        try:
+            async with db.acquire() as connection:
+                locked = await connection.get(
+                    """
+                        SELECT GET_LOCK(CONCAT(DATABASE(), '.orders_upgrade'), 60) AS `locked`;
+                    """)
+
+                if not locked or not locked["locked"]:
+                    logging.error("Failed to lock table 'orders' for upgrade, skipping it")
+                    return
+
+                try:
+                    await self.__upgrade_orders_locked__(connection)
+                finally:
+                    await connection.get(
+                        """
+                            SELECT RELEASE_LOCK(CONCAT(DATABASE(), '.orders_upgrade')) AS `released`;
+                        """)
+        except DatabaseError as e:
+            logging.error("Failed to upgrade table 'orders': {0}".format(e.args[1]))
+
+    async def __upgrade_orders_locked__(self, db):
+        columns = await db.query(
+            """
+                SHOW FULL COLUMNS FROM `orders`;
+            """)
+
+        existing = {column["Field"]: column for column in columns}
+
+        for column_name, alter in OrdersModel.UPGRADE_COLUMNS:
+            if column_name in existing:
+                continue
+
+            try:
+                await db.execute("ALTER TABLE `orders` " + alter + ";")
+            except DatabaseError as e:
+                logging.error("Failed to upgrade table 'orders': {0}".format(e.args[1]))
+            else:
+                logging.warning("Upgraded table 'orders': {0}".format(alter))
+
+        for key, column_name in self.info_indexes.items():
+            column = existing.get(column_name)
+
+            if column is None:
+                alter = "ADD COLUMN {0}, ADD KEY `{1}` (`gamespace_id`, `{1}`)".format(
+                    OrdersModel.__info_index_column__(column_name, key), column_name)
+            elif not (column.get("Collation") or "").endswith("_bin"):
+                # made case-insensitive by an earlier version
+                alter = "MODIFY COLUMN " + OrdersModel.__info_index_column__(column_name, key)
+            else:
+                continue
+
+            try:
+                await db.execute("ALTER TABLE `orders` " + alter + ";")
+            except DatabaseError as e:
+                logging.error("Failed to add order info index '{0}': {1}".format(key, e.args[1]))
+            else:
+                logging.warning("Upgraded order info index '{0}'".format(key))
 
     async def started(self, application):
         await super(OrdersModel, self).started(application)
+        for name, db in self.shards.all():
+            await self.__upgrade_orders__(db)
+        for writer in self.writers.values():
+            await writer.started()
         if self.monitoring_report_callback:
             self.monitoring_report_callback.start()
             await self.__update_monitoring_status__()
 
     async def stopped(self):
+        for writer in self.writers.values():
+            await writer.stopped()
+        await self.states.stopped()
         if self.monitoring_report_callback:
             self.monitoring_report_callback.stop()
         await super(OrdersModel, self).stopped()
 
     def get_setup_tables(self):
-        return ["orders"]
+        return ["orders", "order_transactions"]
 
     def get_setup_db(self):
         return self.db
@@ -261,20 +1010,88 @@ class OrdersModel(Model):
     async def accounts_deleted(self, gamespace, accounts, gamespace_only):
         try:
             if gamespace_only:
-                await self.db.execute(
+                await self.__orders_db__(gamespace).execute(
                     """
                         DELETE FROM `orders`
                         WHERE `gamespace_id`=%s AND `account_id` IN %s;
                     """, gamespace, accounts)
             else:
-                await self.db.execute(
-                    """
-                        DELETE FROM `orders`
-                        WHERE `account_id` IN %s;
-                    """, accounts)
+                for name, db in self.shards.all():
+                    await db.execute(
+                        """
+                            DELETE FROM `orders`
+                            WHERE `account_id` IN %s;
+                        """, accounts)
+        except OrderError as e:
+            # the gamespace could not be routed to a shard, nothing to delete there
+            logging.error("Failed to delete user orders of gamespace {0}: {1}".format(gamespace, e.message))
         except DatabaseError as e:
             raise OrderError(500, "Failed to delete user orders: " + e.args[1])
 
+    def __orders_db__(self, gamespace_id):
+        """
+        Returns the database the gamespace's orders are on
+        """
+
+        try:
+            return self.shards.db_for(gamespace_id)
+        except OrderShardError as e:
+            raise OrderError(e.code, e.message)
+
+    async def __catalog_info__(self, orders_data):
+        """
+        Looks up the store component, item and store of the orders on a shard, like a join with the catalog
+        would do on the main database. Orders which catalog entries are gone are skipped.
+        """
+
+        if not orders_data:
+            return []
+
+        # one query per catalog table, whatever the number of orders
+        components = await self.db.query(
+            """
+                SELECT *
+                FROM `store_components`
+                WHERE `component_id` IN %s;
+            """, list(set(order_data["component_id"] for order_data in orders_data)))
+
+        items = await self.db.query(
+            """
+                SELECT *
+                FROM `items`
+                WHERE `item_id` IN %s;
+            """, list(set(order_data["item_id"] for order_data in orders_data)))
+
+        stores = await self.db.query(
+            """
+                SELECT *
+                FROM `stores`
+                WHERE `store_id` IN %s;
+            """, list(set(order_data["store_id"] for order_data in orders_data)))
+
+        components = {component["component_id"]: component for component in components}
+        items = {item["item_id"]: item for item in items}
+        stores = {store["store_id"]: store for store in stores}
+
+        result = []
+
+        for order_data in orders_data:
+            component = components.get(order_data["component_id"])
+            item = items.get(order_data["item_id"])
+            store = stores.get(order_data["store_id"])
+
+            if component is None or item is None or store is None:
+                continue
+
+            # the columns the tables share are taken from the first one, like the joined query does
+            entry = dict(store)
+            entry.update(item)
+            entry.update(component)
+            entry["order_id"] = order_data["order_id"]
+            result.append(entry)
+
+        return result
+
     async def __gather_order_info__(self, gamespace_id, store, component, item, db=None):
         try:
             data = await (db or self.db).get(
@@ -301,7 +1118,7 @@ class OrdersModel(Model):
     @validate(gamespace_id="int", order_id="int")
     async def get_order(self, gamespace_id, order_id, db=None):
         try:
-            data = await (db or self.db).get(
+            data = await (db or self.__orders_db__(gamespace_id)).get(
                 """
                     SELECT *
                     FROM `orders`
@@ -318,6 +1135,25 @@ class OrdersModel(Model):
 
     @validate(gamespace_id="int", order_id="int")
     async def get_order_info(self, gamespace_id, order_id, account_id, db=None):
+        orders_db = self.__orders_db__(gamespace_id)
+
+        if orders_db is not self.db:
+            try:
+                order_data = await orders_db.get(
+                    """
+                        SELECT `order_id`, `component_id`, `item_id`, `store_id`
+                        FROM `orders`
+                        WHERE `order_id`=%s AND `gamespace_id`=%s AND `account_id`=%s;
+                    """, order_id, gamespace_id, account_id)
+                data = (await self.__catalog_info__([order_data])) if order_data else None
+            except DatabaseError as e:
+                raise OrderError(500, "Failed to gather order info: " + e.args[1])
+
+            if not data:
+                raise NoOrderError()
+
+            return StoreComponentItemTierAdapter(data[0])
+
         try:
             data = await (db or self.db).get(
                 """
@@ -340,90 +1176,173 @@ class OrdersModel(Model):
 
         return StoreComponentItemTierAdapter(data)
 
-    @validate(gamespace_id="int", order_id="int", status="str_name", info="json")
-    async def update_order_info(self, gamespace_id, order_id, status, info, db=None):
+    async def __order_transitioned__(self, gamespace_id, order_id, old_status, new_status, info, account_id):
+        self.app.monitor_rate("orders", "updated", status=new_status)
+
+    async def __order_transaction_hook__(self, gamespace_id, order_id, old_status, new_status, info, account_id):
+        if info and info.get("transaction_id"):
+            await self.__record_transaction__(gamespace_id, order_id, info["transaction_id"])
+
+    async def __order_pending_hook__(self, gamespace_id, order_id, old_status, new_status, info, account_id):
+        # the order becomes visible to update_orders right now, so the "no pending orders" mark
+        # made before it (if any) has to go
+        if not self.pending_marker_ttl:
+            return
+
+        if new_status not in OrdersModel.PENDING_STATUSES or old_status in OrdersModel.PENDING_STATUSES:
+            return
+
+        if account_id is None:
+            try:
+                order = await self.get_order(gamespace_id, order_id)
+            except (OrderError, NoOrderError):
+                logging.exception("Failed to find the account of order {0}".format(order_id))
+                return
+            account_id = order.account_id
+
+        await self.__pending_order_added__(gamespace_id, account_id)
+
+    async def __record_transaction__(self, gamespace_id, order_id, transaction_id):
+        """
+        Maps the provider's transaction id to the order. The first order to claim a transaction id keeps it.
+        """
+
+        transaction_id = str(transaction_id)
+
+        if len(transaction_id) > OrdersModel.TRANSACTION_ID_LENGTH:
+            logging.warning("Transaction id of order {0} is too long to be mapped".format(order_id))
+            return
+
         try:
-            await (db or self.db).execute(
+            await self.__orders_db__(gamespace_id).execute(
                 """
-                    UPDATE `orders`
-                    SET `order_info`=%s, `order_status`=%s
+                    INSERT IGNORE INTO `order_transactions`
+                        (`gamespace_id`, `component_id`, `transaction_id`, `order_id`)
+                    SELECT `gamespace_id`, `component_id`, %s, `order_id`
+                    FROM `orders`
                     WHERE `order_id`=%s AND `gamespace_id`=%s;
-                """, ujson.dumps(info), status, order_id, gamespace_id)
+                """, transaction_id, order_id, gamespace_id)
         except DatabaseError as e:
-            raise OrderError(500, e.args[1])
-        else:
-            self.app.monitor_rate("orders", "updated", status=status)
+            logging.error("Failed to record transaction of order {0}: {1}".format(order_id, e.args[1]))
+        except OrderError as e:
+            logging.error("Failed to record transaction of order {0}: {1}".format(order_id, e.message))
 
-    @validate(gamespace_id="int", order_id="int", status="str_name")
-    async def update_order_status(self, gamespace_id, order_id, status, db=None):
+    @validate(gamespace_id="int", component_id="int", transaction_id="str")
+    async def get_order_by_transaction(self, gamespace_id, component_id, transaction_id, db=None):
         try:
-            await (db or self.db).execute(
+            data = await (db or self.__orders_db__(gamespace_id)).get(
                 """
-                    UPDATE `orders`
-                    SET `order_status`=%s
+                    SELECT `orders`.*
+                    FROM `order_transactions`
+                        INNER JOIN `orders` ON `orders`.`order_id`=`order_transactions`.`order_id`
+                    WHERE `order_transactions`.`gamespace_id`=%s AND `order_transactions`.`component_id`=%s
+                        AND `order_transactions`.`transaction_id`=%s;
+                """, gamespace_id, component_id, transaction_id
+            )
+        except DatabaseError as e:
+            raise OrderError(500, "Failed to find order by transaction: " + e.args[1])
+
+        if not data:
+            raise NoOrderError()
+
+        return OrderAdapter(data)
+
+    @validate(gamespace_id="int", order_id="int", transaction_id="str")
+    async def claim_transaction(self, gamespace_id, order_id, transaction_id):
+        """
+        Maps the provider's transaction id to the order, unless it is mapped to another order already.
+        Returns True if the transaction belongs to this order now.
+        """
+
+        if len(transaction_id) > OrdersModel.TRANSACTION_ID_LENGTH:
+            raise OrderError(400, "Transaction id is too long")
+
+        orders_db = self.__orders_db__(gamespace_id)
+
+        try:
+            await orders_db.execute(
+                """
+                    INSERT IGNORE INTO `order_transactions`
+                        (`gamespace_id`, `component_id`, `transaction_id`, `order_id`)
+                    SELECT `gamespace_id`, `component_id`, %s, `order_id`
+                    FROM `orders`
                     WHERE `order_id`=%s AND `gamespace_id`=%s;
-                """, status, order_id, gamespace_id)
+                """, transaction_id, order_id, gamespace_id)
+
+            claimed = await orders_db.get(
+                """
+                    SELECT `order_transactions`.`order_id`
+                    FROM `orders`
+                        INNER JOIN `order_transactions`
+                            ON `order_transactions`.`gamespace_id`=`orders`.`gamespace_id`
+                            AND `order_transactions`.`component_id`=`orders`.`component_id`
+                    WHERE `orders`.`order_id`=%s AND `orders`.`gamespace_id`=%s
+                        AND `order_transactions`.`transaction_id`=%s;
+                """, order_id, gamespace_id, transaction_id)
         except DatabaseError as e:
-            raise OrderError(500, e.args[1])
-        else:
-            self.app.monitor_rate("orders", "updated", status=status)
+            raise OrderError(500, "Failed to claim transaction: " + e.args[1])
+
+        return claimed is not None and str(claimed["order_id"]) == str(order_id)
+
+    @validate(gamespace_id="int", order_id="int", status="str_name", info="json")
+    async def update_order_info(self, gamespace_id, order_id, status, info, db=None):
+        """
+        Changes the order status, and patches the order info (keys of the info are added or replaced).
+        Returns False if the order cannot be moved to that status.
+        """
+        result = await self.states.transition(gamespace_id, order_id, status, info=info, db=db)
+        return result
+
+    @validate(gamespace_id="int", order_id="int", status="str_name")
+    async def update_order_status(self, gamespace_id, order_id, status, db=None):
+        result = await self.states.transition(gamespace_id, order_id, status, db=db)
+        return result
 
     @validate(gamespace_id="int", order_id="int", old_status="str_name",
               new_status="str_name", ensure_order_total="int", ensure_item_id="int")
     async def update_order_status_reliable(self, gamespace_id, order_id, old_status,
                                      new_status, new_info=None,
                                      ensure_order_total=None, ensure_item_id=None):
+        """
+        Moves the order from old_status to new_status. Returns False if the order is not in old_status
+        (including the case it has been moved to new_status already): the web hooks that are retried by
+        the provider should tell a retry apart from a wrong state themselves.
+        """
 
-        application = self.app
-
-        try:
-            async with self.db.acquire(auto_commit=False) as db:
-
-                try:
-                    order = await db.get(
-                        """
-                            SELECT * FROM `orders`
-                            WHERE `order_status`=%s AND `order_id`=%s AND `gamespace_id`=%s
-                            FOR UPDATE;
-                        """, old_status, order_id, gamespace_id)
-
-                    if not order:
-                        return False
+        conditions = {}
 
-                    if ensure_order_total is not None:
-                        order_total = int(order["order_total"])
-                        if order_total != ensure_order_total:
-                            raise OrderError(409, "Order has wrong total.")
+        if ensure_order_total is not None:
+            conditions["order_total"] = ensure_order_total
 
-                    if ensure_item_id is not None:
-                        item_id = int(order["item_id"])
-                        if item_id != ensure_item_id:
-                            raise OrderError(409, "Order has wrong item_id.")
+        if ensure_item_id is not None:
+            conditions["item_id"] = ensure_item_id
 
-                    order_info = order["order_info"] or {}
+        updated = await self.states.transition(
+            gamespace_id, order_id, new_status, info=new_info if isinstance(new_info, dict) else None,
+            old_status=old_status, conditions=conditions)
 
-                    if isinstance(new_info, dict):
-                        order_info.update(new_info)
+        if updated or not conditions:
+            return updated
 
-                    await db.execute(
-                        """
-                            UPDATE `orders`
-                            SET `order_status`=%s, `order_info`=%s
-                            WHERE `order_id`=%s AND `gamespace_id`=%s;
-                        """, new_status, ujson.dumps(order_info), order_id, gamespace_id)
+        # find out why exactly the order was not updated
+        try:
+            order = await self.get_order(gamespace_id, order_id)
+        except NoOrderError:
+            return False
 
-                    application.monitor_rate("orders", "updated", status=new_status)
+        if order.status != old_status:
+            return False
 
-                    return True
+        if ensure_order_total is not None and int(order.total) != ensure_order_total:
+            raise OrderError(409, "Order has wrong total.")
 
-                finally:
-                    await db.commit()
+        if ensure_item_id is not None and int(order.item_id) != ensure_item_id:
+            raise OrderError(409, "Order has wrong item_id.")
 
-        except DatabaseError as e:
-            raise OrderError(500, e.args[1])
+        return False
 
     def orders_query(self, gamespace, store_id=None):
-        return OrderQuery(gamespace, self.db, store_id)
+        return OrderQuery(gamespace, self.db, store_id, info_indexes=self.info_indexes, shards=self.shards)
 
     @validate(gamespace_id="int", account_id="int", store="str_name", component="str_name", item_name="str_name",
               currency="str_name", amount="int", env="json")
@@ -435,6 +1354,15 @@ class OrdersModel(Model):
         if not StoreComponents.has_component(component_name):
             raise OrderError(404, "No such component")
 
+        try:
+            writer = self.writers[self.shards.route(gamespace_id)]
+        except OrderShardError as e:
+            raise OrderError(e.code, e.message)
+
+        # the order is processed in phases, so a database connection is never held while the payment
+        # provider is being waited for: reserve the order on a connection, release it, call the provider,
+        # then update the order status on another short-lived one
+
         async with self.db.acquire() as db:
             try:
                 data = await self.__gather_order_info__(gamespace_id, store_name, component_name, item_name, db=db)
@@ -452,7 +1380,8 @@ class OrdersModel(Model):
             component_id = data.component.component_id
 
             try:
-                campaign_entry = await self.campaigns.find_current_campaign_item(gamespace_id, store_id, item_id)
+                campaign_entry = await self.campaigns.find_current_campaign_item(
+                    gamespace_id, store_id, item_id, db=db)
             except CampaignError:
                 tier = data.tier
                 campaign_id = None
@@ -478,40 +1407,76 @@ class OrdersModel(Model):
             price = tier.prices[currency]
             total = price * amount
 
-            try:
-                order_id = await db.insert(
-                    """
-                        INSERT INTO `orders`
-                            (`gamespace_id`, `store_id`, `tier_id`, `item_id`, `account_id`,
-                             `component_id`, `order_amount`, `order_status`, `order_currency`, 
-                             `order_total`, `order_campaign_id`)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                    """, gamespace_id, store_id, tier_id, item_id, account_id, component_id,
-                    amount, OrdersModel.STATUS_NEW, currency, total, campaign_id)
-            except DatabaseError as e:
-                raise OrderError(500, "Failed to create new order: " + e.args[1])
+        try:
+            order_id = await writer.insert(
+                gamespace_id, store_id, tier_id, item_id, account_id, component_id,
+                amount, OrdersModel.STATUS_NEW, currency, total, campaign_id)
+        except DatabaseError as e:
+            raise OrderError(500, "Failed to create new order: " + e.args[1])
 
-            component_instance = StoreComponents.component(component_name, data.component.data)
+        component_instance = StoreComponents.component(component_name, data.component.data)
 
-            try:
+        try:
+            async with trace.span("provider." + component_name + ".new_order"):
                 info = await component_instance.new_order(
                     self.app, gamespace_id, account_id, order_id, currency, price,
                     amount, total, data.store, item, env, campaign_item)
 
-            except StoreComponentError as e:
-                logging.exception("Failed to process new order: " + e.message)
-                await self.update_order_status(gamespace_id, order_id, OrdersModel.STATUS_ERROR, db=db)
-                raise OrderError(e.code, e.message)
+        except StoreComponentError as e:
+            logging.exception("Failed to process new order: " + e.message)
+            await self.update_order_status(gamespace_id, order_id, OrdersModel.STATUS_ERROR)
+            raise OrderError(e.code, e.message)
 
-            result = {
-                "order_id": order_id
-            }
+        result = {
+            "order_id": order_id
+        }
 
-            if info:
-                result.update(info)
-                await self.update_order_status(gamespace_id, order_id, OrdersModel.STATUS_CREATED, db=db)
+        if info:
+            result.update(info)
+            await self.states.transition(
+                gamespace_id, order_id, OrdersModel.STATUS_CREATED,
+                old_status=OrdersModel.STATUS_NEW, account_id=account_id)
 
-            return result
+            if info.get("transaction_id"):
+                await self.__record_transaction__(gamespace_id, order_id, info["transaction_id"])
+
+        return result
+
+    async def __claim_order__(self, gamespace_id, order, account_id):
+        """
+        Claims the order for processing for lease_time seconds, so concurrent updates of the same order
+        (client, web hooks) do not process it twice, without holding a row lock during the provider call
+        """
+
+        try:
+            claimed = await self.__orders_db__(gamespace_id).execute(
+                """
+                    UPDATE `orders`
+                    SET `order_version`=`order_version`+1,
+                        `order_lease`=DATE_ADD(NOW(), INTERVAL %s SECOND)
+                    WHERE `order_id`=%s AND `gamespace_id`=%s AND `account_id`=%s AND `order_version`=%s
+                        AND (`order_lease` IS NULL OR `order_lease` < NOW());
+                """, self.lease_time, order.order_id, gamespace_id, account_id, order.version)
+        except DatabaseError as e:
+            raise OrderError(500, "Failed to claim the order: " + e.args[1])
+
+        if not claimed:
+            raise OrderError(409, "Order is being processed already")
+
+        order.version += 1
+
+    async def __release_order__(self, gamespace_id, order, account_id):
+        try:
+            await self.__orders_db__(gamespace_id).execute(
+                """
+                    UPDATE `orders`
+                    SET `order_lease`=NULL
+                    WHERE `order_id`=%s AND `gamespace_id`=%s AND `account_id`=%s AND `order_version`=%s;
+                """, order.order_id, gamespace_id, account_id, order.version)
+        except DatabaseError as e:
+            logging.error("Failed to release order {0}: {1}".format(order.order_id, e.args[1]))
+        except OrderError as e:
+            logging.error("Failed to release order {0}: {1}".format(order.order_id, e.message))
 
     async def __process_order_error__(self, gamespace_id, order, order_info, update_status, account_id, db):
         logging.warning("Processing failed order", extra={
@@ -526,22 +1491,40 @@ class OrdersModel(Model):
         component_name = order_info.component.name
         component_instance = StoreComponents.component(component_name, order_info.component.data)
 
+        await self.__claim_order__(gamespace_id, order, account_id)
+
+        # the lease is kept only if the order has moved on, whatever happens in between
+        status_moved = False
+
         try:
-            update = await component_instance.update_order(
-                self.app, gamespace_id, account_id, order, order_info)
-        except StoreComponentError as e:
-            logging.exception("Failed to update order", extra={
-                "gamespace": gamespace_id,
-                "order": order.order_id,
-                "account": account_id
-            })
+            try:
+                async with trace.span("provider." + component_name + ".update_order"):
+                    update = await component_instance.update_order(
+                        self.app, gamespace_id, account_id, order, order_info)
+            except StoreComponentError as e:
+                logging.exception("Failed to update order", extra={
+                    "gamespace": gamespace_id,
+                    "order": order.order_id,
+                    "account": account_id
+                })
 
-            if e.update_status:
-                new_status, new_info = e.update_status
-                await update_status(new_status, new_info)
+                if e.update_status:
+                    new_status, new_info = e.update_status
+                    await update_status(new_status, new_info)
+                    status_moved = True
+
+                raise OrderError(e.code, e.message)
+            except OrderError:
+                raise
+            except Exception as e:
+                logging.exception("Failed to update order", extra={
+                    "gamespace": gamespace_id,
+                    "order": order.order_id,
+                    "account": account_id
+                })
+
+                raise OrderError(500, "Failed to update order: " + str(e))
 
-            raise OrderError(e.code, e.message)
-        else:
             logging.info("Order succeeded!", extra={
                 "gamespace": gamespace_id,
                 "order": order.order_id,
@@ -553,31 +1536,36 @@ class OrdersModel(Model):
             new_status, new_info = update
 
             await update_status(new_status, new_info)
+            status_moved = True
+        finally:
+            if not status_moved:
+                # nothing has changed (or it's unknown if it has), let the order to be tried again right away
+                await self.__release_order__(gamespace_id, order, account_id)
 
-            item = order_info.item
+        item = order_info.item
 
-            if order.campaign_id:
-                try:
-                    campaign = await self.campaigns.get_campaign_item(
-                        gamespace_id, order.campaign_id, order.item_id, db)
-                except CampaignItemNotFound:
-                    pass
-                except CampaignError:
-                    pass
-                else:
-                    item.apply_campaign(campaign)
-
-            return {
-                "item": item.name,
-                "amount": order.amount,
-                "currency": order.currency,
-                "store": order_info.store.name,
-                "total": order.total,
-                "order_id": to_int(order.order_id),
-                "public": item.public_data,
-                "private": item.private_data,
-                "info": order.info
-            }
+        if order.campaign_id:
+            try:
+                campaign = await self.campaigns.get_campaign_item(
+                    gamespace_id, order.campaign_id, order.item_id, db)
+            except CampaignItemNotFound:
+                pass
+            except CampaignError:
+                pass
+            else:
+                item.apply_campaign(campaign)
+
+        return {
+            "item": item.name,
+            "amount": order.amount,
+            "currency": order.currency,
+            "store": order_info.store.name,
+            "total": order.total,
+            "order_id": to_int(order.order_id),
+            "public": item.public_data,
+            "private": item.private_data,
+            "info": order.info
+        }
 
     async def __process_order_succeeded__(self, gamespace_id, order, order_info, update_status, account_id, db):
         logging.warning("Processing already succeeded order", extra={
@@ -616,8 +1604,9 @@ class OrdersModel(Model):
             raise OrderError(400, "This store component does not allow hooks")
 
         try:
-            result = await component_instance.order_callback(self.app, gamespace_id, component.store_id,
-                                                             arguments, headers, body)
+            async with trace.span("provider." + component_name + ".order_callback"):
+                result = await component_instance.order_callback(self.app, gamespace_id, component.store_id,
+                                                                 arguments, headers, body)
         except StoreComponentError as e:
             logging.exception("Failed to process callback!")
             raise OrderError(e.code, e.message)
@@ -627,71 +1616,171 @@ class OrdersModel(Model):
     @validate(gamespace_id="int", order_id="int", account_id="int")
     async def update_order(self, gamespace_id, order_id, account_id, order_info=None):
 
-        application = self.app
+        # concurrent updates of the same order on this node (client requests, update_orders polls) join
+        # the one already in progress and share its result, instead of racing for it in the database;
+        # web hooks change the order status with update_order_status_reliable instead, and do not join
 
-        async with self.db.acquire(auto_commit=False) as db:
-            if not order_info:
-                order_info = await self.get_order_info(gamespace_id, order_id, account_id, db=db)
+        _key = (gamespace_id, order_id, account_id)
 
-            try:
-                try:
-                    order_data = await db.get(
-                        """
-                            SELECT *
-                            FROM `orders`
-                            WHERE `orders`.`order_id`=%s AND `orders`.`gamespace_id`=%s
-                                AND `orders`.`account_id`=%s
-                            FOR UPDATE;
-                        """, order_id, gamespace_id, account_id
-                    )
-                except DatabaseError as e:
-                    raise OrderError(500, "Failed to gather order info: " + e.args[1])
+        existing_futures = self.updates_in_flight.get(_key, None)
 
-                if not order_data:
-                    raise NoOrderError()
+        if existing_futures is not None:
+            future = Future()
+            existing_futures.append(future)
+            result = await future
+            return result
 
-                order = OrderAdapter(order_data)
+        new_futures = []
+        self.updates_in_flight[_key] = new_futures
 
-                async def update_status(new_status, new_info):
+        try:
+            result = await self.__finalize_order__(gamespace_id, order_id, account_id, order_info)
+        except BaseException as e:
+            if not isinstance(e, Exception):
+                # the update has been cancelled (or the process is exiting), the joined ones should not hang
+                e = OrderError(503, "Order update has been interrupted")
+            for f in new_futures:
+                if not f.done():
+                    f.set_exception(e)
+            raise
+        else:
+            for f in new_futures:
+                if not f.done():
+                    f.set_result(result)
+            return result
+        finally:
+            del self.updates_in_flight[_key]
 
-                    info = order.info or {}
-                    info.update(new_info)
-                    order.info = info
+    async def __finalize_order__(self, gamespace_id, order_id, account_id, order_info):
 
-                    await db.execute(
-                        """
-                            UPDATE `orders`
-                            SET `order_status`=%s, `order_info`=%s
-                            WHERE `orders`.`order_id`=%s AND `orders`.`gamespace_id`=%s
-                                AND `orders`.`account_id`=%s;
-                        """, new_status, ujson.dumps(info), order_id, gamespace_id, account_id)
+        if not order_info:
+            order_info = await self.get_order_info(gamespace_id, order_id, account_id)
 
-                    application.monitor_rate("orders", "updated", status=new_status)
+        try:
+            order_data = await self.__orders_db__(gamespace_id).get(
+                """
+                    SELECT *
+                    FROM `orders`
+                    WHERE `orders`.`order_id`=%s AND `orders`.`gamespace_id`=%s
+                        AND `orders`.`account_id`=%s;
+                """, order_id, gamespace_id, account_id
+            )
+        except DatabaseError as e:
+            raise OrderError(500, "Failed to gather order info: " + e.args[1])
+
+        if not order_data:
+            raise NoOrderError()
+
+        order = OrderAdapter(order_data)
+
+        async def update_status(new_status, new_info):
+
+            # commits the result only if the order is still claimed by this very update
+            updated = await self.states.transition(
+                gamespace_id, order_id, new_status, info=new_info, old_status=order.status,
+                version=order.version, account_id=account_id, release_lease=True)
+
+            if not updated:
+                raise OrderError(409, "Order has been updated concurrently")
+
+            info = order.info or {}
+            info.update(new_info)
+            order.info = info
+            order.status = new_status
+            order.version += 1
+
+            logging.info("Updated order '{0}' status to: {1}".format(order_id, new_status))
+
+        order_status = order.status
+
+        if order_status not in OrdersModel.ORDER_PROCESSORS:
+            raise OrderError(406, "Order is in bad condition")
+
+        update = await OrdersModel.ORDER_PROCESSORS[order_status](
+            self, gamespace_id, order, order_info, update_status, account_id, db=self.db)
+
+        return update
+
+    @staticmethod
+    def __pending_key__(gamespace_id, account_id):
+        return "store_pending_orders:" + str(gamespace_id) + ":" + str(account_id)
+
+    async def __pending_order_added__(self, gamespace_id, account_id):
+        """
+        Every order that becomes pending bumps the account's generation, which invalidates
+        the "no pending orders" mark. Has to be called after the order is pending in the database,
+        so a poll that has missed the order cannot mark the new generation as empty.
+        """
+
+        if not self.pending_marker_ttl:
+            return
 
-                    logging.info("Updated order '{0}' status to: {1}".format(order_id, new_status))
+        key = OrdersModel.__pending_key__(gamespace_id, account_id)
 
-                order_status = order.status
+        try:
+            async with self.cache.acquire() as db:
+                await db.hincrby(key, "generation", 1)
+                await db.expire(key, self.pending_marker_ttl)
+        except Exception as e:
+            # a cache outage should not fail the purchase; update_orders goes to the database while the cache
+            # is down, and a mark that is left stale expires in pending_marker_ttl at most
+            logging.error("Failed to register a pending order of account {0}: {1}".format(account_id, str(e)))
+
+    async def __get_pending_generation__(self, gamespace_id, account_id):
+        """
+        Returns (has_pending, generation): has_pending is False only if the account is known
+        to have no pending orders
+        """
 
-                if order_status not in OrdersModel.ORDER_PROCESSORS:
-                    raise OrderError(406, "Order is in bad condition")
+        if not self.pending_marker_ttl:
+            return True, None
 
-                update = await OrdersModel.ORDER_PROCESSORS[order_status](
-                    self, gamespace_id, order, order_info, update_status, account_id, db=db)
+        try:
+            async with self.cache.acquire() as db:
+                generation, empty = await db.hmget(
+                    OrdersModel.__pending_key__(gamespace_id, account_id), "generation", "empty")
+        except Exception as e:
+            logging.warning("Failed to check pending orders: {0}".format(str(e)))
+            return True, None
 
-                return update
+        generation = generation or b"0"
+        return empty != generation, generation
 
-            finally:
-                await db.commit()
+    async def __mark_no_pending__(self, gamespace_id, account_id, generation):
+        try:
+            async with self.cache.acquire() as db:
+                await db.eval(OrdersModel.NO_PENDING_SCRIPT,
+                              keys=[OrdersModel.__pending_key__(gamespace_id, account_id)],
+                              args=[generation, self.pending_marker_ttl])
+        except Exception as e:
+            logging.warning("Failed to mark no pending orders: {0}".format(str(e)))
 
     @validate(gamespace_id="int", account_id="int")
     async def update_orders(self, gamespace_id, account_id):
 
-        async with self.db.acquire() as db:
+        # most of the accounts have nothing pending, so do not look for it in the database every time
+        has_pending, generation = await self.__get_pending_generation__(gamespace_id, account_id)
 
-            order_statuses = [OrdersModel.STATUS_CREATED, OrdersModel.STATUS_APPROVED, OrdersModel.STATUS_RETRY]
+        if not has_pending:
+            return []
 
-            try:
-                orders_data = await db.query(
+        order_statuses = [OrdersModel.STATUS_CREATED, OrdersModel.STATUS_APPROVED, OrdersModel.STATUS_RETRY]
+
+        orders_db = self.__orders_db__(gamespace_id)
+
+        try:
+            if orders_db is not self.db:
+                orders_data = await orders_db.query(
+                    """
+                        SELECT `order_id`, `component_id`, `item_id`, `store_id`
+                        FROM `orders`
+                        WHERE `order_status` IN %s AND `gamespace_id`=%s AND `account_id`=%s
+                        ORDER BY `order_id` DESC
+                        LIMIT 10;
+                    """, order_statuses, gamespace_id, account_id)
+                orders_data = await self.__catalog_info__(orders_data)
+            else:
+                orders_data = await self.db.query(
                     """
                         SELECT `store_components`.*, `items`.*, `stores`.*, `orders`.`order_id`
                         FROM `orders`, `store_components`, `items`, `stores`
@@ -707,30 +1796,35 @@ class OrdersModel(Model):
                             LIMIT 10;
                     """, order_statuses, gamespace_id, account_id
                 )
-            except DatabaseError as e:
-                raise OrderError(500, "Failed to gather order info: " + e.args[1])
+        except DatabaseError as e:
+            raise OrderError(500, "Failed to gather order info: " + e.args[1])
 
-            orders_info = map(StoreComponentItemTierAdapter, orders_data)
+        if not orders_data:
+            if generation is not None:
+                await self.__mark_no_pending__(gamespace_id, account_id, generation)
+            return []
 
-            update = []
+        orders_info = map(StoreComponentItemTierAdapter, orders_data)
 
-            for info in orders_info:
-                order_id = info.order_id
+        update = []
 
-                if not order_id:
-                    continue
+        for info in orders_info:
+            order_id = info.order_id
 
-                try:
-                    update_result = await self.update_order(
-                        gamespace_id, order_id, account_id, order_info=info)
-                except OrderError:
-                    pass
-                except NoOrderError:
-                    pass
-                else:
-                    update.append(update_result)
+            if not order_id:
+                continue
 
-            return update
+            try:
+                update_result = await self.update_order(
+                    gamespace_id, order_id, account_id, order_info=info)
+            except OrderError:
+                pass
+            except NoOrderError:
+                pass
+            else:
+                update.append(update_result)
+
+        return update
 
     ORDER_PROCESSORS = {
         STATUS_ERROR: __process_order_error__,
@@ -740,3 +1834,6 @@ class OrdersModel(Model):
         STATUS_SUCCEEDED: __process_order_succeeded__,
         STATUS_REJECTED: __process_order_rejected__
     }
+
+
+trace.instrument(OrdersModel, "orders")
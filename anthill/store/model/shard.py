@@ -0,0 +1,429 @@
+
+from tornado.ioloop import IOLoop
+from tornado import gen
+
+from . invalidation import CatalogInvalidation
+
+from anthill.common.model import Model
+from anthill.common.database import DatabaseError
+from anthill.common.validate import validate
+
+import logging
+
+
+class OrderShardError(Exception):
+    def __init__(self, code, message):
+        self.code = code
+        self.message = message
+
+    def __str__(self):
+        return str(self.code) + ": " + self.message
+
+
+class OrderShards(Model):
+    """
+    Routes the orders of a gamespace to one of the order databases (shards).
+
+    The catalog (stores, items, tiers, campaigns etc) and the shard map itself always stay on the main
+    database, which is also the 'default' shard for every gamespace that is not mapped anywhere else.
+    Other shards only have the `orders` and `order_transactions` tables, without foreign keys
+    to the catalog, so the orders there are joined with the catalog in the application.
+
+    Every shard should have its own range of order ids (for example, ALTER TABLE `orders` AUTO_INCREMENT=...),
+    otherwise orders of a moved gamespace may collide with the ones already there, and the move is refused.
+    """
+
+    DEFAULT = "default"
+
+    STATE_ACTIVE = "active"
+    # the last changes of the gamespace's orders are being copied, its orders cannot be accessed meanwhile
+    STATE_MOVING = "moving"
+
+    # columns copied when a gamespace is moved, the generated ones are left to the target
+    COLUMNS = ["order_id", "gamespace_id", "store_id", "tier_id", "item_id", "component_id", "account_id",
+               "order_amount", "order_status", "order_time", "order_currency", "order_total", "order_info",
+               "order_campaign_id", "order_version", "order_lease"]
+
+    SHARD_TABLES = ["orders", "order_transactions"]
+
+    def __init__(self, db, shards=None, invalidation=None):
+        self.db = db
+        self.shards = {OrderShards.DEFAULT: db}
+        self.shards.update(shards or {})
+        # gamespace_id -> (shard name, state), only the gamespaces that are not on the default shard
+        self.map = {}
+        self.invalidation = invalidation or CatalogInvalidation()
+        self.invalidation.add_listener(self.__map_changed__)
+
+    @staticmethod
+    def parse_config(config):
+        """
+        Parses 'name=host[:port]/database,...' into {name: (host, port, database)}
+        """
+
+        result = {}
+
+        for entry in filter(None, (e.strip() for e in config.split(","))):
+            try:
+                name, location = entry.split("=", 1)
+                host, database = location.split("/", 1)
+            except ValueError:
+                raise OrderShardError(400, "Bad order shard: " + entry)
+
+            port = None
+
+            if ":" in host:
+                host, port = host.split(":", 1)
+                port = int(port)
+
+            name = name.strip()
+
+            if name == OrderShards.DEFAULT:
+                raise OrderShardError(400, "The default order shard is the main database")
+
+            result[name] = (host.strip(), port, database.strip())
+
+        return result
+
+    def get_setup_db(self):
+        return self.db
+
+    def get_setup_tables(self):
+        return ["order_shards"]
+
+    def is_sharded(self):
+        return len(self.shards) > 1
+
+    def all(self):
+        return list(self.shards.items())
+
+    async def __setup_shard_table__(self, name, db, table_name, application):
+        tables = await db.get(
+            """
+                SHOW TABLES LIKE %s;
+            """, table_name)
+
+        if tables and table_name in tables.values():
+            return
+
+        with (open(application.module_path("sql/shard/{0}.sql".format(table_name)))) as f:
+            sql = f.read()
+
+        try:
+            await db.execute(sql)
+        except DatabaseError as e:
+            logging.error("Failed to create table '{0}' on order shard '{1}': {2}".format(
+                table_name, name, e.args[1]))
+        else:
+            logging.warning("Created table '{0}' on order shard '{1}'".format(table_name, name))
+
+    async def started(self, application):
+        await super(OrderShards, self).started(application)
+
+        for name, db in self.shards.items():
+            if name == OrderShards.DEFAULT:
+                continue
+            for table_name in OrderShards.SHARD_TABLES:
+                await self.__setup_shard_table__(name, db, table_name, application)
+
+        await self.reload()
+
+    async def reload(self):
+        if not self.is_sharded():
+            return
+
+        try:
+            entries = await self.db.query(
+                """
+                    SELECT `gamespace_id`, `shard_name`, `shard_state`
+                    FROM `order_shards`;
+                """)
+        except DatabaseError as e:
+            logging.error("Failed to load the order shard map: {0}".format(e.args[1]))
+            return
+
+        self.map = {
+            str(entry["gamespace_id"]): (entry["shard_name"], entry["shard_state"])
+            for entry in entries
+        }
+
+        for gamespace_id, (name, state) in self.map.items():
+            if name not in self.shards:
+                logging.error("Gamespace {0} is mapped to unknown order shard '{1}'".format(gamespace_id, name))
+
+    def __map_changed__(self, gamespace_id, entity, entity_id):
+        if entity is None or entity == CatalogInvalidation.ORDER_SHARD:
+            IOLoop.current().spawn_callback(self.reload)
+
+    def route(self, gamespace_id):
+        """
+        Returns the name of the shard the gamespace's orders are on
+        """
+
+        entry = self.map.get(str(gamespace_id), None)
+
+        if entry is None:
+            return OrderShards.DEFAULT
+
+        name, state = entry
+
+        if state != OrderShards.STATE_ACTIVE:
+            raise OrderShardError(503, "Orders of this gamespace are being moved, please try again later")
+
+        if name not in self.shards:
+            raise OrderShardError(503, "Orders of this gamespace are on unknown shard")
+
+        return name
+
+    def db_for(self, gamespace_id):
+        return self.shards[self.route(gamespace_id)]
+
+    async def __set_shard__(self, gamespace_id, name, state):
+        try:
+            if name == OrderShards.DEFAULT and state == OrderShards.STATE_ACTIVE:
+                await self.db.execute(
+                    """
+                        DELETE FROM `order_shards`
+                        WHERE `gamespace_id`=%s;
+                    """, gamespace_id)
+            else:
+                await self.db.execute(
+                    """
+                        INSERT INTO `order_shards`
+                            (`gamespace_id`, `shard_name`, `shard_state`)
+                        VALUES (%s, %s, %s)
+                        ON DUPLICATE KEY UPDATE `shard_name`=VALUES(`shard_name`),
+                            `shard_state`=VALUES(`shard_state`);
+                    """, gamespace_id, name, state)
+        except DatabaseError as e:
+            raise OrderShardError(500, "Failed to update the order shard map: " + e.args[1])
+
+        await self.reload()
+        await self.invalidation.publish(gamespace_id, CatalogInvalidation.ORDER_SHARD, gamespace_id)
+
+    async def __copy_orders__(self, gamespace_id, source, target, chunk, only=None, copied=None):
+        """
+        Copies the gamespace's orders from source to target, in chunks ordered by order_id.
+        If only is set, copies only the orders with these ids.
+        Remembers the versions copied in copied (order_id -> version).
+        """
+
+        last_id = 0
+        copied = copied if copied is not None else {}
+
+        while True:
+            if only is None:
+                rows = await source.query(
+                    """
+                        SELECT {0}
+                        FROM `orders`
+                        WHERE `gamespace_id`=%s AND `order_id`>%s
+                        ORDER BY `order_id`
+                        LIMIT %s;
+                    """.format(", ".join("`" + c + "`" for c in OrderShards.COLUMNS)),
+                    gamespace_id, last_id, chunk)
+            else:
+                ids = only[:chunk]
+                only = only[chunk:]
+
+                if not ids:
+                    break
+
+                rows = await source.query(
+                    """
+                        SELECT {0}
+                        FROM `orders`
+                        WHERE `gamespace_id`=%s AND `order_id` IN %s;
+                    """.format(", ".join("`" + c + "`" for c in OrderShards.COLUMNS)),
+                    gamespace_id, ids)
+
+            if not rows:
+                if only is None:
+                    break
+                continue
+
+            order_ids = [row["order_id"] for row in rows]
+
+            collisions = await target.query(
+                """
+                    SELECT `order_id`
+                    FROM `orders`
+                    WHERE `order_id` IN %s AND `gamespace_id`!=%s
+                    LIMIT 1;
+                """, order_ids, gamespace_id)
+
+            if collisions:
+                raise OrderShardError(409, "Order {0} already exists on the target shard in another gamespace".format(
+                    collisions[0]["order_id"]))
+
+            data = []
+            for row in rows:
+                data.extend(row[c] for c in OrderShards.COLUMNS)
+
+            await target.execute(
+                """
+                    INSERT INTO `orders`
+                        ({0})
+                    VALUES {1}
+                    ON DUPLICATE KEY UPDATE {2};
+                """.format(
+                    ", ".join("`" + c + "`" for c in OrderShards.COLUMNS),
+                    ", ".join(["(" + ", ".join(["%s"] * len(OrderShards.COLUMNS)) + ")"] * len(rows)),
+                    ", ".join("`{0}`=VALUES(`{0}`)".format(c) for c in OrderShards.COLUMNS[1:])),
+                *data)
+
+            for row in rows:
+                copied[row["order_id"]] = row["order_version"]
+
+            last_id = order_ids[-1]
+
+        return copied
+
+    async def __changed_orders__(self, gamespace_id, source, chunk, copied):
+        """
+        Returns (changed, deleted): ids of the gamespace's orders that are new or have changed since they were
+        copied, and ids of the copied orders that are gone from the source since
+        """
+
+        last_id = 0
+        changed = []
+        seen = set()
+
+        while True:
+            rows = await source.query(
+                """
+                    SELECT `order_id`, `order_version`
+                    FROM `orders`
+                    WHERE `gamespace_id`=%s AND `order_id`>%s
+                    ORDER BY `order_id`
+                    LIMIT %s;
+                """, gamespace_id, last_id, chunk)
+
+            if not rows:
+                break
+
+            for row in rows:
+                seen.add(row["order_id"])
+                if copied.get(row["order_id"], None) != row["order_version"]:
+                    changed.append(row["order_id"])
+
+            last_id = rows[-1]["order_id"]
+
+        deleted = [order_id for order_id in copied if order_id not in seen]
+        return changed, deleted
+
+    @staticmethod
+    async def __copy_transactions__(gamespace_id, source, target, chunk):
+        last = (0, "")
+
+        while True:
+            rows = await source.query(
+                """
+                    SELECT `gamespace_id`, `component_id`, `transaction_id`, `order_id`
+                    FROM `order_transactions`
+                    WHERE `gamespace_id`=%s AND (`component_id`, `transaction_id`) > (%s, %s)
+                    ORDER BY `component_id`, `transaction_id`
+                    LIMIT %s;
+                """, gamespace_id, last[0], last[1], chunk)
+
+            if not rows:
+                break
+
+            data = []
+            for row in rows:
+                data.extend([row["gamespace_id"], row["component_id"], row["transaction_id"], row["order_id"]])
+
+            await target.execute(
+                """
+                    INSERT IGNORE INTO `order_transactions`
+                        (`gamespace_id`, `component_id`, `transaction_id`, `order_id`)
+                    VALUES {0};
+                """.format(", ".join(["(%s, %s, %s, %s)"] * len(rows))), *data)
+
+            last = (rows[-1]["component_id"], rows[-1]["transaction_id"])
+
+    @staticmethod
+    async def __delete_orders__(gamespace_id, db, chunk):
+        while True:
+            deleted = await db.execute(
+                """
+                    DELETE FROM `orders`
+                    WHERE `gamespace_id`=%s
+                    ORDER BY `order_id`
+                    LIMIT %s;
+                """, gamespace_id, chunk)
+
+            if not deleted:
+                break
+
+    @validate(gamespace_id="int", target="str_name", chunk="int", grace="int", keep_source="bool")
+    async def move(self, gamespace_id, target, chunk=1000, grace=15, keep_source=False):
+        """
+        Moves the gamespace's orders to the target shard, while the gamespace keeps working:
+
+        1. every order is copied to the target, while the orders keep changing on the source
+        2. the gamespace is marked as moving: its orders are refused on every node (503)
+           for grace seconds, so the calls in flight could finish
+        3. the orders that are new or have changed since the first pass are copied again,
+           along with the transaction ids
+        4. the gamespace is mapped to the target, and the orders are accessible again
+        5. the orders are deleted from the source, unless keep_source is set
+
+        Only steps 2 to 4 make the gamespace's orders unavailable, for as long as the last changes take to copy.
+        """
+
+        if target not in self.shards:
+            raise OrderShardError(404, "No such order shard: " + target)
+
+        await self.reload()
+
+        source_name = self.route(gamespace_id)
+
+        if source_name == target:
+            raise OrderShardError(409, "Orders of this gamespace are on this shard already")
+
+        source = self.shards[source_name]
+        target_db = self.shards[target]
+
+        logging.info("Moving orders of gamespace {0} from '{1}' to '{2}'".format(gamespace_id, source_name, target))
+
+        try:
+            copied = await self.__copy_orders__(gamespace_id, source, target_db, chunk)
+        except DatabaseError as e:
+            raise OrderShardError(500, "Failed to copy orders: " + e.args[1])
+
+        logging.info("Copied {0} orders, freezing the gamespace".format(len(copied)))
+
+        await self.__set_shard__(gamespace_id, source_name, OrderShards.STATE_MOVING)
+
+        try:
+            await gen.sleep(grace)
+
+            changed, deleted = await self.__changed_orders__(gamespace_id, source, chunk, copied)
+            await self.__copy_orders__(gamespace_id, source, target_db, chunk, only=changed, copied=copied)
+
+            for i in range(0, len(deleted), chunk):
+                await target_db.execute(
+                    """
+                        DELETE FROM `orders`
+                        WHERE `gamespace_id`=%s AND `order_id` IN %s;
+                    """, gamespace_id, deleted[i:i + chunk])
+            await OrderShards.__copy_transactions__(gamespace_id, source, target_db, chunk)
+
+            logging.info("Copied {0} orders changed meanwhile".format(len(changed)))
+        except (DatabaseError, OrderShardError) as e:
+            await self.__set_shard__(gamespace_id, source_name, OrderShards.STATE_ACTIVE)
+            raise OrderShardError(500, "Failed to copy the last changes: " + str(e))
+
+        await self.__set_shard__(gamespace_id, target, OrderShards.STATE_ACTIVE)
+
+        logging.info("Orders of gamespace {0} are on '{1}' now".format(gamespace_id, target))
+
+        if keep_source:
+            return
+
+        try:
+            # the transaction ids are deleted along with the orders
+            await OrderShards.__delete_orders__(gamespace_id, source, chunk)
+        except DatabaseError as e:
+            logging.error("Failed to delete moved orders from '{0}': {1}".format(source_name, e.args[1]))
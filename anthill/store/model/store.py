@@ -3,13 +3,19 @@ from tornado.gen import coroutine, Return, Future
 
 from anthill.common.database import DatabaseError
 from anthill.common.model import Model
-from anthill.common.validate import validate
+from anthill.common.validate import validate, ValidationError
+from anthill.common.access import utc_time
 
-from . item import ItemError
+from .. import trace
+
+from . item import ItemError, StoreItemAdapter
 from . campaign import CampaignError
 from . tier import CurrencyError
+from . invalidation import CatalogInvalidation
 
 import ujson
+import time
+import datetime
 
 
 class StoreAdapter(object):
@@ -32,13 +38,43 @@ class StoreComponentNotFound(Exception):
 
 
 class StoreModel(Model):
-    def __init__(self, db, items, tiers, currencies, campaigns):
+    # maximum number of per-language store projections kept in memory
+    PROJECTIONS_LIMIT = 1024
+    # the largest campaigns extra start/end time (in seconds) a client can ask for, if not configured otherwise
+    DEFAULT_CAMPAIGNS_MAX_EXTRA_TIME = 3 * 86400
+
+    def __init__(self, db, items, tiers, currencies, campaigns, projection_ttl=0, invalidation=None,
+                 campaigns_max_extra_time=0, campaigns_time_bucket=0):
         self.db = db
         self.items = items
         self.tiers = tiers
         self.currencies = currencies
         self.campaigns = campaigns
         self.rc_cache = {}
+        self.projection_ttl = projection_ttl
+        self.projections = {}
+        # (gamespace, store) -> (expires, base), the part of the store that does not depend on the request
+        self.bases = {}
+        # the largest campaigns extra start/end time a client can ask for, larger ones are rejected;
+        # every cached base holds the campaigns of that long, so it should be kept small
+        self.campaigns_max_extra_time = campaigns_max_extra_time or StoreModel.DEFAULT_CAMPAIGNS_MAX_EXTRA_TIME
+        # if set, extra start/end times are rounded up to a multiple of that, to limit the number of variants
+        self.campaigns_time_bucket = campaigns_time_bucket
+
+        self.invalidation = invalidation or CatalogInvalidation()
+        self.invalidation.add_listener(self.__catalog_changed__)
+
+    def __catalog_changed__(self, gamespace_id, entity, entity_id):
+        if gamespace_id is None:
+            self.projections.clear()
+            self.bases.clear()
+            return
+
+        for key in [key for key in self.projections if str(key[0]) == gamespace_id]:
+            del self.projections[key]
+
+        for key in [key for key in self.bases if str(key[0]) == gamespace_id]:
+            del self.bases[key]
 
     def get_setup_db(self):
         return self.db
@@ -70,6 +106,8 @@ class StoreModel(Model):
         except DatabaseError as e:
             raise StoreError("Failed to delete store: " + e.args[1])
 
+        await self.invalidation.publish(gamespace_id, CatalogInvalidation.STORE, store_id)
+
     @validate(gamespace_id="int", store_id="int", component_id="int")
     async def delete_store_component(self, gamespace_id, store_id, component_id):
         try:
@@ -81,6 +119,8 @@ class StoreModel(Model):
         except DatabaseError as e:
             raise StoreError("Failed to delete store component: " + e.args[1])
 
+        await self.invalidation.publish(gamespace_id, CatalogInvalidation.STORE_COMPONENT, store_id)
+
     @validate(gamespace_id="int", store_name="str_name")
     async def find_store(self, gamespace_id, store_name, db=None):
         try:
@@ -130,14 +170,211 @@ class StoreModel(Model):
 
         return StoreComponentAdapter(result)
 
+    @staticmethod
+    def __project_store_data__(data, language):
+        localize = StoreItemAdapter.localize_public_data
+
+        return {
+            "items": [
+                dict(item, public=localize(item["public"], language))
+                for item in data["items"]
+            ],
+            "tiers": data["tiers"],
+            "campaigns": [
+                dict(campaign, items={
+                    item_name: dict(campaign_item, public=localize(campaign_item["public"], language))
+                    for item_name, campaign_item in campaign["items"].items()
+                })
+                for campaign in data["campaigns"]
+            ]
+        }
+
+    def __store_projection__(self, key, projection, now):
+        if len(self.projections) >= StoreModel.PROJECTIONS_LIMIT:
+            self.projections = {
+                k: v
+                for k, v in self.projections.items()
+                if v[0] > now
+            }
+
+            if len(self.projections) >= StoreModel.PROJECTIONS_LIMIT:
+                self.projections.clear()
+
+        self.projections[key] = (now + self.projection_ttl, projection)
+
+    def __campaigns_extra_time__(self, extra_time):
+        extra_time = max(int(extra_time or 0), 0)
+
+        if extra_time > self.campaigns_max_extra_time:
+            raise ValidationError("Campaigns extra time cannot be larger than {0} seconds".format(
+                self.campaigns_max_extra_time))
+
+        return self.__round_extra_time__(extra_time)
+
+    def __round_extra_time__(self, extra_time):
+        if self.campaigns_time_bucket and extra_time:
+            bucket = self.campaigns_time_bucket
+            extra_time = ((extra_time + bucket - 1) // bucket) * bucket
+
+        return extra_time
+
     @validate(gamespace_id="int", store_name="str_name", campaigns_extra_start_time="int",
-              campaigns_extra_end_time="int")
+              campaigns_extra_end_time="int", language="str_name")
     async def build_store_data(self, gamespace_id, store_name,
                          campaigns_extra_start_time=0,
-                         campaigns_extra_end_time=0):
+                         campaigns_extra_end_time=0,
+                         language=None):
+        """
+        Builds the store as it is delivered to the client. If the language is specified, every
+        localized item field is resolved into that language (with EN fallback), and the resulting
+        projection is cached for projection_ttl seconds.
+
+        Campaigns are included if they are going on, or are about to start in campaigns_extra_start_time
+        seconds, or have ended no longer than campaigns_extra_end_time seconds ago. Either of them larger
+        than campaigns_max_extra_time raises ValidationError.
+        """
+
+        campaigns_extra_start_time = self.__campaigns_extra_time__(campaigns_extra_start_time)
+        campaigns_extra_end_time = self.__campaigns_extra_time__(campaigns_extra_end_time)
+
+        if language is None:
+            result = await self.__build_store_data__(
+                gamespace_id, store_name, campaigns_extra_start_time, campaigns_extra_end_time)
+            return result
+
+        _key = (gamespace_id, store_name, campaigns_extra_start_time, campaigns_extra_end_time, language)
+
+        now = time.time()
+        cached = self.projections.get(_key, None)
+
+        if cached is not None:
+            expires, projection = cached
+            if expires > now:
+                return projection
+
+        data = await self.__build_store_data__(
+            gamespace_id, store_name, campaigns_extra_start_time, campaigns_extra_end_time)
+
+        projection = StoreModel.__project_store_data__(data, language)
+
+        if self.projection_ttl > 0:
+            self.__store_projection__(_key, projection, now)
 
-        _key = "store_data:" + str(gamespace_id) + ":" + str(store_name) + ":" + \
-            str(campaigns_extra_start_time) + ":" + str(campaigns_extra_end_time)
+        return projection
+
+    async def __build_store_data__(self, gamespace_id, store_name,
+                                   campaigns_extra_start_time,
+                                   campaigns_extra_end_time):
+
+        # every variant of the store is made of the same base, only the campaigns are filtered
+        # in memory for the requested time window
+
+        base = await self.__get_store_base__(gamespace_id, store_name)
+
+        now = datetime.datetime.utcfromtimestamp(utc_time())
+        window_start = now - datetime.timedelta(seconds=campaigns_extra_end_time)
+        window_end = now + datetime.timedelta(seconds=campaigns_extra_start_time)
+
+        pricing = base["pricing"]
+        tier_names = set(base["tiers"])
+        campaigns = {}
+
+        for entry in base["campaign_items"]:
+            # same as (now BETWEEN start - extra_start AND end + extra_end)
+            if entry.campaign.time_start > window_end or entry.campaign.time_end < window_start:
+                continue
+
+            campaign_id = str(entry.campaign.campaign_id)
+            campaign = campaigns.get(campaign_id, None)
+
+            # this generates a list of campaigns, including campaign items
+            if campaign is None:
+                campaign_items = {}
+                campaign = {
+                    "payload": entry.campaign.data,
+                    "time": {
+                        "start": str(entry.campaign.time_start),
+                        "end": str(entry.campaign.time_end)
+                    },
+                    "items": campaign_items
+                }
+                campaigns[campaign_id] = campaign
+            else:
+                campaign_items = campaign["items"]
+
+            campaign_items[entry.item_name] = {
+                "tier": entry.tier.name,
+                "public": entry.campaign_item.public_data
+            }
+
+            # since tiers are not requested separately, they are delivered together with campaign items themselves
+            tier_names.add(entry.tier.name)
+
+        tiers = {
+            tier_name: pricing[tier_name]
+            for tier_name in tier_names
+        }
+
+        return {
+            "items": base["items"],
+            "tiers": tiers,
+            "campaigns": campaigns.values()
+        }
+
+    @staticmethod
+    def __tier_pricing__(tier, currencies):
+        """
+        The tier as it is delivered to the client, with the currency details merged into its prices
+        """
+
+        def process_currency(currency_name, price):
+
+            currency = currencies.get(currency_name)
+
+            if not currency:
+                return {
+                    "price": price
+                }
+
+            return {
+                "title": currency.title,
+                "price": price,
+                "format": currency.format,
+                "symbol": currency.symbol,
+                "label": currency.label,
+            }
+
+        return {
+            "product": tier.product,
+            "prices": {
+                currency: process_currency(currency, price)
+                for currency, price in tier.prices.items()
+            }
+        }
+
+    async def __get_store_base__(self, gamespace_id, store_name):
+        now = time.time()
+
+        _key = (gamespace_id, store_name)
+        cached = self.bases.get(_key, None)
+
+        if cached is not None:
+            expires, base = cached
+            if expires > now:
+                return base
+
+        base = await self.__build_store_base__(gamespace_id, store_name)
+
+        if self.projection_ttl > 0:
+            if len(self.bases) >= StoreModel.PROJECTIONS_LIMIT:
+                self.bases.clear()
+            self.bases[_key] = (now + self.projection_ttl, base)
+
+        return base
+
+    async def __build_store_base__(self, gamespace_id, store_name):
+
+        _key = "store_data:" + str(gamespace_id) + ":" + str(store_name)
 
         existing_futures = self.rc_cache.get(_key, None)
 
@@ -159,7 +396,11 @@ class StoreModel(Model):
         async with self.db.acquire() as db:
 
             # look up the store itself
-            store = await self.find_store(gamespace_id, store_name, db=db)
+            try:
+                store = await self.find_store(gamespace_id, store_name, db=db)
+            except (StoreNotFound, StoreError) as e:
+                raise_(e)
+                return
 
             # gather the list of all currencies
             try:
@@ -184,7 +425,6 @@ class StoreModel(Model):
             # outgoing items
             items = []
             tier_items = {}
-            campaigns = {}
 
             # process the items fist
             for entry in enabled_items_raw:
@@ -203,77 +443,33 @@ class StoreModel(Model):
                 if entry.tier.name not in tier_items:
                     tier_items[entry.tier.name] = entry.tier
 
-            # process a list of items that are being under campaigns
+            # a superset of campaigns any client can ask for, for as long as the base is cached
+            superset_time = self.__round_extra_time__(self.campaigns_max_extra_time) + max(self.projection_ttl, 0)
+
             try:
                 campaign_items_raw = await self.campaigns.list_store_campaign_items(
-                    gamespace_id, store.store_id,
-                    campaigns_extra_start_time,
-                    campaigns_extra_end_time)
+                    gamespace_id, store.store_id, superset_time, superset_time, db=db)
             except CampaignError as e:
                 raise_(StoreError(e.message))
                 return
 
-            for entry in campaign_items_raw:
-                campaign_id = str(entry.campaign.campaign_id)
-                campaign = campaigns.get(campaign_id, None)
-
-                # this generates a list of campaigns, including campaign items
-                if campaign is None:
-                    campaign_items = {}
-                    campaign = {
-                        "payload": entry.campaign.data,
-                        "time": {
-                            "start": str(entry.campaign.time_start),
-                            "end": str(entry.campaign.time_end)
-                        },
-                        "items": campaign_items
-                    }
-                    campaigns[campaign_id] = campaign
-                else:
-                    campaign_items = campaign["items"]
-
-                campaign_items[entry.item_name] = {
-                    "tier": entry.tier.name,
-                    "public": entry.campaign_item.public_data
-                }
-
-                # since tiers are not requested separately, they are delivered together with campaign items themselves
-                # so they are extracted here
-                if entry.tier.name not in tier_items:
-                    tier_items[entry.tier.name] = entry.tier
-
-            # converts raw currency object into a JSON object
-            def process_currency(currency_name, price):
-
-                currency = currencies.get(currency_name)
-
-                if not currency:
-                    return {
-                        "price": price
-                    }
-
-                return {
-                    "title": currency.title,
-                    "price": price,
-                    "format": currency.format,
-                    "symbol": currency.symbol,
-                    "label": currency.label,
-                }
-
-            tiers = {
-                tier_name: {
-                    "product": tier.product,
-                    "prices": {
-                        currency: process_currency(currency, price)
-                        for currency, price in tier.prices.items()
-                    }
-                } for tier_name, tier in tier_items.items()
+            # the pricing is the same for every request, so it is made once along with the base,
+            # store tiers take precedence over campaign tiers of the same name
+            pricing = {
+                tier_name: StoreModel.__tier_pricing__(tier, currencies)
+                for tier_name, tier in tier_items.items()
             }
 
+            for entry in campaign_items_raw:
+                if entry.tier.name not in pricing:
+                    pricing[entry.tier.name] = StoreModel.__tier_pricing__(entry.tier, currencies)
+
             result = {
                 "items": items,
-                "tiers": tiers,
-                "campaigns": campaigns.values()
+                "tiers": tier_items,
+                "currencies": currencies,
+                "campaign_items": campaign_items_raw,
+                "pricing": pricing
             }
 
             for f in new_futures:
@@ -356,6 +552,8 @@ class StoreModel(Model):
         except DatabaseError as e:
             raise StoreError("Failed to add new store: " + e.args[1])
 
+        await self.invalidation.publish(gamespace_id, CatalogInvalidation.STORE, store_id)
+
         return store_id
 
     @validate(gamespace_id="int", store_id="int", component_name="str_name", component_data="json_dict")
@@ -377,6 +575,8 @@ class StoreModel(Model):
         except DatabaseError as e:
             raise StoreError("Failed to add new store component: " + e.args[1])
 
+        await self.invalidation.publish(gamespace_id, CatalogInvalidation.STORE_COMPONENT, store_id)
+
         return component_id
 
     @validate(gamespace_id="int", store_id="int", store_name="str", store_campaign_scheme="json_dict")
@@ -390,6 +590,8 @@ class StoreModel(Model):
         except DatabaseError as e:
             raise StoreError("Failed to update store: " + e.args[1])
 
+        await self.invalidation.publish(gamespace_id, CatalogInvalidation.STORE, store_id)
+
     @validate(gamespace_id="int", store_id="int", component_id="int", component_data="json_dict")
     async def update_store_component(self, gamespace_id, store_id, component_id, component_data):
 
@@ -407,6 +609,8 @@ class StoreModel(Model):
         except DatabaseError as e:
             raise StoreError("Failed to update store component: " + e.args[1])
 
+        await self.invalidation.publish(gamespace_id, CatalogInvalidation.STORE_COMPONENT, store_id)
+
 
 class StoreError(Exception):
     pass
@@ -414,3 +618,6 @@ class StoreError(Exception):
 
 class StoreNotFound(Exception):
     pass
+
+
+trace.instrument(StoreModel, "stores")
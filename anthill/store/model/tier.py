@@ -1,8 +1,11 @@
 
+from . invalidation import CatalogInvalidation
+
 from anthill.common.database import DatabaseError, DuplicateError
 from anthill.common.model import Model
 from anthill.common.validate import validate
 
+import logging
 import ujson
 
 
@@ -25,8 +28,9 @@ class CurrencyError(Exception):
 
 
 class CurrencyModel(Model):
-    def __init__(self, db):
+    def __init__(self, db, invalidation=None):
         self.db = db
+        self.invalidation = invalidation or CatalogInvalidation()
 
     def get_setup_db(self):
         return self.db
@@ -44,6 +48,8 @@ class CurrencyModel(Model):
         except DatabaseError as e:
             raise CurrencyError("Failed to delete currency: " + e.args[1])
 
+        await self.invalidation.publish(gamespace_id, CatalogInvalidation.CURRENCY, currency_id)
+
     async def find_currency(self, gamespace_id, currency_name):
         try:
             result = await self.db.get("""
@@ -106,6 +112,8 @@ class CurrencyModel(Model):
         except DatabaseError as e:
             raise CurrencyError("Failed to add new currency: " + e.args[1])
 
+        await self.invalidation.publish(gamespace_id, CatalogInvalidation.CURRENCY, result)
+
         return result
 
     async def update_currency(self, gamespace_id, currency_id, currency_name, currency_title, currency_format,
@@ -121,6 +129,8 @@ class CurrencyModel(Model):
         except DatabaseError as e:
             raise CurrencyError("Failed to update currency: " + e.args[1])
 
+        await self.invalidation.publish(gamespace_id, CatalogInvalidation.CURRENCY, currency_id)
+
 
 class CurrencyNotFound(Exception):
     pass
@@ -148,14 +158,126 @@ class TierComponentNotFound(Exception):
 
 
 class TierModel(Model):
-    def __init__(self, db):
+    # longer product ids are not indexed
+    PRODUCT_LENGTH = 191
+
+    def __init__(self, db, invalidation=None):
         self.db = db
+        self.invalidation = invalidation or CatalogInvalidation()
 
     def get_setup_db(self):
         return self.db
 
     def get_setup_tables(self):
-        return ["tiers", "tier_components"]
+        return ["tiers", "tier_components", "tier_products"]
+
+    async def started(self, application):
+        await super(TierModel, self).started(application)
+        await self.__upgrade_tier_products__()
+
+    async def __upgrade_tier_products__(self):
+        # the table was created with a signed gamespace_id at first
+        try:
+            column = await self.db.get(
+                """
+                    SHOW COLUMNS FROM `tier_products` WHERE `Field`='gamespace_id';
+                """)
+
+            if column is None or "unsigned" in column["Type"]:
+                return
+
+            await self.db.execute(
+                """
+                    ALTER TABLE `tier_products` MODIFY COLUMN `gamespace_id` int(11) unsigned NOT NULL;
+                """)
+        except DatabaseError as e:
+            logging.error("Failed to upgrade table 'tier_products': {0}".format(e.args[1]))
+        else:
+            logging.warning("Upgraded table 'tier_products'")
+
+    async def setup_table_tier_products(self):
+        # index the products of the tiers that existed before
+        await self.db.execute(
+            """
+                INSERT IGNORE INTO `tier_products`
+                    (`gamespace_id`, `store_id`, `component`, `product`, `tier_id`)
+                SELECT `gamespace_id`, `store_id`, '', `tier_product`, `tier_id`
+                FROM `tiers`
+                WHERE `tier_product`!='' AND CHAR_LENGTH(`tier_product`)<=%s;
+            """, TierModel.PRODUCT_LENGTH)
+
+        await self.db.execute(
+            """
+                INSERT IGNORE INTO `tier_products`
+                    (`gamespace_id`, `store_id`, `component`, `product`, `tier_id`)
+                SELECT `tiers`.`gamespace_id`, `tiers`.`store_id`, `tier_components`.`component`,
+                    JSON_UNQUOTE(JSON_EXTRACT(`tier_components`.`component_data`, '$.product')), `tiers`.`tier_id`
+                FROM `tier_components`
+                    INNER JOIN `tiers` ON `tiers`.`tier_id`=`tier_components`.`tier_id`
+                WHERE JSON_TYPE(JSON_EXTRACT(`tier_components`.`component_data`, '$.product'))='STRING'
+                    AND CHAR_LENGTH(JSON_UNQUOTE(JSON_EXTRACT(`tier_components`.`component_data`, '$.product')))
+                        BETWEEN 1 AND %s;
+            """, TierModel.PRODUCT_LENGTH)
+
+    async def __index_product__(self, db, gamespace_id, tier_id, component, product):
+        """
+        Maps the product id to the tier, for the component ('' stands for the tier's own product,
+        that is used by every component that has no product of its own).
+        Should be called on the connection of the transaction that writes the tier (or the component).
+        """
+
+        if product is not None and not isinstance(product, str):
+            product = None
+
+        if product and len(product) > TierModel.PRODUCT_LENGTH:
+            logging.warning("Product of tier {0} is too long to be indexed".format(tier_id))
+            product = None
+
+        try:
+            await db.execute("""
+                DELETE FROM `tier_products`
+                WHERE `tier_id`=%s AND `gamespace_id`=%s AND `component`=%s;
+            """, tier_id, gamespace_id, component)
+
+            if product:
+                await db.execute("""
+                    INSERT IGNORE INTO `tier_products`
+                        (`gamespace_id`, `store_id`, `component`, `product`, `tier_id`)
+                    SELECT `gamespace_id`, `store_id`, %s, %s, `tier_id`
+                    FROM `tiers`
+                    WHERE `tier_id`=%s AND `gamespace_id`=%s;
+                """, component, product, tier_id, gamespace_id)
+        except DatabaseError as e:
+            raise TierError("Failed to index tier product: " + e.args[1])
+
+    @validate(gamespace_id="int", store_id="int", component="str_name", product="str")
+    async def find_tier_by_product(self, gamespace_id, store_id, component, product, db=None):
+        """
+        Finds the tier that is sold as the product by the store component (like the App Store receipts
+        refer to what has been purchased)
+        """
+
+        try:
+            result = await (db or self.db).get("""
+                SELECT `tiers`.*
+                FROM `tier_products`
+                    INNER JOIN `tiers` ON `tiers`.`tier_id`=`tier_products`.`tier_id`
+                WHERE `tier_products`.`gamespace_id`=%s AND `tier_products`.`store_id`=%s
+                    AND `tier_products`.`component` IN (%s, '') AND `tier_products`.`product`=%s
+                    AND NOT (`tier_products`.`component`='' AND EXISTS (
+                        SELECT 1
+                        FROM `tier_products` AS `own`
+                        WHERE `own`.`tier_id`=`tier_products`.`tier_id` AND `own`.`component`=%s))
+                ORDER BY `tier_products`.`component` DESC, `tier_products`.`tier_id`
+                LIMIT 1;
+            """, gamespace_id, store_id, component, product, component)
+        except DatabaseError as e:
+            raise TierError("Failed to find tier by product: " + e.args[1])
+
+        if result is None:
+            raise TierNotFound()
+
+        return TierAdapter(result)
 
     async def delete_tier(self, gamespace_id, tier_id):
         try:
@@ -167,16 +289,37 @@ class TierModel(Model):
         except DatabaseError as e:
             raise TierError("Failed to delete tier: " + e.args[1])
 
+        await self.invalidation.publish(gamespace_id, CatalogInvalidation.TIER, tier_id)
+
     async def delete_tier_component(self, gamespace_id, tier_id, component_id):
         try:
-            await self.db.execute("""
-                DELETE
-                FROM `tier_components`
-                WHERE `tier_id`=%s AND `gamespace_id`=%s AND `component_id`=%s;
-            """, tier_id, gamespace_id, component_id)
+            async with self.db.acquire(auto_commit=False) as db:
+                try:
+                    # the product of the component goes away along with it
+                    await db.execute("""
+                        DELETE FROM `tier_products`
+                        WHERE `tier_id`=%s AND `gamespace_id`=%s AND `component`=(
+                            SELECT `component`
+                            FROM `tier_components`
+                            WHERE `tier_id`=%s AND `gamespace_id`=%s AND `component_id`=%s);
+                    """, tier_id, gamespace_id, tier_id, gamespace_id, component_id)
+
+                    deleted = await db.execute("""
+                        DELETE
+                        FROM `tier_components`
+                        WHERE `tier_id`=%s AND `gamespace_id`=%s AND `component_id`=%s;
+                    """, tier_id, gamespace_id, component_id)
+
+                    await db.commit()
+                except Exception:
+                    await db.rollback()
+                    raise
         except DatabaseError as e:
             raise TierError("Failed to delete tier component: " + e.args[1])
 
+        if deleted:
+            await self.invalidation.publish(gamespace_id, CatalogInvalidation.TIER_COMPONENT, tier_id)
+
     async def find_tier(self, gamespace_id, store_id, tier_name):
         try:
             result = await self.db.get("""
@@ -266,16 +409,26 @@ class TierModel(Model):
     async def new_tier(self, gamespace_id, store_id, tier_name, tier_title, tier_product, tier_prices):
 
         try:
-            tier_id = await self.db.insert("""
-                INSERT INTO `tiers`
-                (`gamespace_id`, `store_id`, `tier_name`, `tier_title`, `tier_product`, `tier_prices`)
-                VALUES (%s, %s, %s, %s, %s, %s);
-            """, gamespace_id, store_id, tier_name, tier_title, tier_product, ujson.dumps(tier_prices))
+            async with self.db.acquire(auto_commit=False) as db:
+                try:
+                    tier_id = await db.insert("""
+                        INSERT INTO `tiers`
+                        (`gamespace_id`, `store_id`, `tier_name`, `tier_title`, `tier_product`, `tier_prices`)
+                        VALUES (%s, %s, %s, %s, %s, %s);
+                    """, gamespace_id, store_id, tier_name, tier_title, tier_product, ujson.dumps(tier_prices))
+
+                    await self.__index_product__(db, gamespace_id, tier_id, "", tier_product)
+                    await db.commit()
+                except Exception:
+                    await db.rollback()
+                    raise
         except DuplicateError:
             raise TierError("Tier with such name already exits in this store")
         except DatabaseError as e:
             raise TierError("Failed to add new tier: " + e.args[1])
 
+        await self.invalidation.publish(gamespace_id, CatalogInvalidation.TIER, tier_id)
+
         return tier_id
 
     async def new_tier_component(self, gamespace_id, tier_id, component_name, component_data):
@@ -290,14 +443,25 @@ class TierModel(Model):
             raise TierError("Tier component '{0}' already exists.".format(component_name))
 
         try:
-            component_id = await self.db.insert("""
-                INSERT INTO `tier_components`
-                (`gamespace_id`, `tier_id`, `component`, `component_data`)
-                VALUES (%s, %s, %s, %s);
-            """, gamespace_id, tier_id, component_name, ujson.dumps(component_data))
+            async with self.db.acquire(auto_commit=False) as db:
+                try:
+                    component_id = await db.insert("""
+                        INSERT INTO `tier_components`
+                        (`gamespace_id`, `tier_id`, `component`, `component_data`)
+                        VALUES (%s, %s, %s, %s);
+                    """, gamespace_id, tier_id, component_name, ujson.dumps(component_data))
+
+                    await self.__index_product__(
+                        db, gamespace_id, tier_id, component_name, component_data.get("product"))
+                    await db.commit()
+                except Exception:
+                    await db.rollback()
+                    raise
         except DatabaseError as e:
             raise TierError("Failed to add new tier component: " + e.args[1])
 
+        await self.invalidation.publish(gamespace_id, CatalogInvalidation.TIER_COMPONENT, tier_id)
+
         return component_id
 
     @validate(gamespace_id="int", tier_id="int", tier_name="str_name", tier_title="str", tier_product="str",
@@ -305,34 +469,55 @@ class TierModel(Model):
     async def update_tier(self, gamespace_id, tier_id, tier_name, tier_title, tier_product, tier_prices):
 
         try:
-            await self.db.execute("""
-                UPDATE `tiers`
-                SET `tier_name`=%s, `tier_title`=%s, `tier_product`=%s, `tier_prices`=%s
-                WHERE `tier_id`=%s AND `gamespace_id`=%s;
-            """, tier_name, tier_title, tier_product, ujson.dumps(tier_prices), tier_id, gamespace_id)
+            async with self.db.acquire(auto_commit=False) as db:
+                try:
+                    await db.execute("""
+                        UPDATE `tiers`
+                        SET `tier_name`=%s, `tier_title`=%s, `tier_product`=%s, `tier_prices`=%s
+                        WHERE `tier_id`=%s AND `gamespace_id`=%s;
+                    """, tier_name, tier_title, tier_product, ujson.dumps(tier_prices), tier_id, gamespace_id)
+
+                    await self.__index_product__(db, gamespace_id, tier_id, "", tier_product)
+                    await db.commit()
+                except Exception:
+                    await db.rollback()
+                    raise
         except DuplicateError:
             raise TierError("A tier with this name already exists in this store")
         except DatabaseError as e:
             raise TierError("Failed to update tier: " + e.args[1])
 
+        await self.invalidation.publish(gamespace_id, CatalogInvalidation.TIER, tier_id)
+
     async def update_tier_component(self, gamespace_id, tier_id, component_id, component_data):
         if not isinstance(component_data, dict):
             raise TierError("Component data should be a dict")
 
         try:
-            await self.get_tier_component(gamespace_id, tier_id, component_id)
+            component = await self.get_tier_component(gamespace_id, tier_id, component_id)
         except TierComponentNotFound:
             raise TierError("Tier component not exists.")
 
         try:
-            await self.db.execute("""
-                UPDATE `tier_components`
-                SET `component_data`=%s
-                WHERE `tier_id`=%s AND `gamespace_id`=%s AND `component_id`=%s;
-            """, ujson.dumps(component_data), tier_id, gamespace_id, component_id)
+            async with self.db.acquire(auto_commit=False) as db:
+                try:
+                    await db.execute("""
+                        UPDATE `tier_components`
+                        SET `component_data`=%s
+                        WHERE `tier_id`=%s AND `gamespace_id`=%s AND `component_id`=%s;
+                    """, ujson.dumps(component_data), tier_id, gamespace_id, component_id)
+
+                    await self.__index_product__(
+                        db, gamespace_id, tier_id, component.name, component_data.get("product"))
+                    await db.commit()
+                except Exception:
+                    await db.rollback()
+                    raise
         except DatabaseError as e:
             raise TierError("Failed to update tier component: " + e.args[1])
 
+        await self.invalidation.publish(gamespace_id, CatalogInvalidation.TIER_COMPONENT, tier_id)
+
 
 class TierError(Exception):
     def __init__(self, message):
@@ -0,0 +1,93 @@
+"""
+Moves the orders of a gamespace to another order shard, while the gamespace keeps working.
+Takes the same database, cache and --order_shards options as the store service:
+
+    python -m anthill.store.move_orders --order_shards=big=db2/store_orders \\
+        --move_gamespace=1 --move_target=big
+
+The store service has to be running with the same --order_shards, so the tables exist on the target
+and every node can route to it. Use --move_target=default to move the orders back to the main database.
+See OrderShards.move for how the move is done.
+"""
+
+from anthill.common.options import options, define
+from anthill.common import server, database, keyvalue
+
+from tornado.ioloop import IOLoop
+
+from . import options as _opts
+from . server import StoreServer
+from . model.invalidation import CatalogInvalidation
+from . model.shard import OrderShards, OrderShardError
+from . import trace
+
+import logging
+
+
+define("move_gamespace",
+       default=0,
+       help="Gamespace to move the orders of",
+       group="move_orders",
+       type=int)
+
+define("move_target",
+       default="",
+       help="Name of the order shard to move the orders to",
+       group="move_orders",
+       type=str)
+
+define("move_chunk",
+       default=1000,
+       help="Number of orders copied at once",
+       group="move_orders",
+       type=int)
+
+define("move_grace",
+       default=15,
+       help="For how long (in seconds) to wait for the calls in flight before the last changes are copied",
+       group="move_orders",
+       type=int)
+
+define("move_keep_source",
+       default=False,
+       help="Do not delete the orders from the source shard once moved",
+       group="move_orders",
+       type=bool)
+
+
+async def move():
+    db = trace.TracedDatabase(database.Database(
+        host=options.db_host,
+        database=options.db_name,
+        user=options.db_username,
+        password=options.db_password))
+
+    cache = keyvalue.KeyValueStorage(
+        host=options.cache_host,
+        port=options.cache_port,
+        db=options.cache_db,
+        max_connections=options.cache_max_connections)
+
+    # the other nodes learn about the map changes over the cache's pub/sub channel
+    shards = OrderShards(db, StoreServer.connect_order_shards(options.order_shards),
+                         invalidation=CatalogInvalidation(cache))
+
+    await shards.move(options.move_gamespace, options.move_target, chunk=options.move_chunk,
+                      grace=options.move_grace, keep_source=options.move_keep_source)
+
+
+def main():
+    server.init()
+
+    if not options.move_gamespace or not options.move_target:
+        raise SystemExit("Both --move_gamespace and --move_target are required")
+
+    try:
+        IOLoop.current().run_sync(move)
+    except OrderShardError as e:
+        logging.error("Failed to move orders: {0}".format(e.message))
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -18,6 +18,12 @@ define("name",
        help="Service short name. User to discover by discovery service.",
        type=str)
 
+define("workers",
+       default=1,
+       help="Number of worker processes sharing the listening socket, 0 for one per CPU core. "
+            "The database and cache connections are split between them.",
+       type=int)
+
 # MySQL database
 
 define("db_host",
@@ -40,6 +46,11 @@ define("db_name",
        type=str,
        help="MySQL database name")
 
+define("db_max_connections",
+       default=0,
+       type=int,
+       help="Maximum connections to each MySQL database, shared between the workers. 0 for 256 per worker.")
+
 # Regular cache
 
 define("cache_host",
@@ -62,6 +73,163 @@ define("cache_db",
 
 define("cache_max_connections",
        default=500,
-       help="Maximum connections to the regular cache (connection pool).",
+       help="Maximum connections to the regular cache (connection pool), shared between the workers.",
        group="cache",
-       type=int)
\ No newline at end of file
+       type=int)
+
+# Store
+
+define("store_projection_cache_ttl",
+       default=10,
+       help="For how long (in seconds) a built store, and its per-language projections, are cached. "
+            "Catalog changes drop them right away. 0 to disable.",
+       group="store",
+       type=int)
+
+define("slow_query_threshold",
+       default=250,
+       help="Database queries slower than this (in milliseconds) are logged as slow. 0 to disable.",
+       group="store",
+       type=int)
+
+define("trace_header",
+       default=False,
+       help="Add X-Store-Trace header with the request timing spans to the client API responses (debug only).",
+       group="store",
+       type=bool)
+
+define("provider_endpoints",
+       default="",
+       help="Comma-separated list of component=url pairs to send payment provider API calls to, instead of the "
+            "real ones (for example, steam=http://localhost:9600/steam,xsolla=http://localhost:9600). "
+            "Used for testing only, see anthill.store.fake_providers.",
+       group="store",
+       type=str)
+
+define("provider_timeout",
+       default=10,
+       help="A deadline (in seconds) for a single payment provider API call.",
+       group="store",
+       type=int)
+
+define("provider_max_inflight",
+       default=256,
+       help="Maximum number of concurrent API calls to a single payment provider. The actual limit adapts "
+            "between provider_min_inflight and this value, and shrinks when the provider fails or times out.",
+       group="store",
+       type=int)
+
+define("provider_min_inflight",
+       default=4,
+       help="A floor for the adaptive concurrent API calls limit of a single payment provider.",
+       group="store",
+       type=int)
+
+define("provider_breaker_failures",
+       default=10,
+       help="Consecutive payment provider failures (5xx, timeouts, connection errors) to open the circuit breaker "
+            "after. While open, calls to that provider fail right away.",
+       group="store",
+       type=int)
+
+define("provider_breaker_reset",
+       default=30,
+       help="For how long (in seconds) the payment provider circuit breaker stays open until a probe call "
+            "is let through.",
+       group="store",
+       type=int)
+
+define("order_lease_time",
+       default=60,
+       help="For how long (in seconds) an order is claimed by an update while the payment provider is being "
+            "called. Should be longer than provider_timeout.",
+       group="store",
+       type=int)
+
+define("order_history",
+       default=False,
+       help="Append every order status change to the \"history\" list of the order info.",
+       group="store",
+       type=bool)
+
+define("order_info_indexes",
+       default="transaction_id",
+       help="Comma-separated list of order info keys to maintain indexed generated columns for. Order queries "
+            "filtering by these keys (like the internal list_orders with info) use the index instead of "
+            "scanning all orders of a gamespace.",
+       group="store",
+       type=str)
+
+define("pending_orders_marker_ttl",
+       default=3600,
+       help="For how long (in seconds) an account with no pending orders is remembered as such in the cache, "
+            "so polling for order updates does not hit the database. 0 to disable.",
+       group="store",
+       type=int)
+
+define("store_campaigns_max_extra_time",
+       default=259200,
+       help="The largest extra_start_time / extra_end_time (in seconds) a client can ask the store campaigns for, "
+            "larger values are rejected with 400. Every cached store holds the campaigns of that long before and "
+            "after now, so keep it small.",
+       group="store",
+       type=int)
+
+define("store_campaigns_time_bucket",
+       default=0,
+       help="Round extra_start_time / extra_end_time up to a multiple of this (in seconds), so clients asking "
+            "for slightly different times share the same cached store. 0 to keep them as they are.",
+       group="store",
+       type=int)
+
+define("order_insert_batch_window",
+       default=0,
+       help="Collect concurrent new orders for this long (in milliseconds) and insert them with a single "
+            "multi-row INSERT. 0 to insert every order right away.",
+       group="store",
+       type=int)
+
+define("order_status_batch_window",
+       default=0,
+       help="Collect concurrent order status changes for this long (in milliseconds) and commit them "
+            "in a single transaction. 0 to commit every change right away.",
+       group="store",
+       type=int)
+
+define("order_shards",
+       default="",
+       help="Additional databases for orders, as 'name=host[:port]/database,...'. Gamespaces are moved "
+            "onto them with 'python -m anthill.store.move_orders', the rest stay on the main database.",
+       group="store",
+       type=str)
+
+define("store_encode_threads",
+       default=2,
+       help="Threads to encode large stores in, 0 to encode them on the IOLoop.",
+       group="store",
+       type=int)
+
+define("store_encode_offload_threshold",
+       default=500,
+       help="Stores of at least that many items, tiers and campaign items in total are encoded in a thread.",
+       group="store",
+       type=int)
+
+define("store_gzip_min_size",
+       default=0,
+       help="Gzip the stores of at least that many bytes, if the client accepts it. 0 to never gzip.",
+       group="store",
+       type=int)
+
+define("appstore_receipt_cache_ttl",
+       default=86400,
+       help="For how long (in seconds) App Store receipt verification results are cached.",
+       group="store",
+       type=int)
+
+define("item_data_validation",
+       default=True,
+       help="Validate the data of items and campaign items against the schemes of their categories on every "
+            "write. Requires the jsonschema package, otherwise the data is not validated.",
+       group="store",
+       type=bool)
@@ -11,48 +11,169 @@ from anthill.common.social.xsolla import XsollaAPI
 from anthill.common.social.mailru import MailRuAPI
 
 from . import admin
+from . import trace
+from . import workers
+from . encoder import StoreEncoder
 from . model.store import StoreModel
 from . model.item import ItemModel
 from . model.category import CategoryModel
 from . model.tier import TierModel, CurrencyModel
 from . model.order import OrdersModel
+from . model.shard import OrderShards
 from . model.campaign import CampaignsModel
+from . model.invalidation import CatalogInvalidation
+from . model.components import StoreComponents
+from . model.components.guard import ProviderGuards
+from . model.components.appstore import AppStoreStoreComponent
+
+import tornado.httpserver
+
+import logging
+import os
 
 
 class StoreServer(server.Server):
+    # set up before the server is created in the multi-process mode
+    WORKERS = 1
+    WORKER_ID = workers.LEADER
+    SOCKETS = None
+    # a worker never gets fewer database connections than that, no matter the budget: a request may hold
+    # a connection while waiting for another one (its nested calls should be given the held one, though)
+    MIN_WORKER_DB_CONNECTIONS = 4
+
     # noinspection PyShadowingNames
     def __init__(self):
         super(StoreServer, self).__init__()
 
-        self.db = database.Database(
+        self.db = trace.TracedDatabase(database.Database(
             host=options.db_host,
             database=options.db_name,
             user=options.db_username,
-            password=options.db_password)
+            password=options.db_password), max_connections=StoreServer.worker_share(
+            options.db_max_connections, StoreServer.MIN_WORKER_DB_CONNECTIONS))
 
         self.cache = keyvalue.KeyValueStorage(
             host=options.cache_host,
             port=options.cache_port,
             db=options.cache_db,
-            max_connections=options.cache_max_connections)
+            max_connections=StoreServer.worker_share(options.cache_max_connections))
 
         self.steam_api = SteamAPI(self.cache)
         self.xsolla_api = XsollaAPI(self.cache)
         self.mailru_api = MailRuAPI(self.cache)
 
-        self.items = ItemModel(self.db)
-        self.categories = CategoryModel(self.db)
-        self.tiers = TierModel(self.db)
-        self.currencies = CurrencyModel(self.db)
-        self.campaigns = CampaignsModel(self.db)
-        self.stores = StoreModel(self.db, self.items, self.tiers, self.currencies, self.campaigns)
-        self.orders = OrdersModel(self, self.db, self.tiers, self.campaigns)
+        self.invalidation = CatalogInvalidation(self.cache)
+        self.order_shards = OrderShards(self.db, StoreServer.connect_order_shards(options.order_shards),
+                                        invalidation=self.invalidation)
+
+        self.categories = CategoryModel(self.db, self.invalidation,
+                                        validate_items=options.item_data_validation)
+        self.items = ItemModel(self.db, self.invalidation, categories=self.categories)
+        self.tiers = TierModel(self.db, self.invalidation)
+        self.currencies = CurrencyModel(self.db, self.invalidation)
+        self.campaigns = CampaignsModel(self.db, self.invalidation, categories=self.categories)
+        self.stores = StoreModel(self.db, self.items, self.tiers, self.currencies, self.campaigns,
+                                 projection_ttl=options.store_projection_cache_ttl,
+                                 invalidation=self.invalidation,
+                                 campaigns_max_extra_time=options.store_campaigns_max_extra_time,
+                                 campaigns_time_bucket=options.store_campaigns_time_bucket)
+        self.orders = OrdersModel(self, self.db, self.tiers, self.campaigns,
+                                  lease_time=options.order_lease_time,
+                                  history=options.order_history,
+                                  info_indexes=[key.strip() for key in options.order_info_indexes.split(",")
+                                                if key.strip()],
+                                  cache=self.cache,
+                                  pending_marker_ttl=options.pending_orders_marker_ttl,
+                                  insert_batch_window=options.order_insert_batch_window / 1000.0,
+                                  status_batch_window=options.order_status_batch_window / 1000.0,
+                                  shards=self.order_shards,
+                                  report_monitoring=StoreServer.is_leader())
+
+        self.store_encoder = StoreEncoder(
+            self,
+            threads=options.store_encode_threads,
+            offload_threshold=options.store_encode_offload_threshold,
+            gzip_min_size=options.store_gzip_min_size)
 
         admin.init()
 
+        for endpoint in filter(None, options.provider_endpoints.split(",")):
+            component_name, url = endpoint.split("=", 1)
+            StoreComponents.override_endpoint(component_name.strip(), url.strip())
+            logging.warning("Payment provider '{0}' is overridden with {1}".format(component_name, url))
+
+        ProviderGuards.configure(
+            timeout=options.provider_timeout,
+            max_inflight=options.provider_max_inflight,
+            min_inflight=options.provider_min_inflight,
+            failures_threshold=options.provider_breaker_failures,
+            reset_timeout=options.provider_breaker_reset)
+
+        AppStoreStoreComponent.RECEIPT_CACHE_TTL = options.appstore_receipt_cache_ttl
+
+        trace.init(
+            slow_query_threshold=options.slow_query_threshold / 1000.0,
+            debug_header=options.trace_header)
+
+    @staticmethod
+    def connect_order_shards(config):
+        shards = {}
+
+        for name, (host, port, database_name) in OrderShards.parse_config(config).items():
+            kwargs = {"port": port} if port else {}
+            shards[name] = trace.TracedDatabase(database.Database(
+                host=host,
+                database=database_name,
+                user=options.db_username,
+                password=options.db_password,
+                **kwargs), max_connections=StoreServer.worker_share(
+                    options.db_max_connections, StoreServer.MIN_WORKER_DB_CONNECTIONS))
+
+        return shards
+
+    @staticmethod
+    def worker_share(budget, minimum=1):
+        """
+        Splits a connection budget of the whole node between the workers, 0 stays unlimited
+        """
+        if not budget:
+            return 0
+        return max(minimum, budget // StoreServer.WORKERS)
+
+    @staticmethod
+    def is_leader():
+        return StoreServer.WORKER_ID == workers.LEADER
+
+    async def models_started(self):
+        # only the leader creates and upgrades the tables, the others start once it's done,
+        # so the workers don't run the same DDL and backfills at once
+        if not StoreServer.is_leader():
+            await workers.wait_setup()
+
+        try:
+            return await super(StoreServer, self).models_started()
+        finally:
+            if StoreServer.is_leader():
+                workers.setup_complete()
+
+    async def process_shutdown(self):
+        await super(StoreServer, self).process_shutdown()
+        self.store_encoder.shutdown()
+
+    def listen_server(self):
+        if StoreServer.SOCKETS is None:
+            super(StoreServer, self).listen_server()
+            return
+
+        # the sockets are bound before the fork and shared by all workers
+        self.http_server = tornado.httpserver.HTTPServer(self, xheaders=True)
+        self.http_server.add_sockets(StoreServer.SOCKETS)
+
+        logging.info("Worker {0} of {1} is listening".format(StoreServer.WORKER_ID, StoreServer.WORKERS))
+
     def get_models(self):
-        return [self.currencies, self.categories, self.stores,
-                self.items, self.tiers, self.orders, self.campaigns]
+        return [self.invalidation, self.currencies, self.categories, self.stores,
+                self.items, self.tiers, self.order_shards, self.orders, self.campaigns]
 
     def get_admin(self):
         return {
@@ -109,4 +230,12 @@ class StoreServer(server.Server):
 if __name__ == "__main__":
     stt = server.init()
     access.AccessToken.init([access.public()])
+
+    workers_count = options.workers or os.cpu_count() or 1
+
+    if workers_count > 1:
+        StoreServer.SOCKETS = workers.bind_sockets(options.listen)
+        StoreServer.WORKERS = workers_count
+        StoreServer.WORKER_ID = workers.fork_workers(workers_count)
+
     server.start(StoreServer)
@@ -0,0 +1,6 @@
+CREATE TABLE `order_shards` (
+  `gamespace_id` int(11) unsigned NOT NULL,
+  `shard_name` varchar(64) NOT NULL,
+  `shard_state` enum('active','moving') NOT NULL DEFAULT 'active',
+  PRIMARY KEY (`gamespace_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
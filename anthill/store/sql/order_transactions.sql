@@ -0,0 +1,9 @@
+CREATE TABLE `order_transactions` (
+  `gamespace_id` int(11) unsigned NOT NULL,
+  `component_id` int(11) unsigned NOT NULL,
+  `transaction_id` varchar(191) NOT NULL,
+  `order_id` int(11) unsigned NOT NULL,
+  PRIMARY KEY (`gamespace_id`,`component_id`,`transaction_id`),
+  KEY `order_id` (`order_id`),
+  CONSTRAINT `order_transactions_ibfk_1` FOREIGN KEY (`order_id`) REFERENCES `orders` (`order_id`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
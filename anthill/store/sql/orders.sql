@@ -13,6 +13,8 @@ CREATE TABLE `orders` (
   `order_total` float NOT NULL,
   `order_info` json DEFAULT NULL,
   `order_campaign_id` int(11) unsigned DEFAULT NULL,
+  `order_version` int(11) unsigned NOT NULL DEFAULT '0',
+  `order_lease` datetime DEFAULT NULL,
   PRIMARY KEY (`order_id`),
   KEY `store_id` (`store_id`),
   KEY `pack_id` (`tier_id`),
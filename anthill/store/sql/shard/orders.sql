@@ -0,0 +1,26 @@
+CREATE TABLE `orders` (
+  `order_id` int(11) unsigned NOT NULL AUTO_INCREMENT,
+  `gamespace_id` int(11) unsigned NOT NULL,
+  `store_id` int(11) unsigned NOT NULL,
+  `tier_id` int(11) unsigned NOT NULL,
+  `item_id` int(11) unsigned NOT NULL,
+  `component_id` int(11) unsigned NOT NULL,
+  `account_id` int(11) unsigned NOT NULL,
+  `order_amount` int(11) unsigned NOT NULL,
+  `order_status` enum('NEW','CREATED','SUCCEEDED','ERROR','REJECTED','APPROVED','RETRY') NOT NULL DEFAULT 'NEW',
+  `order_time` datetime NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  `order_currency` varchar(16) NOT NULL DEFAULT '',
+  `order_total` float NOT NULL,
+  `order_info` json DEFAULT NULL,
+  `order_campaign_id` int(11) unsigned DEFAULT NULL,
+  `order_version` int(11) unsigned NOT NULL DEFAULT '0',
+  `order_lease` datetime DEFAULT NULL,
+  PRIMARY KEY (`order_id`),
+  KEY `gamespace_id` (`gamespace_id`,`order_id`),
+  KEY `store_id` (`store_id`),
+  KEY `pack_id` (`tier_id`),
+  KEY `item_id` (`item_id`),
+  KEY `component_id` (`component_id`),
+  KEY `account_id` (`account_id`),
+  KEY `order_campaign_id` (`order_campaign_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
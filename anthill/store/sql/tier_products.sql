@@ -0,0 +1,10 @@
+CREATE TABLE `tier_products` (
+  `gamespace_id` int(11) unsigned NOT NULL,
+  `store_id` int(11) unsigned NOT NULL,
+  `component` varchar(32) NOT NULL DEFAULT '',
+  `product` varchar(191) NOT NULL,
+  `tier_id` int(11) unsigned NOT NULL,
+  PRIMARY KEY (`gamespace_id`,`store_id`,`component`,`product`,`tier_id`),
+  KEY `tier_id` (`tier_id`,`component`),
+  CONSTRAINT `tier_products_ibfk_1` FOREIGN KEY (`tier_id`) REFERENCES `tiers` (`tier_id`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
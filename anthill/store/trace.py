@@ -0,0 +1,260 @@
+from contextvars import ContextVar
+
+from tornado.locks import Semaphore
+from tornado import gen
+
+from anthill.common.database import DatabaseError
+
+import functools
+import inspect
+import logging
+import time
+
+
+class RequestTrace(object):
+    """
+    Collects timing spans and database round trips of a single request
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.time()
+        self.duration = 0
+        self.spans = {}
+        self.queries = 0
+        self.query_time = 0
+
+    def add_span(self, name, duration):
+        count, total = self.spans.get(name, (0, 0))
+        self.spans[name] = (count + 1, total + duration)
+
+    def add_query(self, duration):
+        self.queries += 1
+        self.query_time += duration
+
+    def finish(self):
+        self.duration = time.time() - self.started
+
+    def header(self):
+        parts = ["total={0:.1f}ms".format(self.duration * 1000),
+                 "db={0}/{1:.1f}ms".format(self.queries, self.query_time * 1000)]
+
+        parts.extend(
+            "{0}={1}/{2:.1f}ms".format(name, count, total * 1000)
+            for name, (count, total) in sorted(self.spans.items(), key=lambda span: -span[1][1]))
+
+        return "; ".join(parts)
+
+    def report(self, app):
+        app.monitor_action("trace.request", values={
+            "duration": self.duration * 1000,
+            "db_queries": self.queries,
+            "db_time": self.query_time * 1000
+        }, request=self.name)
+
+        for name, (count, total) in self.spans.items():
+            app.monitor_action("trace.span", values={
+                "duration": total * 1000,
+                "count": count
+            }, span=name, request=self.name)
+
+
+class Tracing(object):
+    # queries slower than this (in seconds) are logged, 0 to disable
+    SLOW_QUERY_THRESHOLD = 0
+    # whenever an X-Store-Trace header is added to the traced responses
+    DEBUG_HEADER = False
+
+
+_current_trace = ContextVar("store_request_trace", default=None)
+
+
+def init(slow_query_threshold=0, debug_header=False):
+    Tracing.SLOW_QUERY_THRESHOLD = slow_query_threshold
+    Tracing.DEBUG_HEADER = debug_header
+
+
+def current():
+    return _current_trace.get()
+
+
+def add_span(name, duration):
+    request_trace = _current_trace.get()
+    if request_trace is not None:
+        request_trace.add_span(name, duration)
+
+
+class span(object):
+    """
+    Measures a block of code as a span of the current request, if there is any:
+
+    async with trace.span("provider.steam.new_order"):
+        await ...
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.started = 0
+
+    async def __aenter__(self):
+        self.started = time.time()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        add_span(self.name, time.time() - self.started)
+
+
+async def _measure(name, awaitable):
+    started = time.time()
+    try:
+        return await awaitable
+    finally:
+        add_span(name, time.time() - started)
+
+
+def traced_request(name):
+    """
+    Traces the decorated handler method: every instrumented model method, provider call and query
+    awaited within the request is accounted, the result is reported to the monitoring, and, if enabled,
+    returned as X-Store-Trace response header.
+    """
+
+    def wrapper1(method):
+        @functools.wraps(method)
+        async def wrapper2(handler, *args, **kwargs):
+            request_trace = RequestTrace(name)
+            token = _current_trace.set(request_trace)
+
+            try:
+                return await method(handler, *args, **kwargs)
+            finally:
+                _current_trace.reset(token)
+                request_trace.finish()
+
+                if Tracing.DEBUG_HEADER:
+                    handler.set_header("X-Store-Trace", request_trace.header())
+
+                request_trace.report(handler.application)
+
+        return wrapper2
+    return wrapper1
+
+
+# model methods that are not a part of request processing
+NOT_TRACED = {"get_setup_db", "get_setup_tables", "has_delete_account_event", "started", "stopped"}
+
+
+def instrument(cls, prefix):
+    """
+    Wraps every method of a model class into a span named <prefix>.<method name>
+    """
+
+    def traced(span_name, method):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            result = method(*args, **kwargs)
+            if not inspect.isawaitable(result):
+                return result
+            return _measure(span_name, result)
+        return wrapper
+
+    for name, method in list(vars(cls).items()):
+        if not inspect.isfunction(method) or name in NOT_TRACED or hasattr(object, name):
+            continue
+
+        setattr(cls, name, traced(prefix + "." + name.strip("_"), method))
+
+
+class TracedConnection(object):
+    # for how long to wait for a free connection slot, like the pool waits for a free connection
+    SLOT_TIMEOUT = 15
+
+    def __init__(self, connection, slots=None):
+        self.connection = connection
+        self.slots = slots
+
+    def __getattr__(self, item):
+        return getattr(self.connection, item)
+
+    async def __aenter__(self):
+        if self.slots is not None:
+            try:
+                await self.slots.acquire(timeout=TracedConnection.SLOT_TIMEOUT)
+            except gen.TimeoutError:
+                raise DatabaseError(0, "Timed out waiting for a database connection")
+
+        try:
+            await self.connection.__aenter__()
+        except BaseException:
+            if self.slots is not None:
+                self.slots.release()
+            raise
+
+        return self
+
+    async def __aexit__(self, *exc_info):
+        try:
+            await self.connection.__aexit__(*exc_info)
+        finally:
+            if self.slots is not None:
+                self.slots.release()
+
+    async def __timed__(self, method, query, args, kwargs):
+        started = time.time()
+        try:
+            return await method(query, *args, **kwargs)
+        finally:
+            duration = time.time() - started
+
+            request_trace = _current_trace.get()
+            if request_trace is not None:
+                request_trace.add_query(duration)
+
+            if Tracing.SLOW_QUERY_THRESHOLD and duration > Tracing.SLOW_QUERY_THRESHOLD:
+                logging.warning("Slow query ({0:.1f}ms): {1}".format(duration * 1000, " ".join(query.split())))
+
+    def execute(self, query, *args, **kwargs):
+        return self.__timed__(self.connection.execute, query, args, kwargs)
+
+    def get(self, query, *args, **kwargs):
+        return self.__timed__(self.connection.get, query, args, kwargs)
+
+    def insert(self, query, *args, **kwargs):
+        return self.__timed__(self.connection.insert, query, args, kwargs)
+
+    def query(self, query, *args, **kwargs):
+        return self.__timed__(self.connection.query, query, args, kwargs)
+
+
+class TracedDatabase(object):
+    """
+    Wraps a database so every query is counted to the current request trace and checked against
+    the slow query threshold. If max_connections is set, no more than that many connections are used at once
+    (the pool itself always allows 256).
+    """
+
+    def __init__(self, db, max_connections=0):
+        self.db = db
+        self.slots = Semaphore(max_connections) if max_connections else None
+
+    def __getattr__(self, item):
+        return getattr(self.db, item)
+
+    def acquire(self, auto_commit=True):
+        return TracedConnection(self.db.acquire(auto_commit=auto_commit), self.slots)
+
+    async def execute(self, query, *args, **kwargs):
+        async with self.acquire() as conn:
+            return await conn.execute(query, *args, **kwargs)
+
+    async def get(self, query, *args, **kwargs):
+        async with self.acquire() as conn:
+            return await conn.get(query, *args, **kwargs)
+
+    async def insert(self, query, *args, **kwargs):
+        async with self.acquire() as conn:
+            return await conn.insert(query, *args, **kwargs)
+
+    async def query(self, query, *args, **kwargs):
+        async with self.acquire() as conn:
+            return await conn.query(query, *args, **kwargs)
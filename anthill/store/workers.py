@@ -0,0 +1,159 @@
+"""
+Pre-fork serving mode: the listening sockets are bound once, then the process is forked into a number
+of workers that accept connections on the very same sockets, so the service can use more than one core.
+
+The parent process only supervises: it restarts the workers that crash, and passes SIGTERM / SIGINT on
+to them. Every worker has its own IOLoop and its own database and cache pools, so nothing may touch
+those before the fork.
+
+The database is set up (tables created, backfilled and upgraded) by the leader worker alone, the rest of
+the workers wait for it to finish before starting their models.
+"""
+
+from anthill.common.server import ServerError
+
+import tornado.netutil
+import tornado.ioloop
+
+import multiprocessing
+import logging
+import random
+import signal
+import sys
+import os
+
+
+# the worker that runs the things that should only run once per node (like periodic monitoring reports)
+LEADER = 0
+
+MAX_RESTARTS = 100
+
+# seconds between the reports of a worker waiting for the leader
+SETUP_WAIT = 10
+
+# shared between the workers, set once the leader has set the database up
+setup_event = None
+
+
+def bind_sockets(listen_uri):
+    """
+    Binds the sockets of the 'listen' option (port:N or unix:PATH), the same way the server would
+    """
+
+    listen_group = listen_uri.split(":")
+
+    if len(listen_group) < 2:
+        raise ServerError("Failed to listen on " + listen_uri + ": bad format")
+
+    kind, addresses = listen_group[0], listen_group[1:]
+
+    sockets = []
+
+    if kind == "port":
+        for port in addresses:
+            sockets.extend(tornado.netutil.bind_sockets(int(port), "127.0.0.1"))
+    elif kind == "unix":
+        for sock in addresses:
+            sockets.append(tornado.netutil.bind_unix_socket(sock, mode=0o777))
+    else:
+        raise ServerError("Failed to listen on " + listen_uri + ": unsupported kind")
+
+    logging.info("Listening '{0}' on '{1}'".format(kind, addresses))
+    return sockets
+
+
+def setup_complete():
+    """
+    Called by the leader once its models have started
+    """
+    if setup_event is not None:
+        setup_event.set()
+
+
+async def wait_setup():
+    """
+    Waits for the leader to set the database up, returns at once if not forked
+    """
+    if setup_event is None:
+        return
+
+    loop = tornado.ioloop.IOLoop.current()
+
+    while not (await loop.run_in_executor(None, setup_event.wait, SETUP_WAIT)):
+        logging.info("Waiting for the leader worker to set the database up")
+
+
+def fork_workers(count):
+    """
+    Forks count workers. Returns the id of the worker (from 0 to count - 1) in each of them,
+    the parent process never returns.
+    """
+
+    global setup_event
+    # a restarted leader sets the database up again, but nobody waits for it anymore
+    setup_event = multiprocessing.Event()
+
+    children = {}
+    state = {"stopping": False, "restarts": 0}
+
+    def start_worker(worker_id):
+        pid = os.fork()
+
+        if pid == 0:
+            # the server installs its own handlers
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            random.seed()
+            return True
+
+        children[pid] = worker_id
+        return False
+
+    # noinspection PyUnusedLocal
+    def stop(sig, frame):
+        state["stopping"] = True
+
+        for pid in list(children):
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    logging.info("Starting {0} workers".format(count))
+
+    for worker_id in range(count):
+        if start_worker(worker_id):
+            return worker_id
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+
+        worker_id = children.pop(pid, None)
+
+        if worker_id is None or state["stopping"]:
+            continue
+
+        if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+            logging.info("Worker {0} (pid {1}) has exited".format(worker_id, pid))
+            continue
+
+        logging.warning("Worker {0} (pid {1}) has died with status {2}, restarting".format(
+            worker_id, pid, status))
+
+        state["restarts"] += 1
+
+        if state["restarts"] > MAX_RESTARTS:
+            logging.error("Too many workers have died, stopping")
+            stop(signal.SIGTERM, None)
+            continue
+
+        if start_worker(worker_id):
+            return worker_id
+
+    sys.exit(1 if state["restarts"] > MAX_RESTARTS else 0)
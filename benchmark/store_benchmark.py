@@ -0,0 +1,392 @@
+"""
+Load-testing benchmark for the store service.
+
+Seeds a realistic catalog (stores, tiers, items, campaigns and a large order history) into a store
+database, and then drives a running store service over HTTP, reporting throughput and p50/p99 latency
+for every endpoint exercised.
+
+The service under test and the seeding step should point at the same MySQL database (use a dedicated
+one, for example 'bench_store'), and the service should have been started against it at least once,
+so the tables are created. benchmark/docker-compose.yml brings up a local MySQL and Redis with exactly
+these defaults, for when there are no spare ones at hand. If the service runs with --order_shards,
+pass the same value to the seed command as --order-shards, so the order history is seeded into the shard
+the gamespace is mapped to. Payment providers the service talks to should be stand-ins rather than
+live ones, otherwise the order endpoints measure the provider, not the service: run
+anthill.store.fake_providers and start the service with --provider_endpoints pointing at it.
+
+Usage:
+
+    docker-compose -f benchmark/docker-compose.yml up -d
+    python benchmark/store_benchmark.py seed --db-name bench_store --gamespace 1 --orders 1000000
+    python benchmark/store_benchmark.py run --host http://localhost:9516 --token <access token> \\
+        --gamespace 1 --duration 30 --concurrency 64
+
+The access token should have 'store' and 'store_order' scopes for the gamespace being tested.
+"""
+
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest, HTTPError
+from tornado.ioloop import IOLoop
+from tornado import gen
+
+from anthill.common.database import Database
+
+from anthill.store.model.store import StoreModel, StoreNotFound
+from anthill.store.model.item import ItemModel
+from anthill.store.model.category import CategoryModel
+from anthill.store.model.tier import TierModel, CurrencyModel, CurrencyError, TierError
+from anthill.store.model.campaign import CampaignsModel
+from anthill.store.model.shard import OrderShards, OrderShardError
+
+from urllib import parse
+
+import argparse
+import datetime
+import hashlib
+import random
+import time
+import ujson
+
+
+LANGUAGES = ["EN", "RU", "DE", "FR", "ES", "PT", "JA", "KO", "ZH"]
+CURRENCIES = ["USD", "EUR", "RUB"]
+ORDER_STATUSES = ["NEW", "CREATED", "SUCCEEDED", "ERROR", "REJECTED", "APPROVED", "RETRY"]
+
+
+def localized(text):
+    return {
+        language: "{0} ({1})".format(text, language)
+        for language in LANGUAGES
+    }
+
+
+async def seed(args):
+    db = Database(
+        host=args.db_host,
+        database=args.db_name,
+        user=args.db_username,
+        password=args.db_password)
+
+    items = ItemModel(db)
+    tiers = TierModel(db)
+    currencies = CurrencyModel(db)
+    categories = CategoryModel(db)
+    campaigns = CampaignsModel(db)
+    stores = StoreModel(db, items, tiers, currencies, campaigns)
+
+    gamespace_id = args.gamespace
+
+    # the order history goes where the service looks for it: the shard the gamespace is mapped to
+    order_shards = OrderShards(db, {
+        name: Database(
+            host=host,
+            database=database_name,
+            user=args.db_username,
+            password=args.db_password,
+            **({"port": port} if port else {}))
+        for name, (host, port, database_name) in OrderShards.parse_config(args.order_shards).items()
+    })
+
+    await order_shards.reload()
+
+    try:
+        orders_db = order_shards.db_for(gamespace_id)
+    except OrderShardError as e:
+        raise SystemExit("Cannot seed the orders of gamespace {0}: {1}".format(gamespace_id, e.message))
+
+    for currency_name in CURRENCIES:
+        try:
+            await currencies.new_currency(
+                gamespace_id, currency_name, currency_name, "{0} " + currency_name, "$", currency_name)
+        except (CurrencyError, TierError):
+            pass
+
+    category_id = await categories.new_category(
+        gamespace_id, "bench_{0}".format(int(time.time())),
+        CategoryModel.DEFAULT_PUBLIC_SCHEME, CategoryModel.DEFAULT_PRIVATE_SCHEME)
+
+    for store_index in range(args.stores):
+        store_name = "bench_{0}".format(store_index)
+
+        try:
+            await stores.find_store(gamespace_id, store_name)
+        except StoreNotFound:
+            store_id = await stores.new_store(gamespace_id, store_name, {})
+        else:
+            print("Store '{0}' already exists, skipping".format(store_name))
+            continue
+
+        component_id = await stores.new_store_component(
+            gamespace_id, store_id, args.component, {"sandbox": True})
+
+        tier_ids = []
+
+        for tier_index in range(args.tiers):
+            tier_ids.append(await tiers.new_tier(
+                gamespace_id, store_id, "tier_{0}".format(tier_index), "Tier {0}".format(tier_index),
+                "com.bench.tier{0}".format(tier_index), {
+                    currency: (tier_index + 1) * 99
+                    for currency in CURRENCIES
+                }))
+
+        item_ids = []
+
+        for item_index in range(args.items):
+            item_ids.append(await items.new_item(
+                gamespace_id, store_id, category_id, "item_{0}".format(item_index), True,
+                {
+                    "title": localized("Item {0}".format(item_index)),
+                    "description": localized("Description of item {0}".format(item_index)),
+                    "category": "bench"
+                },
+                {"reward": {"gold": item_index * 100}},
+                random.choice(tier_ids)))
+
+        now = datetime.datetime.utcnow()
+
+        for campaign_index in range(args.campaigns):
+            campaign_id = await campaigns.new_campaign(
+                gamespace_id, store_id, "campaign_{0}".format(campaign_index),
+                (now - datetime.timedelta(days=1)).strftime("%Y-%m-%d %H:%M:%S"),
+                (now + datetime.timedelta(days=campaign_index + 1)).strftime("%Y-%m-%d %H:%M:%S"),
+                {"banner": "campaign_{0}".format(campaign_index)}, True)
+
+            for item_id in random.sample(item_ids, min(len(item_ids), args.campaign_items)):
+                await campaigns.add_campaign_item(
+                    gamespace_id, campaign_id, item_id,
+                    {"reward": {"gold": 1000}},
+                    {"title": localized("Sale"), "description": localized("Sale item")},
+                    random.choice(tier_ids))
+
+        orders_left = args.orders // args.stores
+
+        while orders_left > 0:
+            batch = min(orders_left, args.batch)
+            values = []
+
+            for i in range(batch):
+                currency = random.choice(CURRENCIES)
+                values.extend([
+                    gamespace_id, store_id, random.choice(tier_ids), random.choice(item_ids), component_id,
+                    random.randint(1, args.accounts), 1, random.choice(ORDER_STATUSES), currency,
+                    random.randint(99, 9900), ujson.dumps({"transaction_id": random.randint(1, 1 << 40)})
+                ])
+
+            await orders_db.execute(
+                """
+                    INSERT INTO `orders`
+                        (`gamespace_id`, `store_id`, `tier_id`, `item_id`, `component_id`, `account_id`,
+                         `order_amount`, `order_status`, `order_currency`, `order_total`, `order_info`)
+                    VALUES {0};
+                """.format(", ".join(["(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"] * batch)), *values)
+
+            orders_left -= batch
+
+        print("Seeded store '{0}'".format(store_name))
+
+
+class EndpointStats(object):
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.errors = {}
+
+    def add(self, latency, code):
+        self.latencies.append(latency)
+        if code >= 400:
+            self.errors[code] = self.errors.get(code, 0) + 1
+
+    def percentile(self, p):
+        if not self.latencies:
+            return 0
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100.0))]
+
+    def dump(self, duration):
+        return {
+            "endpoint": self.name,
+            "requests": len(self.latencies),
+            "throughput": round(len(self.latencies) / duration, 2),
+            "p50": round(self.percentile(50) * 1000, 2),
+            "p99": round(self.percentile(99) * 1000, 2),
+            "errors": self.errors
+        }
+
+
+class Scenario(object):
+    def __init__(self, args):
+        self.args = args
+
+    def store_request(self):
+        arguments = {
+            "access_token": self.args.token,
+            "extra_start_time": random.choice([0, 3600]),
+            "extra_end_time": random.choice([0, 3600])
+        }
+
+        if self.args.language:
+            arguments["language"] = self.args.language
+
+        return HTTPRequest(
+            self.args.host + "/store/" + self.store_name() + "?" + parse.urlencode(arguments),
+            method="GET")
+
+    def new_order_request(self):
+        return HTTPRequest(
+            self.args.host + "/order/new", method="POST", body=parse.urlencode({
+                "access_token": self.args.token,
+                "store": self.store_name(),
+                "item": "item_{0}".format(random.randrange(self.args.items)),
+                "currency": random.choice(CURRENCIES),
+                "amount": 1,
+                "component": self.args.component,
+                "env": ujson.dumps({
+                    "steam_id": "76561197960287930",
+                    "language": random.choice(LANGUAGES)
+                })
+            }))
+
+    def orders_request(self):
+        return HTTPRequest(
+            self.args.host + "/orders", method="POST", body=parse.urlencode({
+                "access_token": self.args.token
+            }))
+
+    def web_hook_request(self):
+        body = ujson.dumps({
+            "notification_type": "payment",
+            "transaction": {
+                "id": random.randint(1, 1 << 40),
+                "external_id": str(random.randint(1, self.args.orders)),
+                "dry_run": 1
+            }
+        })
+
+        signature = hashlib.sha1(bytes(body + self.args.xsolla_project_key, "utf-8")).hexdigest().lower()
+
+        return HTTPRequest(
+            self.args.host + "/hook/{0}/{1}/xsolla".format(self.args.gamespace, self.store_name()),
+            method="POST", body=body, headers={
+                "Authorization": "Signature " + signature
+            })
+
+    def store_name(self):
+        return "bench_{0}".format(random.randrange(self.args.stores))
+
+    def endpoints(self):
+        result = {
+            "store": self.store_request,
+            "new_order": self.new_order_request,
+            "orders": self.orders_request
+        }
+
+        if self.args.xsolla_project_key:
+            result["web_hook"] = self.web_hook_request
+
+        return {
+            name: factory
+            for name, factory in result.items()
+            if name in self.args.endpoints
+        }
+
+
+async def run_endpoint(name, factory, args):
+    client = AsyncHTTPClient(force_instance=True, max_clients=args.concurrency)
+    stats = EndpointStats(name)
+    deadline = time.time() + args.duration
+
+    async def worker():
+        while time.time() < deadline:
+            request = factory()
+            request.request_timeout = args.timeout
+            started = time.time()
+
+            try:
+                response = await client.fetch(request, raise_error=False)
+            except HTTPError as e:
+                code = e.code
+            else:
+                code = response.code
+
+            stats.add(time.time() - started, code)
+
+    started_at = time.time()
+
+    await gen.multi([worker() for _ in range(args.concurrency)])
+    client.close()
+
+    return stats.dump(time.time() - started_at)
+
+
+async def run(args):
+    scenario = Scenario(args)
+    report = []
+
+    for name, factory in scenario.endpoints().items():
+        print("Benchmarking '{0}' for {1}s at concurrency {2}...".format(name, args.duration, args.concurrency))
+        result = await run_endpoint(name, factory, args)
+        report.append(result)
+
+    print("{0:<12} {1:>10} {2:>12} {3:>10} {4:>10}  {5}".format(
+        "endpoint", "requests", "req/s", "p50 ms", "p99 ms", "errors"))
+
+    for result in report:
+        print("{endpoint:<12} {requests:>10} {throughput:>12} {p50:>10} {p99:>10}  {errors}".format(**result))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(ujson.dumps(report, indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Store service benchmark")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    seed_parser = subparsers.add_parser("seed", help="Seed a benchmark catalog and order history")
+    seed_parser.add_argument("--db-host", default="127.0.0.1")
+    seed_parser.add_argument("--db-username", default="root")
+    seed_parser.add_argument("--db-password", default="")
+    seed_parser.add_argument("--db-name", default="bench_store")
+    seed_parser.add_argument("--gamespace", type=int, default=1)
+    seed_parser.add_argument("--component", default="steam")
+    seed_parser.add_argument("--stores", type=int, default=2)
+    seed_parser.add_argument("--tiers", type=int, default=20)
+    seed_parser.add_argument("--items", type=int, default=2000)
+    seed_parser.add_argument("--campaigns", type=int, default=10)
+    seed_parser.add_argument("--campaign-items", type=int, default=50)
+    seed_parser.add_argument("--orders", type=int, default=1000000)
+    seed_parser.add_argument("--accounts", type=int, default=100000)
+    seed_parser.add_argument("--batch", type=int, default=1000)
+    seed_parser.add_argument("--order-shards", default="",
+                             help="Same as the service's --order_shards, if the orders are sharded")
+
+    run_parser = subparsers.add_parser("run", help="Drive a running store service")
+    run_parser.add_argument("--host", default="http://localhost:9516")
+    run_parser.add_argument("--token", required=True)
+    run_parser.add_argument("--gamespace", type=int, default=1)
+    run_parser.add_argument("--component", default="steam")
+    run_parser.add_argument("--stores", type=int, default=2)
+    run_parser.add_argument("--items", type=int, default=2000)
+    run_parser.add_argument("--orders", type=int, default=1000000)
+    run_parser.add_argument("--language", default=None)
+    run_parser.add_argument("--xsolla-project-key", default=None,
+                            help="Project key to sign xsolla web hooks with, web hooks are skipped if not set")
+    run_parser.add_argument("--endpoints", default="store,new_order,orders,web_hook",
+                            type=lambda value: value.split(","))
+    run_parser.add_argument("--duration", type=int, default=30)
+    run_parser.add_argument("--concurrency", type=int, default=32)
+    run_parser.add_argument("--timeout", type=float, default=10)
+    run_parser.add_argument("--output", default=None, help="Write the report as JSON into this file")
+
+    args = parser.parse_args()
+
+    command = {
+        "seed": seed,
+        "run": run
+    }[args.command]
+
+    IOLoop.current().run_sync(lambda: command(args))
+
+
+if __name__ == "__main__":
+    main()
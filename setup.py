@@ -20,5 +20,8 @@ setup(
     include_package_data=True,
     packages=find_namespace_packages(include=["anthill.*"]),
     zip_safe=False,
-    install_requires=DEPENDENCIES
+    install_requires=DEPENDENCIES,
+    extras_require={
+        "validation": ["jsonschema>=3.0"]
+    }
 )